@@ -13,6 +13,28 @@ class Settings(BaseSettings):
     es_password: Optional[str] = None
     openai_key: Optional[str] = None
     openai_org: Optional[str] = None
+    embedding_cache_path: Optional[str] = None
+    embedding_cache_size: int = 1_000_000
+    es_connections_per_node: int = 10
+    es_routing: bool = False
+    es_number_of_shards: Optional[int] = None
+    ir_system_idle_ttl: int = 900
+    result_cache_size: int = 10000
+    result_cache_ttl: int = 300
+    query_embedding_cache_size: int = 10000
+    query_embedding_cache_path: Optional[str] = None
+    hybrid_retrieval: bool = False
+    hybrid_lexical_weight: float = 1.0
+    hybrid_vector_weight: float = 1.0
+    hybrid_prefilter_size: Optional[int] = None
+    ingestion_queue_path: Optional[str] = None
+    ingestion_workers: int = 1
+    ingestion_max_queued: int = 100
+    ingestion_batch_size: int = 500
+    ingestion_bulk_load: bool = False
+    ingestion_force_merge_segments: Optional[int] = None
+    metrics_enabled: bool = True
+    batch_search_max_queries: int = 100
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,273 @@
+import json
+from contextlib import nullcontext
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, List, Optional
+from qa_engine.core.ir_system import IRSystem
+from qa_engine.core.models import Document
+from qa_engine.utils.stages import observe_stages
+
+# the number of failure messages kept per job
+MAX_ERRORS = 10
+
+
+class QueueFull(Exception):
+    pass
+
+
+class IngestionJobs:
+    """
+    Background ingestion of json documents by a bounded pool of worker threads. Jobs and their payload are
+    queued in sqlite, so queued and interrupted jobs are resumed after a restart (re-indexing the objects
+    that were already indexed is a no-op thanks to their fingerprints).
+    :parameter resolve: Returns the IRSystem of (index_name, text_keys, id_key).
+    :parameter path: The sqlite file backing the queue, None keeps it in memory.
+    :parameter max_workers: The number of jobs running at the same time.
+    :parameter max_queued: The number of jobs waiting to run, beyond it submit raises QueueFull.
+    :parameter batch_size: The number of objects indexed at once, progress is reported and cancellation
+        checked between batches. The objects of a failing batch are retried one by one, so a job reports how
+        many objects were indexed (objects_done) and how many failed (objects_failed).
+    :parameter bulk_load: Whether jobs run in the bulk-load mode of the IRSystem (see CachingStrategy.bulk_load),
+        which speeds up large first-time ingestions but delays the visibility of the objects to the end of the job.
+        The indices are tuned as a whole: nothing written to them, by any association or api instance, becomes
+        searchable before the job ends. The tuning of jobs interrupted by a restart is undone before they resume.
+    :parameter force_merge_segments: In bulk-load mode, the number of segments the vector index is merged into
+        at the end of every job, None skips the merge.
+    """
+
+    def __init__(self,
+                 resolve: Callable[[str, List[str], str], IRSystem],
+                 path: str = None,
+                 max_workers=1,
+                 max_queued=100,
+                 batch_size=500,
+                 bulk_load=False,
+                 force_merge_segments: int = None):
+        self.resolve = resolve
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self.bulk_load = bulk_load
+        self.force_merge_segments = force_merge_segments
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._workers = []
+        self._closed = False
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT, index_name TEXT, text_keys TEXT, id_key TEXT, association_id TEXT, "
+            "sync INTEGER, payload TEXT, objects_total INTEGER, objects_done INTEGER DEFAULT 0, "
+            "objects_failed INTEGER DEFAULT 0, embedded INTEGER DEFAULT 0, embed_seconds REAL DEFAULT 0, "
+            "stored INTEGER DEFAULT 0, store_seconds REAL DEFAULT 0, errors TEXT DEFAULT '[]', "
+            "cancel_requested INTEGER DEFAULT 0, created REAL, started REAL, finished REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        # their indices may still be tuned for a bulk load, see _run
+        self._interrupted = {index_name for index_name, in self._db.execute(
+            "SELECT DISTINCT index_name FROM jobs WHERE status = 'running'")}
+        # jobs interrupted by a restart run again, from their last finished batch
+        self._db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+        self._db.commit()
+        if self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]:
+            self._start_workers()
+
+    def submit(self, index_name: str, text_keys: List[str], id_key: str, association_id: str, documents: list,
+               sync=False) -> dict:
+        job_id = str(uuid.uuid4())
+        with self._lock:
+            queued = self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFull(f"{queued} ingestion jobs are already queued")
+            self._db.execute(
+                "INSERT INTO jobs (id, status, index_name, text_keys, id_key, association_id, sync, payload, "
+                "objects_total, created) VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, index_name, json.dumps(text_keys), id_key, association_id, int(sync), json.dumps(documents),
+                 len(documents), time.time()))
+            self._db.commit()
+            self._start_workers()
+            self._wakeup.notify()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            rows = self._select("WHERE id = ?", (job_id,))
+        return rows[0] if rows else None
+
+    def list(self, limit=50) -> List[dict]:
+        with self._lock:
+            return self._select("ORDER BY created DESC LIMIT ?", (limit,))
+
+    def cancel(self, job_id: str) -> Optional[dict]:
+        """
+        Queued jobs are cancelled right away, running ones after their current batch.
+        """
+        with self._lock:
+            self._db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+            self._db.execute("UPDATE jobs SET status = 'cancelled', payload = NULL, finished = ? "
+                             "WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+            self._db.commit()
+        return self.get(job_id)
+
+    def _select(self, clause: str, params: tuple) -> List[dict]:
+        cursor = self._db.execute(
+            "SELECT id, status, index_name, association_id, objects_total, objects_done, objects_failed, "
+            "embedded, embed_seconds, stored, store_seconds, errors, cancel_requested, created, started, finished "
+            f"FROM jobs {clause}", params)
+        jobs = []
+        for (job_id, status, index_name, association_id, total, done, failed, embedded, embed_seconds, stored,
+             store_seconds, errors, cancel_requested, created, started, finished) in cursor.fetchall():
+            jobs.append({
+                "id": job_id,
+                "status": status,
+                "index_name": index_name,
+                "association_id": association_id,
+                "objects_total": total,
+                "objects_done": done,
+                "objects_failed": failed,
+                "progress": (done + failed) / total if total else 1.0,
+                "embed_per_second": embedded / embed_seconds if embed_seconds else None,
+                "store_per_second": stored / store_seconds if store_seconds else None,
+                "errors": json.loads(errors),
+                "cancel_requested": bool(cancel_requested),
+                "created": created,
+                "started": started,
+                "finished": finished,
+            })
+        return jobs
+
+    def _start_workers(self):
+        self._workers = [worker for worker in self._workers if worker.is_alive()]
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._work, name="ingestion-worker", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _claim(self) -> Optional[tuple]:
+        with self._lock:
+            while not self._closed:
+                row = self._db.execute(
+                    "SELECT id, index_name, text_keys, id_key, association_id, sync, payload, "
+                    "objects_done + objects_failed FROM jobs WHERE status = 'queued' "
+                    "ORDER BY created LIMIT 1").fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE jobs SET status = 'running', started = COALESCE(started, ?) WHERE id = ?",
+                                     (time.time(), row[0]))
+                    self._db.commit()
+                    return row
+                self._wakeup.wait()
+        return None
+
+    def _work(self):
+        while True:
+            job = self._claim()
+            if job is None:
+                return
+            try:
+                self._run(*job)
+            except Exception as e:
+                self._finish(job[0], "failed", error=str(e))
+
+    def _run(self, job_id: str, index_name: str, text_keys: str, id_key: str, association_id: str, sync: int,
+             payload: str, objects_processed: int):
+        ir_system = self.resolve(index_name, json.loads(text_keys), id_key)
+        with self._lock:
+            interrupted = index_name in self._interrupted
+            self._interrupted.discard(index_name)
+        if interrupted:
+            ir_system.restore_bulk_load()
+        documents = json.loads(payload)
+        # the bulk load ends (and refreshes the indices) before the sync pass, which searches the indexed entries
+        with ir_system.bulk_load(self.force_merge_segments) if self.bulk_load else nullcontext():
+            failed = self._index_batches(ir_system, job_id, association_id, documents, objects_processed)
+        if failed is None:
+            return
+        if sync and not failed and not self._cancel_requested(job_id):
+            # every object is indexed, this only removes the objects missing from the documents
+            ir_system.index_document(Document(association_id, data=documents), sync=True)
+        self._finish(job_id, "failed" if failed else "completed")
+
+    def _index_batches(self, ir_system: IRSystem, job_id: str, association_id: str, documents: list,
+                       objects_processed: int) -> Optional[bool]:
+        """
+        Indexes the documents from `objects_processed` on, returns whether an object failed or None when the job
+        was cancelled or requeued.
+        """
+        failed = False
+        for start in range(objects_processed, len(documents), self.batch_size):
+            if self._cancel_requested(job_id):
+                self._finish(job_id, "cancelled")
+                return None
+            if self._closed:
+                self._requeue(job_id)
+                return None
+            batch = documents[start:start + self.batch_size]
+            stages = {"embed": [0, 0.0], "store": [0, 0.0]}
+
+            def observe(name: str, seconds: float, count: int, failed: bool):
+                if name in stages:
+                    stages[name][0] += count
+                    stages[name][1] += seconds
+
+            errors = []
+            try:
+                with observe_stages(observe):
+                    ir_system.index_document(Document(association_id, data=batch))
+            except Exception:
+                # only the objects at fault fail, the indexed ones are skipped as unchanged
+                for obj in batch:
+                    try:
+                        with observe_stages(observe):
+                            ir_system.index_document(Document(association_id, data=[obj]))
+                    except Exception as e:
+                        errors.append(str(e))
+            failed = failed or bool(errors)
+            self._report(job_id, len(batch) - len(errors), len(errors), stages, errors)
+        return failed
+
+    def _requeue(self, job_id: str):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = 'queued' WHERE id = ?", (job_id,))
+            self._db.commit()
+
+    def _cancel_requested(self, job_id: str) -> bool:
+        with self._lock:
+            return bool(self._db.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+
+    def _report(self, job_id: str, done: int, failed: int, stages: dict, errors: List[str]):
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET objects_done = objects_done + ?, objects_failed = objects_failed + ?, "
+                "embedded = embedded + ?, embed_seconds = embed_seconds + ?, "
+                "stored = stored + ?, store_seconds = store_seconds + ? WHERE id = ?",
+                (done, failed, *stages["embed"], *stages["store"], job_id))
+            for error in errors[-MAX_ERRORS:]:
+                self._append_error(job_id, error)
+            self._db.commit()
+
+    def _append_error(self, job_id: str, error: str):
+        errors = json.loads(self._db.execute("SELECT errors FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+        errors = (errors + [error])[-MAX_ERRORS:]
+        self._db.execute("UPDATE jobs SET errors = ? WHERE id = ?", (json.dumps(errors), job_id))
+
+    def _finish(self, job_id: str, status: str, error: str = None):
+        with self._lock:
+            if error is not None:
+                self._append_error(job_id, error)
+            # the payload is only needed to resume the job
+            self._db.execute("UPDATE jobs SET status = ?, payload = NULL, finished = ? WHERE id = ?",
+                             (status, time.time(), job_id))
+            self._db.commit()
+
+    def close(self, timeout: float = None):
+        """
+        Stops the workers once their current batch is done, running jobs are resumed by the next instance
+        using the same sqlite file.
+        """
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
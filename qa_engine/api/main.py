@@ -1,8 +1,13 @@
+import time
 from qa_engine.api import config
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from qa_engine.api.routers import es
+from qa_engine.api.registry import get_registry
+from qa_engine.utils.metrics import stage_metrics, StageTimings
+from qa_engine.utils.stages import add_global_observer, observe_stages, stage
 from mangum import Mangum
 
 settings = config.get_settings()
@@ -14,10 +19,41 @@ app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True,
 app.add_middleware(TrustedHostMiddleware, allowed_hosts=settings.whitelist)
 app.include_router(es.router)
 
+if settings.metrics_enabled:
+    add_global_observer(stage_metrics)
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def metrics():
+        return PlainTextResponse(stage_metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    """
+    Echoes the duration of the pipeline stages run for the request in a Server-Timing header. The headers
+    are sent before the body, so the stages run while a StreamingResponse (e.g. the SSE search) is streamed
+    are missing from it.
+    """
+    timings = StageTimings()
+    start = time.perf_counter()
+    with stage("request"), observe_stages(timings):
+        response = await call_next(request)
+    response.headers["Server-Timing"] = ", ".join(
+        filter(None, [timings.server_timing(), f"total;dur={(time.perf_counter() - start) * 1000:.1f}"]))
+    return response
+
 
 @app.on_event("startup")
 def load_prerequisites():
     print("starting app")
+    if settings.ingestion_queue_path:
+        # resumes the ingestion jobs queued before the last shutdown
+        get_registry().jobs
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    await get_registry().aclose()
 
 
 @app.get("/info")
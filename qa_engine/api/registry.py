@@ -0,0 +1,193 @@
+import threading
+import time
+from functools import lru_cache
+from typing import List, Optional, Tuple
+from elasticsearch import Elasticsearch, AsyncElasticsearch
+from qa_engine.api.config import get_settings, Settings
+from qa_engine.core.document_factory import ESDocumentFactory
+from qa_engine.core.embedding_factory import ESEmbeddingFactory
+from qa_engine.core.caching_strategy import JSONChunkingCachingStrategy
+from qa_engine.core.embedding_operator import OpenAIEmbeddingOperator, CachedEmbeddingOperator
+from qa_engine.core.document_operator import BasicDocumentOperator
+from qa_engine.core.answer_strategy import OpenAIAnswerStrategy
+from qa_engine.core.ir_system import IRSystem, RemovalTasks
+from qa_engine.core.result_cache import ResultCache, QueryEmbeddingCache
+from qa_engine.core.hybrid_retrieval import HybridRetrieval
+from qa_engine.api.jobs import IngestionJobs
+import asyncio
+
+
+class IRSystemRegistry:
+    """
+    Process-wide cache of configured IRSystems keyed on (index_name, text_keys, id_key).
+    All entries share one pooled Elasticsearch client (and its async counterpart), one embedding
+    operator, one answer strategy, one result cache, one query embedding cache and the running removal tasks.
+    Index existence is only checked the first time an index is seen and entries that were not used for `idle_ttl`
+    seconds are evicted.
+    """
+
+    def __init__(self, config: Settings, idle_ttl=900):
+        self.config = config
+        self.idle_ttl = idle_ttl
+        self._entries = {}
+        # key -> lock held while its IRSystem is built, so it is built once without blocking the other keys
+        self._building = {}
+        self._known_indices = set()
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self._es_client = None
+        self._async_es_client = None
+        self._embedding_operator = None
+        self._answer_strategy = None
+        self._jobs = None
+        self.result_cache = None
+        if config.result_cache_size > 0 and config.result_cache_ttl > 0:
+            self.result_cache = ResultCache(config.result_cache_size, config.result_cache_ttl)
+        self.query_embedding_cache = None
+        if config.query_embedding_cache_size > 0:
+            self.query_embedding_cache = QueryEmbeddingCache(config.query_embedding_cache_size,
+                                                             config.query_embedding_cache_path)
+        self.removal_tasks = RemovalTasks()
+        self.hybrid_retrieval = None
+        if config.hybrid_retrieval:
+            self.hybrid_retrieval = HybridRetrieval(lexical_weight=config.hybrid_lexical_weight,
+                                                    vector_weight=config.hybrid_vector_weight,
+                                                    prefilter_size=config.hybrid_prefilter_size)
+
+    @property
+    def es_client_params(self) -> dict:
+        return {
+            "cloud_id": self.config.es_cloud_id,
+            "http_auth": (self.config.es_username, self.config.es_password),
+            "connections_per_node": self.config.es_connections_per_node,
+        }
+
+    @property
+    def es_client(self) -> Elasticsearch:
+        with self._lock:
+            if self._es_client is None:
+                self._es_client = Elasticsearch(**self.es_client_params)
+            return self._es_client
+
+    @property
+    def async_es_client(self) -> AsyncElasticsearch:
+        with self._lock:
+            if self._async_es_client is None:
+                self._async_es_client = AsyncElasticsearch(**self.es_client_params)
+            return self._async_es_client
+
+    @property
+    def embedding_operator(self):
+        with self._lock:
+            if self._embedding_operator is None:
+                operator = OpenAIEmbeddingOperator("text-embedding-ada-002", self.config.openai_key,
+                                                   self.config.openai_org)
+                if self.config.embedding_cache_path:
+                    operator = CachedEmbeddingOperator(operator, self.config.embedding_cache_path,
+                                                       max_entries=self.config.embedding_cache_size)
+                self._embedding_operator = operator
+            return self._embedding_operator
+
+    @property
+    def answer_strategy(self):
+        with self._lock:
+            if self._answer_strategy is None:
+                self._answer_strategy = OpenAIAnswerStrategy("gpt-3.5-turbo-16k", self.config.openai_key,
+                                                             self.config.openai_org, top_k=1)
+            return self._answer_strategy
+
+    @property
+    def jobs(self) -> IngestionJobs:
+        with self._lock:
+            if self._jobs is None:
+                self._jobs = IngestionJobs(self.get, self.config.ingestion_queue_path,
+                                           max_workers=self.config.ingestion_workers,
+                                           max_queued=self.config.ingestion_max_queued,
+                                           batch_size=self.config.ingestion_batch_size,
+                                           bulk_load=self.config.ingestion_bulk_load,
+                                           force_merge_segments=self.config.ingestion_force_merge_segments)
+            return self._jobs
+
+    def _build(self, index_name: str, text_keys: List[str], id_key: str) -> IRSystem:
+        docs_index, embs_index, objs_index = index_name + "$docs", index_name + "$embs", index_name + "$objs"
+        # every index is routed (or not) the same way, see qa_engine.utils.es_index.migrate_to_routing
+        routing = {"routing": self.config.es_routing, "number_of_shards": self.config.es_number_of_shards}
+        with self._lock:
+            missing = {index for index in (docs_index, embs_index, objs_index) if index not in self._known_indices}
+        json_strategy = JSONChunkingCachingStrategy(
+            document_factory=ESDocumentFactory(self.es_client_params, docs_index, es_client=self.es_client,
+                                               async_es_client=self.async_es_client,
+                                               ensure_index=docs_index in missing, **routing),
+            embedding_factory=ESEmbeddingFactory(self.es_client_params, embs_index, embedding_size=1536,
+                                                 es_client=self.es_client, async_es_client=self.async_es_client,
+                                                 ensure_index=embs_index in missing, **routing),
+            embedding_operator=self.embedding_operator,
+            document_operator=BasicDocumentOperator(),
+            text_keys=text_keys,
+            id_key=id_key,
+            query_embedding_cache=self.query_embedding_cache,
+            object_factory=ESDocumentFactory(self.es_client_params, objs_index, es_client=self.es_client,
+                                             async_es_client=self.async_es_client, index_metadata=False,
+                                             ensure_index=objs_index in missing, **routing),
+            hybrid_retrieval=self.hybrid_retrieval,
+        )
+        with self._lock:
+            self._known_indices.update(missing)
+        return IRSystem(caching_strategy=json_strategy, answer_strategy=self.answer_strategy,
+                        result_cache=self.result_cache, cache_namespace=index_name, removal_tasks=self.removal_tasks)
+
+    def _key(self, index_name: str, text_keys: List[str], id_key: str) -> Tuple:
+        return index_name, tuple(text_keys), id_key
+
+    def get(self, index_name: str, text_keys=["description"], id_key="id") -> IRSystem:
+        key = self._key(index_name, text_keys, id_key)
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep > self.idle_ttl:
+                self._evict_idle(now)
+            ir_system = self._touch(key, now)
+            if ir_system is not None:
+                return ir_system
+            building = self._building.setdefault(key, threading.Lock())
+        # building checks the indices on the cluster, only the callers of the same key wait for it
+        with building:
+            with self._lock:
+                ir_system = self._touch(key, now)
+            if ir_system is None:
+                ir_system = self._build(index_name, list(text_keys), id_key)
+                with self._lock:
+                    self._entries[key] = [ir_system, now]
+                    self._building.pop(key, None)
+            return ir_system
+
+    def _touch(self, key: Tuple, now: float) -> Optional[IRSystem]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        entry[1] = now
+        return entry[0]
+
+    def _evict_idle(self, now: float):
+        self._last_sweep = now
+        for key in [key for key, (_, last_used) in self._entries.items() if now - last_used > self.idle_ttl]:
+            del self._entries[key]
+
+    async def aclose(self):
+        if self._jobs is not None:
+            await asyncio.to_thread(self._jobs.close)
+        if self.query_embedding_cache is not None and self.query_embedding_cache.path:
+            self.query_embedding_cache.save()
+        with self._lock:
+            es_client, async_es_client = self._es_client, self._async_es_client
+            self._es_client = self._async_es_client = None
+            self._entries = {}
+        if async_es_client is not None:
+            await async_es_client.close()
+        if es_client is not None:
+            await asyncio.to_thread(es_client.close)
+
+
+@lru_cache()
+def get_registry() -> IRSystemRegistry:
+    config = get_settings()
+    return IRSystemRegistry(config, idle_ttl=config.ir_system_idle_ttl)
@@ -1,16 +1,14 @@
 from typing import List, Dict, Any
-from fastapi import APIRouter, Depends
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse, JSONResponse
 from qa_engine.api.config import get_settings, Settings
-from qa_engine.core.document_factory import ESDocumentFactory
-from qa_engine.core.embedding_factory import ESEmbeddingFactory
-from qa_engine.core.caching_strategy import JSONChunkingCachingStrategy
-from qa_engine.core.embedding_operator import OpenAIEmbeddingOperator
-from qa_engine.core.document_operator import BasicDocumentOperator
-from qa_engine.core.answer_strategy import OpenAIAnswerStrategy
-from qa_engine.core.ir_system import IRSystem
+from qa_engine.api.registry import get_registry
+from qa_engine.api.jobs import QueueFull
 from qa_engine.core.models import Document
 from pydantic import BaseModel
-from qa_engine.api.utils import create_response
+from qa_engine.api.utils import create_response, sse_event
+from qa_engine.utils.ndjson import aiter_ndjson, aiter_batches
 
 settings = get_settings()
 
@@ -27,43 +25,179 @@ class IndexDocumentsRequest(BaseModel):
     embedding_provider = "openai"
     text_keys: List[str]
     id_key: str
+    # documents hold the whole association, objects missing from it are removed
+    sync: bool = False
+
+
+class BatchSearchQuery(BaseModel):
+    association_id: str
+    q: str
+    filters: Dict = None
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[BatchSearchQuery]
+    formulate_answer: bool = True
 
 
 def configure_ir_system(index_name: str, config: Settings, text_keys=["description"], id_key="id"):
-    es_client_params = {
-        "cloud_id": config.es_cloud_id,
-        "http_auth": (config.es_username, config.es_password),
-    }
-    json_strategy = JSONChunkingCachingStrategy(
-        document_factory=ESDocumentFactory(es_client_params, index_name+"$docs"),
-        embedding_factory=ESEmbeddingFactory(es_client_params, index_name+"$embs", embedding_size=1536),
-        embedding_operator=OpenAIEmbeddingOperator("text-embedding-ada-002", config.openai_key, config.openai_org),
-        document_operator=BasicDocumentOperator(),
-        text_keys=text_keys,
-        id_key=id_key,
-    )
-    answer_strategy = OpenAIAnswerStrategy("gpt-3.5-turbo-16k", config.openai_key, config.openai_org, top_k=1)
-    ir_system = IRSystem(caching_strategy=json_strategy, answer_strategy=answer_strategy)
-    return ir_system
+    """
+    Returns the shared IRSystem of the process-wide registry for the given configuration. Building it checks
+    the indices on the cluster, async endpoints call it with asyncio.to_thread.
+    """
+    return get_registry().get(index_name, text_keys, id_key)
 
 
 @router.put("/index/{index_name}/json")
 def index_documents(
         request: IndexDocumentsRequest,
         index_name: str,
+        background: bool = False,
         config: Settings = Depends(get_settings)):
+    if background:
+        try:
+            job = get_registry().jobs.submit(index_name, request.text_keys, request.id_key, request.association_id,
+                                             request.documents, sync=request.sync)
+        except QueueFull as e:
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "30"})
+        return JSONResponse(status_code=202, content=create_response(f"Queued ingestion job {job['id']}", job))
     ir_system = configure_ir_system(index_name, config, request.text_keys, request.id_key)
-    ir_system.index_document(Document(request.association_id, data=request.documents))
+    ir_system.index_document(Document(request.association_id, data=request.documents), sync=request.sync)
     return create_response(f"Indexed {len(request.documents)} documents in {index_name}")
 
 
+@router.put("/index/{index_name}/ndjson")
+async def stream_index_documents(
+        request: Request,
+        index_name: str,
+        association_id: str,
+        text_keys: List[str] = Query(["description"]),
+        id_key: str = "id",
+        batch_size: int = 500,
+        config: Settings = Depends(get_settings)):
+    """
+    Indexes a newline-delimited json body (one object per line) while it is uploaded: objects are parsed as
+    they arrive and indexed `batch_size` at a time, one batch being indexed while the next one is received.
+    """
+    ir_system = await asyncio.to_thread(configure_ir_system, index_name, config, text_keys, id_key)
+    batches = aiter_batches(aiter_ndjson(request.stream()), batch_size)
+    indexed = 0
+    pending = None
+    while True:
+        try:
+            batch = await batches.__anext__()
+        except StopAsyncIteration:
+            break
+        except ValueError as e:
+            if pending is not None:
+                indexed += await pending
+            raise HTTPException(status_code=400, detail=f"{e}, {indexed} objects before it were indexed")
+        if pending is not None:
+            indexed += await pending
+        pending = asyncio.ensure_future(index_batch(ir_system, association_id, batch))
+    if pending is not None:
+        indexed += await pending
+    return create_response(f"Indexed {indexed} documents in {index_name}")
+
+
+async def index_batch(ir_system, association_id: str, batch: list) -> int:
+    await asyncio.to_thread(ir_system.index_document, Document(association_id, data=batch))
+    return len(batch)
+
+
+@router.delete("/index/{index_name}/json")
+def remove_documents(
+        index_name: str,
+        association_id: str,
+        obj_ids: List[str] = Query(None),
+        config: Settings = Depends(get_settings)):
+    """
+    Removes the objects `obj_ids` of the association, or all of it without them. The removal runs as background
+    tasks of the cluster, their ids are returned and can be polled on /index/{index_name}/tasks/{task_id}.
+    """
+    ir_system = configure_ir_system(index_name, config)
+    tasks = ir_system.remove_objects(association_id, obj_ids)
+    target = f"{len(obj_ids)} objects" if obj_ids else "every object"
+    if tasks:
+        return JSONResponse(status_code=202,
+                            content=create_response(f"Removing {target} of {association_id}", {"tasks": tasks}))
+    return create_response(f"Removed {target} of {association_id}", {"tasks": tasks})
+
+
+@router.get("/index/{index_name}/tasks/{task_id}")
+def get_removal_task(index_name: str, task_id: str, config: Settings = Depends(get_settings)):
+    status = configure_ir_system(index_name, config).removal_status(task_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Unknown task {task_id}")
+    return create_response(f"Task {task_id} is {'completed' if status['completed'] else 'running'}", status)
+
+
 @router.get("/index/{index_name}/json")
-def search_documents(
+async def search_documents(
         index_name: str,
         q: str,
         association_id: str,
         formulate_answer: bool = True,
         filters: Dict=None,
+        stream: bool = False,
         config: Settings = Depends(get_settings)) -> dict:
-    ir_system = configure_ir_system(index_name, config)
-    return ir_system.find(association_id, q, filters, formulate_answer=formulate_answer)
+    ir_system = await asyncio.to_thread(configure_ir_system, index_name, config)
+    if stream:
+        return StreamingResponse(
+            stream_search_events(ir_system, association_id, q, filters, formulate_answer),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    return await ir_system.afind(association_id, q, filters, formulate_answer=formulate_answer)
+
+
+@router.post("/index/{index_name}/json/search")
+async def batch_search_documents(
+        index_name: str,
+        request: BatchSearchRequest,
+        config: Settings = Depends(get_settings)) -> dict:
+    """
+    Runs many queries at once, their embeddings are requested in one call and the index searched in one request.
+    """
+    if len(request.queries) > config.batch_search_max_queries:
+        raise HTTPException(status_code=422,
+                            detail=f"At most {config.batch_search_max_queries} queries are allowed per request")
+    ir_system = await asyncio.to_thread(configure_ir_system, index_name, config)
+    queries = [(query.association_id, query.q, query.filters) for query in request.queries]
+    return {"results": await ir_system.afind_many(queries, formulate_answer=request.formulate_answer)}
+
+
+async def stream_search_events(ir_system, association_id: str, q: str, filters: Dict, formulate_answer: bool):
+    try:
+        async for event, payload in ir_system.astream_find(association_id, q, filters,
+                                                           formulate_answer=formulate_answer):
+            yield sse_event(event, payload)
+    except Exception as e:
+        yield sse_event("error", {"message": str(e)})
+
+
+@router.get("/jobs")
+def list_jobs(limit: int = 50):
+    return create_response("Ingestion jobs", get_registry().jobs.list(limit))
+
+
+@router.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = get_registry().jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown ingestion job {job_id}")
+    return create_response(f"Ingestion job {job_id} is {job['status']}", job)
+
+
+@router.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    job = get_registry().jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown ingestion job {job_id}")
+    return create_response(f"Cancelled ingestion job {job_id}", job)
+
+
+@router.get("/cache/stats")
+def result_cache_stats():
+    result_cache = get_registry().result_cache
+    return create_response("Result cache statistics", result_cache.stats() if result_cache else None)
@@ -1,7 +1,9 @@
+import json
 import string
 import random
 from datetime import datetime, timedelta, timezone
 import pytz
+from fastapi.encoders import jsonable_encoder
 from qa_engine.api.config import get_settings
 
 settings = get_settings()
@@ -16,6 +18,10 @@ def create_response(message="success", payload=None):
     }
 
 
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+
 def random_string(length):
     letters = string.ascii_lowercase
     return ''.join(random.choice(letters) for i in range(length))
@@ -2,8 +2,10 @@ import os
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"  # Something for tokenizers library, must be here
 
+import asyncio
 from abc import ABC, abstractmethod
 from qa_engine.core.models import TextEntry
+from qa_engine.utils.stages import stage
 # from transformers import pipeline
 import openai
 
@@ -17,6 +19,20 @@ class AnswerStrategy(ABC):
     def formulate_answer(self, query: str, entries: [TextEntry], *args, **kwargs) -> str:
         pass
 
+    async def aformulate_answer(self, query: str, entries: [TextEntry], *args, **kwargs) -> str:
+        """
+        Asynchronous formulate_answer, strategies with a native async client override it, the others
+        are run in a worker thread.
+        """
+        return await asyncio.to_thread(self.formulate_answer, query, entries, *args, **kwargs)
+
+    async def astream_answer(self, query: str, entries: [TextEntry], *args, **kwargs):
+        """
+        Yields the answer in pieces as they are produced, strategies that cannot stream yield the
+        whole answer at once.
+        """
+        yield await self.aformulate_answer(query, entries, *args, **kwargs)
+
 
 class OpenAIAnswerStrategy(AnswerStrategy):
 
@@ -26,8 +42,8 @@ class OpenAIAnswerStrategy(AnswerStrategy):
         openai.api_key = openai_key
         openai.organization = organization
 
-    def openai_completion(self, text: str) -> str:
-        response = openai.Completion.create(
+    def _completion_params(self, text: str) -> dict:
+        return dict(
             engine=self.model_name,
             prompt=text,
             temperature=0.5,
@@ -36,12 +52,9 @@ class OpenAIAnswerStrategy(AnswerStrategy):
             frequency_penalty=0,
             presence_penalty=0
         )
-        openai_response = response.choices[0].text.strip()
-
-        return openai_response
 
-    def openai_chat_completion(self, text: str) -> str:
-        response = openai.ChatCompletion.create(
+    def _chat_completion_params(self, text: str) -> dict:
+        return dict(
             model=self.model_name,
             temperature=0.5,
             max_tokens=8192,
@@ -52,10 +65,31 @@ class OpenAIAnswerStrategy(AnswerStrategy):
                 {"role": "system", "content": text},
             ]
         )
+
+    def openai_completion(self, text: str) -> str:
+        with stage("openai_completion"):
+            response = openai.Completion.create(**self._completion_params(text))
+        openai_response = response.choices[0].text.strip()
+
+        return openai_response
+
+    def openai_chat_completion(self, text: str) -> str:
+        with stage("openai_completion"):
+            response = openai.ChatCompletion.create(**self._chat_completion_params(text))
         openai_response = response['choices'][0]['message']['content'].strip()
         return openai_response
 
-    def formulate_answer(self, query: str, entries: [TextEntry], *args, **kwargs) -> str:
+    async def aopenai_completion(self, text: str) -> str:
+        with stage("openai_completion"):
+            response = await openai.Completion.acreate(**self._completion_params(text))
+        return response.choices[0].text.strip()
+
+    async def aopenai_chat_completion(self, text: str) -> str:
+        with stage("openai_completion"):
+            response = await openai.ChatCompletion.acreate(**self._chat_completion_params(text))
+        return response['choices'][0]['message']['content'].strip()
+
+    def _prompt(self, query: str, entries: [TextEntry]) -> str:
         es = entries[:self.top_k]
         lines = [
             "Result/Evidence from Google Search:",
@@ -64,13 +98,35 @@ class OpenAIAnswerStrategy(AnswerStrategy):
             "Answer (translated in same lang) only use evidence to provide the answer (1 liner sentence): "
         ]
         # print(f"Lines: {lines}")
+        return "\n".join(lines)
+
+    def formulate_answer(self, query: str, entries: [TextEntry], *args, **kwargs) -> str:
         if self.model_name.startswith("text"):
-            response = self.openai_completion("\n".join(lines))
+            response = self.openai_completion(self._prompt(query, entries))
         else:
-            response = self.openai_chat_completion("\n".join(lines))
+            response = self.openai_chat_completion(self._prompt(query, entries))
 
         return response
 
+    async def aformulate_answer(self, query: str, entries: [TextEntry], *args, **kwargs) -> str:
+        if self.model_name.startswith("text"):
+            return await self.aopenai_completion(self._prompt(query, entries))
+        return await self.aopenai_chat_completion(self._prompt(query, entries))
+
+    async def astream_answer(self, query: str, entries: [TextEntry], *args, **kwargs):
+        if self.model_name.startswith("text"):
+            chunks = await openai.Completion.acreate(
+                stream=True, **self._completion_params(self._prompt(query, entries)))
+            async for chunk in chunks:
+                if chunk["choices"] and chunk["choices"][0].get("text"):
+                    yield chunk["choices"][0]["text"]
+        else:
+            chunks = await openai.ChatCompletion.acreate(
+                stream=True, **self._chat_completion_params(self._prompt(query, entries)))
+            async for chunk in chunks:
+                if chunk["choices"] and chunk["choices"][0]["delta"].get("content"):
+                    yield chunk["choices"][0]["delta"]["content"]
+
 
 # class SentenceTransformerAnswerStrategy(AnswerStrategy):
 #
@@ -1,12 +1,20 @@
 from abc import ABC, abstractmethod
+from contextlib import ExitStack, contextmanager
 from qa_engine.core.models import TextEntry, EmbeddingEntry, Document
 from qa_engine.core.embedding_operator import EmbeddingOperator
 from qa_engine.core.embedding_factory import EmbeddingFactory
-from qa_engine.core.document_factory import DocumentFactory, generate_id
+from qa_engine.core.document_factory import DocumentFactory, generate_id, content_id
 from qa_engine.core.document_operator import DocumentOperator
-from typing import List
+from qa_engine.core.result_cache import QueryEmbeddingCache
+from qa_engine.core.hybrid_retrieval import HybridRetrieval
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import math
 import pandas as pd
-from qa_engine.utils.chunk import chunk_corpus
+from qa_engine.utils.chunk import iter_passages
+from qa_engine.utils.stages import stage
 
 
 class CachingStrategy(ABC):
@@ -19,60 +27,272 @@ class CachingStrategy(ABC):
         - Utilises the operators to parse the documents and embed the text.
         - finding relevant documents given a query in accordance with the way the entries returning the list of ids.
 
+    :parameter query_embedding_cache: Optional LRU of query embeddings, shared between strategies using the same
+        embedding model.
+    :parameter hybrid_retrieval: If set, find fuses the vector search with a lexical search of the document
+        factory and can narrow the vector search down to the lexical candidates.
     """
 
     def __init__(self,
                  embedding_factory: EmbeddingFactory,
                  document_factory: DocumentFactory,
                  embedding_operator: EmbeddingOperator,
-                 document_operator: DocumentOperator):
+                 document_operator: DocumentOperator,
+                 query_embedding_cache: QueryEmbeddingCache = None,
+                 hybrid_retrieval: HybridRetrieval = None):
         self.embedding_factory = embedding_factory
         self.document_factory = document_factory
         self.embedding_operator = embedding_operator
         self.document_operator = document_operator
+        self.query_embedding_cache = query_embedding_cache
+        self.hybrid_retrieval = hybrid_retrieval
+
+    @property
+    def embedding_model(self) -> str:
+        return getattr(self.embedding_operator, "model_name", type(self.embedding_operator).__name__)
 
     """
     Takes in and parses a document and indexes it
     """
 
-    def cache(self, document: Document):
+    def cache(self, document: Document, *args, **kwargs):
         # Parse the document
         parsed_obj = self.document_operator.parse(document)
         text_entries = self._parsed_obj_to_entries(parsed_obj)
-        embedding_entries = self._text2embedding_entries(text_entries)
+        self._cache_entries(document.id, text_entries)
+
+    def _cache_entries(self, doc_id, text_entries: List[TextEntry]):
+        with stage("embed", len(text_entries)):
+            embedding_entries = self._text2embedding_entries(text_entries)
         # Store them
-        self._store_text(document.id, text_entries)
-        self._store_embeddings(document.id, embedding_entries)
+        with stage("store", len(text_entries)):
+            self._store_text(doc_id, text_entries)
+            self._store_embeddings(doc_id, embedding_entries)
+
+    def _embed_query(self, query: str) -> List[float]:
+        if self.query_embedding_cache is not None:
+            query_embedding = self.query_embedding_cache.get(self.embedding_model, query)
+            if query_embedding is not None:
+                return query_embedding
+        with stage("query_embedding"):
+            query_embedding = \
+                self.embedding_operator.embed([TextEntry(generate_id(), text=query, metadata={})])[
+                    0].embedding
+        if self.query_embedding_cache is not None:
+            self.query_embedding_cache.put(self.embedding_model, query, query_embedding)
+        return query_embedding
+
+    async def _aembed_query(self, query: str) -> List[float]:
+        if self.query_embedding_cache is not None:
+            query_embedding = self.query_embedding_cache.get(self.embedding_model, query)
+            if query_embedding is not None:
+                return query_embedding
+        with stage("query_embedding"):
+            query_embedding = \
+                (await self.embedding_operator.aembed([TextEntry(generate_id(), text=query, metadata={})]))[
+                    0].embedding
+        if self.query_embedding_cache is not None:
+            self.query_embedding_cache.put(self.embedding_model, query, query_embedding)
+        return query_embedding
+
+    def _embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """
+        Embeds the queries missing from the query embedding cache in a single embedding call.
+        """
+        embeddings = [None] * len(queries)
+        missing = {}
+        for i, query in enumerate(queries):
+            if self.query_embedding_cache is not None:
+                embeddings[i] = self.query_embedding_cache.get(self.embedding_model, query)
+            if embeddings[i] is None:
+                missing.setdefault(query, []).append(i)
+        if missing:
+            with stage("query_embedding", len(missing)):
+                embedded = self.embedding_operator.embed(
+                    [TextEntry(generate_id(), text=query, metadata={}) for query in missing])
+            for (query, positions), entry in zip(missing.items(), embedded):
+                if self.query_embedding_cache is not None:
+                    self.query_embedding_cache.put(self.embedding_model, query, entry.embedding)
+                for i in positions:
+                    embeddings[i] = entry.embedding
+        return embeddings
+
+    def find_many(self, queries: List[Tuple[str, str, Optional[dict]]]) -> List[List[TextEntry]]:
+        """
+        Batch variant of find for (doc_id, query, metadata) tuples: the queries are embedded in one call,
+        retrieved with one retrieve_many and the texts that are not co-located with the vectors fetched with
+        one get_by_ids_many.
+        """
+        if self.hybrid_retrieval is not None:
+            return [self._hybrid_find(doc_id, query, metadata) for doc_id, query, metadata in queries]
+        embeddings = self._embed_queries([query for _, query, _ in queries])
+        with stage("vector_search", len(queries)):
+            results = self.embedding_factory.retrieve_many([
+                (doc_id, embedding, metadata) for (doc_id, _, metadata), embedding in zip(queries, embeddings)])
+        colocated = [self._colocated_text_entries(entries) for entries in results]
+        requests = [(doc_id, missing_ids)
+                    for (doc_id, _, _), (_, missing_ids) in zip(queries, colocated) if missing_ids]
+        if requests:
+            with stage("text_fetch", sum(len(missing_ids) for _, missing_ids in requests)):
+                fetched = iter(self.document_factory.get_by_ids_many(requests))
+                for text_entries, missing_ids in colocated:
+                    if missing_ids:
+                        for text_entry in next(fetched):
+                            text_entries[text_entry.id] = text_entry
+        return [
+            self._rank_text_entries(entries, [text_entries[e.id] for e in entries if e.id in text_entries])
+            for entries, (text_entries, _) in zip(results, colocated)
+        ]
 
     def find(self, doc_id: str, query: str, metadata=None):
-        query_embedding = \
-            self.embedding_operator.embed([TextEntry(generate_id(), text=query, metadata={})])[
-                0].embedding
-        entries = self.embedding_factory.retrieve(doc_id, query_embedding, metadata)
+        if self.hybrid_retrieval is not None:
+            return self._hybrid_find(doc_id, query, metadata)
+        query_embedding = self._embed_query(query)
+        with stage("vector_search"):
+            entries = self.embedding_factory.retrieve(doc_id, query_embedding, metadata)
+        text_entries = self._embedding2text_entries(doc_id, entries)
+        return self._rank_text_entries(entries, text_entries)
+
+    async def afind(self, doc_id: str, query: str, metadata=None):
+        if self.hybrid_retrieval is not None:
+            return await self._ahybrid_find(doc_id, query, metadata)
+        query_embedding = await self._aembed_query(query)
+        with stage("vector_search"):
+            entries = await self.embedding_factory.aretrieve(doc_id, query_embedding, metadata)
+        text_entries = await self._aembedding2text_entries(doc_id, entries)
+        return self._rank_text_entries(entries, text_entries)
+
+    def _hybrid_find(self, doc_id: str, query: str, metadata=None) -> List[TextEntry]:
+        with stage("lexical_search"):
+            lexical_entries = self.document_factory.search_text(doc_id, query, metadata,
+                                                                size=self.hybrid_retrieval.lexical_request_size)
+        query_embedding = self._embed_query(query)
+        with stage("vector_search"):
+            entries = self.embedding_factory.retrieve(doc_id, query_embedding, metadata,
+                                                      entry_ids=self.hybrid_retrieval.prefilter_ids(lexical_entries))
+        text_entries = self._rank_text_entries(entries, self._embedding2text_entries(doc_id, entries))
+        return self.hybrid_retrieval.fuse(text_entries, lexical_entries)
+
+    async def _ahybrid_find(self, doc_id: str, query: str, metadata=None) -> List[TextEntry]:
+        # the lexical search and the query embedding do not depend on each other
+        lexical_entries, query_embedding = await asyncio.gather(
+            self._alexical_search(doc_id, query, metadata),
+            self._aembed_query(query),
+        )
+        with stage("vector_search"):
+            entries = await self.embedding_factory.aretrieve(
+                doc_id, query_embedding, metadata, entry_ids=self.hybrid_retrieval.prefilter_ids(lexical_entries))
+        text_entries = self._rank_text_entries(entries, await self._aembedding2text_entries(doc_id, entries))
+        return self.hybrid_retrieval.fuse(text_entries, lexical_entries)
+
+    async def _alexical_search(self, doc_id: str, query: str, metadata=None) -> List[TextEntry]:
+        with stage("lexical_search"):
+            return await self.document_factory.asearch_text(doc_id, query, metadata,
+                                                            size=self.hybrid_retrieval.lexical_request_size)
+
+    @staticmethod
+    def _rank_text_entries(embedding_entries: List[EmbeddingEntry], text_entries: List[TextEntry]) -> List[
+        TextEntry]:
         id2metadata = {}
-        for e in entries:
+        for e in embedding_entries:
             id2metadata[e.id] = e.metadata
-        text_entries = self._embedding2text_entries(doc_id, entries)
         for text_entry in text_entries:
             text_entry.metadata["__rank"] = id2metadata[text_entry.id]["__rank"]
         return text_entries
 
     def remove_by_ids(self, doc_id: str, entry_ids: List[str], *args, **kwargs) -> bool:
-        self.embedding_factory.remove_by_ids(doc_id, entry_ids, *args, **kwargs)
-        return self.document_factory.remove_by_ids(doc_id, entry_ids, *args, **kwargs)
+        with stage("remove", len(entry_ids)):
+            self.embedding_factory.remove_by_ids(doc_id, entry_ids, *args, **kwargs)
+            return self.document_factory.remove_by_ids(doc_id, entry_ids, *args, **kwargs)
+
+    def _factories(self) -> Dict[str, object]:
+        return {"embedding_factory": self.embedding_factory, "document_factory": self.document_factory}
+
+    def remove_objects(self, doc_id: str, obj_ids: List[str] = None) -> Dict[str, str]:
+        """
+        Removes the entries of the source objects `obj_ids` (matched on their obj_id metadata), or every
+        entry of the association when None, without the caller knowing the entry ids.
+        Returns the ids of the removal tasks still running in the background by factory, see removal_status.
+        """
+        tasks = {}
+        with stage("remove_objects", len(obj_ids) if obj_ids is not None else 1):
+            for name, factory in self._factories().items():
+                task_id = self._remove_objects_from(name, factory, doc_id, obj_ids)
+                if task_id is not None:
+                    tasks[name] = task_id
+        return tasks
+
+    def _remove_objects_from(self, name: str, factory, doc_id: str, obj_ids: Optional[List[str]]) -> Optional[str]:
+        """
+        Removes the entries of the objects from one of the factories, returns the id of the removal task if any.
+        """
+        metadata = None if obj_ids is None else {"obj_id": [str(obj_id) for obj_id in obj_ids]}
+        return factory.remove_where(doc_id, metadata)
+
+    @contextmanager
+    def bulk_load(self, force_merge_segments: int = None):
+        """
+        Tunes every factory for a large ingestion done in the block, e.g. by disabling index refreshes, and
+        restores them at the end. The embedding factory is then optionally force-merged.
+        """
+        with ExitStack() as stack:
+            for name, factory in self._factories().items():
+                stack.enter_context(factory.bulk_load(force_merge_segments if name == "embedding_factory" else None))
+            yield
+
+    def restore_bulk_load(self) -> bool:
+        """
+        Undoes the tuning of an interrupted bulk load in every factory, returns whether there was one.
+        """
+        restored = False
+        for factory in self._factories().values():
+            restored = factory.restore_bulk_load() or restored
+        return restored
+
+    def removal_status(self, task_id: str) -> Optional[dict]:
+        for factory in self._factories().values():
+            status = factory.removal_status(task_id)
+            if status is not None:
+                return status
+        return None
 
     @abstractmethod
     def _parsed_obj_to_entries(self, parsed_obj) -> List[TextEntry]:
         pass
 
     def _text2embedding_entries(self, text_entries: List[TextEntry]) -> List[EmbeddingEntry]:
-        return self.embedding_operator.embed(text_entries)
+        embedding_entries = self.embedding_operator.embed(text_entries)
+        # lets factories co-locate the text with the vector and answer find in a single round trip
+        for text_entry, embedding_entry in zip(text_entries, embedding_entries):
+            embedding_entry.text = text_entry.text
+        return embedding_entries
+
+    @staticmethod
+    def _colocated_text_entries(embedding_entries: List[EmbeddingEntry]):
+        text_entries = {
+            e.id: TextEntry(id=e.id, text=e.text, metadata=dict(e.metadata))
+            for e in embedding_entries if e.text is not None
+        }
+        missing_ids = [e.id for e in embedding_entries if e.text is None]
+        return text_entries, missing_ids
 
     def _embedding2text_entries(self, doc_id, embedding_entries: List[EmbeddingEntry]) -> List[
         TextEntry]:
-        ids = [embedding_entry.id for embedding_entry in embedding_entries]
-        text_entries = self.document_factory.retrieve(doc_id, ids)
-        return text_entries
+        text_entries, missing_ids = self._colocated_text_entries(embedding_entries)
+        if missing_ids:
+            with stage("text_fetch", len(missing_ids)):
+                for text_entry in self.document_factory.get_by_ids(doc_id, missing_ids):
+                    text_entries[text_entry.id] = text_entry
+        return [text_entries[e.id] for e in embedding_entries if e.id in text_entries]
+
+    async def _aembedding2text_entries(self, doc_id, embedding_entries: List[EmbeddingEntry]) -> List[
+        TextEntry]:
+        text_entries, missing_ids = self._colocated_text_entries(embedding_entries)
+        if missing_ids:
+            with stage("text_fetch", len(missing_ids)):
+                for text_entry in await self.document_factory.aget_by_ids(doc_id, missing_ids):
+                    text_entries[text_entry.id] = text_entry
+        return [text_entries[e.id] for e in embedding_entries if e.id in text_entries]
 
     def _store_embeddings(self, doc_id, entries: List[EmbeddingEntry], *args, **kwargs):
         self.embedding_factory.store(doc_id, entries, *args, **kwargs)
@@ -89,8 +309,11 @@ class BasicJSONCachingStrategy(CachingStrategy):
                  embedding_operator: EmbeddingOperator,
                  document_operator: DocumentOperator,
                  text_keys: List[str],
-                 id_key: str):
-        super().__init__(embedding_factory, document_factory, embedding_operator, document_operator)
+                 id_key: str,
+                 query_embedding_cache: QueryEmbeddingCache = None,
+                 hybrid_retrieval: HybridRetrieval = None):
+        super().__init__(embedding_factory, document_factory, embedding_operator, document_operator,
+                         query_embedding_cache, hybrid_retrieval)
         self.text_keys = text_keys
         self.id_key = id_key
 
@@ -108,8 +331,13 @@ class BasicJSONCachingStrategy(CachingStrategy):
 class ChunkingCachingStrategy(CachingStrategy):
     """
     Caching strategy that chunks the document into smaller chunks and caches each chunk separately.
-    :parameter chunk_size: The number of sentences per chunk.
-    :parameter sentence_word_count: The minimum and maximum word count of a sentence in the document.
+    The document is split into passages of whole sentences, each embedded as one entry, and every
+    `chunk_size` consecutive passages form a chunk.
+    :parameter chunk_size: The number of passages per chunk.
+    :parameter sentence_word_count: The minimum and maximum word count of a passage, only the maximum is
+        used (as 4/3 tokens per word) when max_tokens is not set.
+    :parameter max_tokens: The maximum (estimated) number of tokens of a passage.
+    :parameter overlap_tokens: The number of tokens of trailing sentences a passage shares with the next one.
     """
 
     def __init__(self,
@@ -118,28 +346,56 @@ class ChunkingCachingStrategy(CachingStrategy):
                  embedding_operator: EmbeddingOperator,
                  document_operator: DocumentOperator,
                  chunk_size=8,
-                 sentence_word_count=(15, 75)):
+                 sentence_word_count=(15, 75),
+                 query_embedding_cache: QueryEmbeddingCache = None,
+                 hybrid_retrieval: HybridRetrieval = None,
+                 max_tokens: int = None,
+                 overlap_tokens=0):
         super().__init__(embedding_factory, document_factory, embedding_operator,
-                         document_operator)
+                         document_operator, query_embedding_cache, hybrid_retrieval)
         self.chunk_size = chunk_size
         self.sentence_word_count = sentence_word_count
-
-    def _chunk_corpus(self, corpus: str) -> List[TextEntry]:
-        chunks = chunk_corpus(corpus, self.chunk_size, self.sentence_word_count)
-
+        self.max_tokens = max_tokens or math.ceil(sentence_word_count[1] * 4 / 3)
+        self.overlap_tokens = overlap_tokens
+
+    def _chunk_corpus(self, corpus: str, id_prefix: str = None) -> List[TextEntry]:
+        """
+        The entries hold the character offsets of their passage in the corpus as "start" and "end".
+        :parameter id_prefix: If set, chunk and entry ids are derived from it and the position of the
+            passage instead of being random, so re-chunking the same content yields the same ids.
+        """
         text_entry_chunks = []
-        for chunk in chunks:
-            chunk_id = generate_id()
-            for sentence in chunk:
-                txt_entry_id = generate_id()
-                text_entry_chunks.append(TextEntry(id=txt_entry_id, text=sentence, metadata={
-                    "chunk_id": chunk_id
-                }))
+        chunk_id = None
+        for position, passage in enumerate(iter_passages(corpus, self.max_tokens, self.overlap_tokens)):
+            i, j = divmod(position, self.chunk_size)
+            if j == 0:
+                chunk_id = content_id(id_prefix, i) if id_prefix else generate_id()
+            txt_entry_id = content_id(id_prefix, i, j, passage.text) if id_prefix else generate_id()
+            text_entry_chunks.append(TextEntry(id=txt_entry_id, text=passage.text, metadata={
+                "chunk_id": chunk_id,
+                "start": passage.start,
+                "end": passage.end,
+            }))
 
         return text_entry_chunks
 
     def find(self, doc_id: str, query: str, metadata=None):
         text_entries = super().find(doc_id, query, metadata)
+        with stage("aggregate", len(text_entries)):
+            return self._aggregate_chunks(text_entries)
+
+    async def afind(self, doc_id: str, query: str, metadata=None):
+        text_entries = await super().afind(doc_id, query, metadata)
+        with stage("aggregate", len(text_entries)):
+            return self._aggregate_chunks(text_entries)
+
+    def find_many(self, queries: List[Tuple[str, str, Optional[dict]]]) -> List[List[TextEntry]]:
+        results = super().find_many(queries)
+        with stage("aggregate", sum(len(text_entries) for text_entries in results)):
+            return [self._aggregate_chunks(text_entries) for text_entries in results]
+
+    @staticmethod
+    def _aggregate_chunks(text_entries: List[TextEntry]) -> List[TextEntry]:
         unique_chunk_ids = set([text_entry.metadata["chunk_id"] for text_entry in text_entries])
         by_chunk = {}
         for chunk_id in unique_chunk_ids:
@@ -164,6 +420,14 @@ class ChunkingCachingStrategy(CachingStrategy):
 
 
 class JSONChunkingCachingStrategy(ChunkingCachingStrategy):
+    """
+    Chunking caching strategy for lists of json objects.
+    :parameter text_keys: The keys of the objects whose text is chunked and embedded.
+    :parameter id_key: The key holding the id of an object.
+    :parameter object_factory: If set, every source object is stored once in it (as the metadata of an
+        entry with the object id) and only attached to the results of find, instead of being copied into
+        the metadata of each of its entries.
+    """
 
     def __init__(self,
                  embedding_factory: EmbeddingFactory,
@@ -173,7 +437,12 @@ class JSONChunkingCachingStrategy(ChunkingCachingStrategy):
                  text_keys: List[str],
                  id_key: str,
                  chunk_size=8,
-                 sentence_word_count=(15, 70)):
+                 sentence_word_count=(15, 70),
+                 query_embedding_cache: QueryEmbeddingCache = None,
+                 object_factory: DocumentFactory = None,
+                 hybrid_retrieval: HybridRetrieval = None,
+                 max_tokens: int = None,
+                 overlap_tokens=0):
         super().__init__(
             embedding_factory,
             document_factory,
@@ -181,43 +450,212 @@ class JSONChunkingCachingStrategy(ChunkingCachingStrategy):
             document_operator,
             chunk_size,
             sentence_word_count,
+            query_embedding_cache,
+            hybrid_retrieval,
+            max_tokens,
+            overlap_tokens,
         )
         self.text_keys = text_keys
         self.id_key = id_key
+        self.object_factory = object_factory
+
+    def fingerprint(self, obj: dict) -> str:
+        """
+        Content fingerprint of a source object and of the way it is split into entries (text keys and chunking
+        parameters), any change to them re-embeds the object. IRSystems with other text keys share the indices.
+        """
+        payload = [obj, self.text_keys, self.chunk_size, self.max_tokens, self.overlap_tokens]
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:32]
+
+    def cache(self, document: Document, sync=False, *args, **kwargs):
+        """
+        Upserts the objects of the document: unchanged objects (same fingerprint) are skipped, changed ones
+        are re-embedded and their stale entries removed.
+        :parameter sync: If True the document holds every object of the association and the entries of the
+            objects missing from it are removed.
+        """
+        json_objs = {str(json_obj[self.id_key]): json_obj for json_obj in document.data}
+        fingerprints = {obj_id: self.fingerprint(json_obj) for obj_id, json_obj in json_objs.items()}
+        with stage("fingerprint_diff", len(json_objs)):
+            existing_entries = self.document_factory.retrieve_ids(
+                document.id, metadata=None if sync else {"obj_id": list(json_objs)},
+                fields=["obj_id", "fingerprint"])
+        existing_fingerprints, existing_ids = {}, {}
+        for entry in existing_entries:
+            obj_id = entry.metadata.get("obj_id")
+            existing_fingerprints.setdefault(obj_id, set()).add(entry.metadata.get("fingerprint"))
+            existing_ids.setdefault(obj_id, []).append(entry.id)
+
+        changed_objs = [json_obj for obj_id, json_obj in json_objs.items()
+                        if existing_fingerprints.get(obj_id) != {fingerprints[obj_id]}]
+        text_entries = self._objs_to_entries(changed_objs, document.id)
+        new_ids = set(entry.id for entry in text_entries)
+        stale_ids = [entry_id for json_obj in changed_objs
+                     for entry_id in existing_ids.get(str(json_obj[self.id_key]), []) if entry_id not in new_ids]
+        removed_obj_ids = [obj_id for obj_id in existing_ids if obj_id not in json_objs] if sync else []
+        stale_ids += [entry_id for obj_id in removed_obj_ids for entry_id in existing_ids[obj_id]]
+        if stale_ids:
+            self.remove_by_ids(document.id, stale_ids)
+        if self.object_factory is not None:
+            if removed_obj_ids:
+                self.object_factory.remove_by_ids(document.id, removed_obj_ids)
+            if changed_objs:
+                self._store_objects(document.id, changed_objs)
+        if text_entries:
+            self._cache_entries(document.id, text_entries)
+
+    def _factories(self) -> Dict[str, object]:
+        factories = super()._factories()
+        if self.object_factory is not None:
+            factories["object_factory"] = self.object_factory
+        return factories
+
+    def _remove_objects_from(self, name: str, factory, doc_id: str, obj_ids: Optional[List[str]]) -> Optional[str]:
+        if name == "object_factory" and obj_ids is not None:
+            # source objects are stored under their own id
+            factory.remove_by_ids(doc_id, [str(obj_id) for obj_id in obj_ids])
+            return None
+        return super()._remove_objects_from(name, factory, doc_id, obj_ids)
+
+    def _store_objects(self, doc_id, objs: List[dict]):
+        self.object_factory.store(doc_id, [
+            TextEntry(id=str(obj[self.id_key]), text="", metadata=obj) for obj in objs
+        ])
+
+    def _attach_objects(self, text_entries: List[TextEntry], objects: List[TextEntry]) -> List[TextEntry]:
+        objects = {entry.id: entry.metadata for entry in objects}
+        for text_entry in text_entries:
+            obj = objects.get(str(text_entry.metadata.get("obj_id")))
+            if obj is not None:
+                text_entry.metadata["obj"] = obj
+        return text_entries
 
-    def cache(self, document: Document):
-        json_objs: List[dict] = document.data
-        ids = [json_obj[self.id_key] for json_obj in json_objs]
-        existing_text_entries = self.document_factory.retrieve(document.id, document_ids=None, metadata={"obj_id": ids})
-        id_black_list = []
-        for text_entry in existing_text_entries:
-            if text_entry.metadata["obj_id"] not in id_black_list:
-                id_black_list.append(text_entry.metadata["obj_id"])
-        white_objects = list(filter(lambda x: x[self.id_key] not in id_black_list, json_objs))
-        new_doc = Document(document.id, data=white_objects)
-        if not white_objects:
-            return
-        super().cache(new_doc)
+    def _result_obj_ids(self, text_entries: List[TextEntry]) -> List[str]:
+        return list(dict.fromkeys(str(e.metadata["obj_id"]) for e in text_entries if "obj_id" in e.metadata))
 
-    def _parsed_obj_to_entries(self, parsed_obj: List[dict]) -> List[TextEntry]:
+    def find(self, doc_id: str, query: str, metadata=None):
+        text_entries = super().find(doc_id, query, metadata)
+        if self.object_factory is None or not text_entries:
+            return text_entries
+        # hydrate the source objects of the final results only
+        obj_ids = self._result_obj_ids(text_entries)
+        with stage("hydrate", len(obj_ids)):
+            objects = self.object_factory.get_by_ids(doc_id, obj_ids)
+        return self._attach_objects(text_entries, objects)
+
+    async def afind(self, doc_id: str, query: str, metadata=None):
+        text_entries = await super().afind(doc_id, query, metadata)
+        if self.object_factory is None or not text_entries:
+            return text_entries
+        obj_ids = self._result_obj_ids(text_entries)
+        with stage("hydrate", len(obj_ids)):
+            objects = await self.object_factory.aget_by_ids(doc_id, obj_ids)
+        return self._attach_objects(text_entries, objects)
+
+    def find_many(self, queries: List[Tuple[str, str, Optional[dict]]]) -> List[List[TextEntry]]:
+        results = super().find_many(queries)
+        if self.object_factory is None:
+            return results
+        requests = [(doc_id, self._result_obj_ids(text_entries))
+                    for (doc_id, _, _), text_entries in zip(queries, results)]
+        with stage("hydrate", sum(len(obj_ids) for _, obj_ids in requests)):
+            objects = self.object_factory.get_by_ids_many(requests)
+        return [self._attach_objects(text_entries, objs) for text_entries, objs in zip(results, objects)]
+
+    def _objs_to_entries(self, objs: List[dict], doc_id: str = None) -> List[TextEntry]:
         text_entries = []
         # For every object in the parsed object
-        for obj in parsed_obj:
+        for obj in objs:
             obj_id = obj[self.id_key]
+            fingerprint = self.fingerprint(obj)
             # For every text key in the object
             for key in self.text_keys:
                 # Chunk the text and append the text entries
                 obj_key_text = obj[key]
-                obj_key_text_entries = self._chunk_corpus(obj_key_text)
+                id_prefix = content_id(doc_id, obj_id, key) if doc_id is not None else None
+                obj_key_text_entries = self._chunk_corpus(obj_key_text, id_prefix)
                 for text_entry in obj_key_text_entries:
-                    text_entry.metadata["obj_id"] = obj_id
+                    # stored as a string, so ES maps it as text with a .keyword whatever the type of the ids
+                    text_entry.metadata["obj_id"] = str(obj_id)
                     text_entry.metadata["key"] = key
-                    text_entry.metadata["obj"] = obj
+                    text_entry.metadata["fingerprint"] = fingerprint
+                    if self.object_factory is None:
+                        text_entry.metadata["obj"] = obj
                 text_entries += obj_key_text_entries
         return text_entries
 
+    def _parsed_obj_to_entries(self, parsed_obj: List[dict]) -> List[TextEntry]:
+        return self._objs_to_entries(parsed_obj)
+
 
 class PDFChunkingCachingStrategy(ChunkingCachingStrategy):
+    """
+    Chunking caching strategy for PDF documents. Pages are chunked one at a time, with their 1-based
+    number in the "page" metadata of the entries, and the entries are embedded and stored every
+    `batch_size` entries, so memory does not grow with the size of the document and the first pages are
+    searchable before the last ones are extracted. Entry ids derive from the content hash of the file, and
+    the entries of a previous version of the same file ("source" metadata) are removed once it is cached.
+    :parameter batch_size: The number of entries embedded and stored together.
+    """
+
+    def __init__(self,
+                 embedding_factory: EmbeddingFactory,
+                 document_factory: DocumentFactory,
+                 embedding_operator: EmbeddingOperator,
+                 document_operator: DocumentOperator,
+                 chunk_size=8,
+                 sentence_word_count=(15, 75),
+                 query_embedding_cache: QueryEmbeddingCache = None,
+                 hybrid_retrieval: HybridRetrieval = None,
+                 max_tokens: int = None,
+                 overlap_tokens=0,
+                 batch_size=256):
+        super().__init__(embedding_factory, document_factory, embedding_operator, document_operator,
+                         chunk_size, sentence_word_count, query_embedding_cache, hybrid_retrieval,
+                         max_tokens, overlap_tokens)
+        self.batch_size = batch_size
+
+    @staticmethod
+    def fingerprint(path: str) -> str:
+        """
+        Content hash of the file, so different files (or versions of a file) cached under the same doc_id
+        never share entry or chunk ids.
+        """
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()[:32]
+
+    def cache(self, document: Document, *args, **kwargs):
+        source = str(document.data)
+        fingerprint = self.fingerprint(source)
+        batch = []
+        pages = self.document_operator.iter_parse(document)
+        for page_entries in self._iter_page_entries(pages, document.id, fingerprint):
+            for text_entry in page_entries:
+                text_entry.metadata["source"] = source
+                text_entry.metadata["fingerprint"] = fingerprint
+            batch += page_entries
+            while len(batch) >= self.batch_size:
+                self._cache_entries(document.id, batch[:self.batch_size])
+                batch = batch[self.batch_size:]
+        if batch:
+            self._cache_entries(document.id, batch)
+        # pages and chunks of a previous version of the file that no longer exist
+        stale_ids = [entry.id for entry in self.document_factory.retrieve_ids(
+                         document.id, metadata={"source": [source]}, fields=["fingerprint"])
+                     if entry.metadata.get("fingerprint") != fingerprint]
+        if stale_ids:
+            self.remove_by_ids(document.id, stale_ids)
+
+    def _iter_page_entries(self, pages, doc_id: str = None, fingerprint: str = None):
+        for page_number, page in enumerate(pages, start=1):
+            id_prefix = content_id(doc_id, fingerprint, "page", page_number) if doc_id is not None else None
+            text_entries = self._chunk_corpus(page, id_prefix)
+            for text_entry in text_entries:
+                text_entry.metadata["page"] = page_number
+            yield text_entries
+
     def _parsed_obj_to_entries(self, parsed_obj: [str]) -> List[TextEntry]:
-        return self._chunk_corpus(
-            "\n ========================= PAGE END ========================= \n".join(parsed_obj))
+        return [entry for page_entries in self._iter_page_entries(parsed_obj) for entry in page_entries]
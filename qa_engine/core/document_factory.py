@@ -1,15 +1,28 @@
 from abc import ABC, abstractmethod
+from contextlib import nullcontext
 from qa_engine.core.models import TextEntry
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, AsyncElasticsearch
 from elasticsearch.helpers import bulk
+import asyncio
+import math
+import re
 import uuid
-from typing import List
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+from qa_engine.utils.es_index import bulk_load, delete_index, ensure_index, restore_bulk_load
+from qa_engine.utils.es_tasks import start_delete_by_query, task_status
 
 
 def generate_id() -> str:
     return str(uuid.uuid4())
 
 
+def content_id(*parts) -> str:
+    """
+    Deterministic id derived from the given parts, the same parts always give the same id.
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, "\x1f".join(str(part) for part in parts)))
+
+
 class DocumentFactory(ABC):
 
     @abstractmethod
@@ -27,55 +40,212 @@ class DocumentFactory(ABC):
     def remove(self, doc_id, entries: List[TextEntry], *args, **kwargs) -> bool:
         return self.remove_by_ids(doc_id, [entry.id for entry in entries], *args, **kwargs)
 
+    def remove_where(self, doc_id, metadata: dict = None, *args, **kwargs) -> Optional[str]:
+        """
+        Removes the entries of `doc_id` matching `metadata`, all of them when None. Factories backed by a
+        cluster run it as a background task and return its id (see removal_status), the others return None
+        once the entries are removed.
+        """
+        self.remove_by_ids(doc_id, [entry.id for entry in self.iter_retrieve(doc_id, metadata=metadata, fields=[])])
+        return None
+
+    def removal_status(self, task_id: str) -> Optional[dict]:
+        """
+        Progress of a removal task started by remove_where, None when the factory does not know it.
+        """
+        return None
+
+    def bulk_load(self, force_merge_segments: int = None):
+        """
+        Context manager tuning the storage for a large ingestion done in the block, a no-op by default.
+        """
+        return nullcontext()
+
+    def restore_bulk_load(self) -> bool:
+        """
+        Undoes the tuning of a bulk load that was interrupted, e.g. by a crash, returns whether there was one.
+        """
+        return False
+
+    async def aretrieve(self, doc_id, document_ids: List[str] = None, metadata: dict = None, *args,
+                        **kwargs) -> List[TextEntry]:
+        return await asyncio.to_thread(self.retrieve, doc_id, document_ids, metadata, *args, **kwargs)
+
+    def iter_retrieve(self, doc_id, document_ids: List[str] = None, metadata: dict = None, fields: List[str] = None,
+                      page_size: int = None, *args, **kwargs) -> Iterator[TextEntry]:
+        """
+        Generator variant of retrieve, factories override it to page through large associations with
+        bounded memory.
+        :parameter fields: When set, the entries have no text and only these metadata fields.
+        :parameter page_size: The number of entries fetched per request, the factory default when None.
+        """
+        for entry in self.retrieve(doc_id, document_ids, metadata):
+            if fields is None:
+                yield entry
+            else:
+                yield TextEntry(id=entry.id, text="",
+                                metadata={f: entry.metadata[f] for f in fields if f in entry.metadata})
+
+    async def aiter_retrieve(self, doc_id, document_ids: List[str] = None, metadata: dict = None,
+                             fields: List[str] = None, page_size: int = None, *args,
+                             **kwargs) -> AsyncIterator[TextEntry]:
+        entries = await asyncio.to_thread(
+            lambda: list(self.iter_retrieve(doc_id, document_ids, metadata, fields, page_size, *args, **kwargs)))
+        for entry in entries:
+            yield entry
+
+    def retrieve_ids(self, doc_id, metadata: dict = None, fields: List[str] = None, *args,
+                     **kwargs) -> List[TextEntry]:
+        """
+        Ids-only variant of retrieve: the returned entries have no text and only the metadata `fields`.
+        """
+        return list(self.iter_retrieve(doc_id, metadata=metadata, fields=fields or []))
+
+    def get_by_ids(self, doc_id, entry_ids: List[str], *args, **kwargs) -> List[TextEntry]:
+        """
+        Fetches entries by id, in the order of `entry_ids`, skipping the ones that do not exist.
+        """
+        entries = {entry.id: entry for entry in self.retrieve(doc_id, entry_ids)}
+        return [entries[entry_id] for entry_id in entry_ids if entry_id in entries]
+
+    async def aget_by_ids(self, doc_id, entry_ids: List[str], *args, **kwargs) -> List[TextEntry]:
+        return await asyncio.to_thread(self.get_by_ids, doc_id, entry_ids, *args, **kwargs)
+
+    def get_by_ids_many(self, requests: List[Tuple[str, List[str]]], *args, **kwargs) -> List[List[TextEntry]]:
+        """
+        Runs get_by_ids for every (doc_id, entry_ids) request, factories override it to answer them in a
+        single round trip.
+        """
+        return [self.get_by_ids(doc_id, entry_ids, *args, **kwargs) for doc_id, entry_ids in requests]
+
+    def search_text(self, doc_id, query: str, metadata: dict = None, size=25, *args, **kwargs) -> List[TextEntry]:
+        """
+        Lexical (BM25) search over the text of the entries, best first with the score in metadata["__lexical"].
+        Entries sharing no term with the query are not returned.
+        """
+        entries = self.retrieve(doc_id, metadata=metadata)
+        scores = bm25_scores([entry.text for entry in entries], query)
+        ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])[:size]
+        for i in ranked:
+            entries[i].metadata["__lexical"] = scores[i]
+        return [entries[i] for i in ranked]
+
+    async def asearch_text(self, doc_id, query: str, metadata: dict = None, size=25, *args,
+                           **kwargs) -> List[TextEntry]:
+        return await asyncio.to_thread(self.search_text, doc_id, query, metadata, size, *args, **kwargs)
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def bm25_scores(texts: List[str], query: str, k1=1.2, b=0.75) -> List[float]:
+    """
+    Okapi BM25 score of every text for the query, with the idf of the Elasticsearch (Lucene) similarity.
+    """
+    documents = [tokenize(text) for text in texts]
+    if not documents:
+        return []
+    average_length = sum(len(document) for document in documents) / len(documents) or 1.0
+    query_terms = set(tokenize(query))
+    frequencies = {term: sum(term in document for document in documents) for term in query_terms}
+    scores = []
+    for document in documents:
+        score = 0.0
+        for term in query_terms:
+            tf = document.count(term)
+            if not tf:
+                continue
+            idf = math.log(1 + (len(documents) - frequencies[term] + 0.5) / (frequencies[term] + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(document) / average_length))
+        scores.append(score)
+    return scores
+
 
 class ESDocumentFactory(DocumentFactory):
+    """
+    Document factory backed by an Elasticsearch index.
+    :parameter es_client: An existing client to share instead of creating one from es_client_params.
+    :parameter async_es_client: An existing async client used by aretrieve, created lazily otherwise.
+    :parameter ensure_index: Whether to check for the index and create it when missing.
+    :parameter index_metadata: Whether the metadata is mapped and searchable. When False it is only stored,
+        e.g. for source objects that are fetched by id.
+    :parameter page_size: The number of hits fetched per request when paging through an association.
+    :parameter pit_keep_alive: How long the point in time used for paging is kept between two pages.
+    :parameter routing: Whether entries are routed on their parent_doc_id, so the requests of an association only
+        hit the shard holding it. Existing indices are migrated with qa_engine.utils.es_index.migrate_to_routing.
+    :parameter number_of_shards: The number of primary shards of a created index, the cluster default when None.
+    """
 
-    def __init__(self, es_client_params: dict, index_name="doc_text_entries"):
-        self.es_client = Elasticsearch(**es_client_params)
+    def __init__(self,
+                 es_client_params: dict,
+                 index_name="doc_text_entries",
+                 es_client: Elasticsearch = None,
+                 async_es_client: AsyncElasticsearch = None,
+                 ensure_index=True,
+                 index_metadata=True,
+                 page_size=1000,
+                 pit_keep_alive="1m",
+                 routing=False,
+                 number_of_shards: int = None):
+        self.es_client_params = es_client_params
+        self.es_client = es_client or Elasticsearch(**es_client_params)
+        self._async_es_client = async_es_client
         self.index_name = index_name
-        self.__create_index_if_not_exists()
+        self.index_metadata = index_metadata
+        self.page_size = page_size
+        self.pit_keep_alive = pit_keep_alive
+        self.routing = routing
+        self.number_of_shards = number_of_shards
+        if ensure_index:
+            self.__create_index_if_not_exists()
+
+    @property
+    def async_es_client(self) -> AsyncElasticsearch:
+        if self._async_es_client is None:
+            self._async_es_client = AsyncElasticsearch(**self.es_client_params)
+        return self._async_es_client
 
     def destruct(self):
-        self.es_client.indices.delete(index=self.index_name)
+        delete_index(self.es_client, self.index_name)
 
     def clear(self):
         self.destruct()
         self.__create_index_if_not_exists()
 
     def __create_index_if_not_exists(self):
-        if self.es_client.indices.exists(index=self.index_name):
-            return
-        self.es_client.indices.create(index=self.index_name)
-        self.es_client.indices.put_mapping(index=self.index_name, body={
-            "properties": {
-                "parent_doc_id": {"type": "keyword"},
-                "id": {"type": "keyword"},
-                "text": {"type": "text"},
-                "metadata": {"type": "object"},
-            },
-        })
+        ensure_index(self.es_client, self.index_name, {
+            "parent_doc_id": {"type": "keyword"},
+            "id": {"type": "keyword"},
+            "text": {"type": "text"},
+            "metadata": {"type": "object"} if self.index_metadata else {"type": "object", "enabled": False},
+        }, self.number_of_shards, self.routing)
+
+    def _route(self, doc_id) -> Optional[str]:
+        return doc_id if self.routing else None
+
+    def _action(self, doc_id, entry_id: str, **action) -> dict:
+        action.update({"_index": self.index_name, "_id": f"{doc_id}_{entry_id}"})
+        if self.routing:
+            action["_routing"] = doc_id
+        return action
 
     def store(self, doc_id, entries: List[TextEntry], refresh=False, *args, **kwargs) -> bool:
         actions = [
-            {
-                "_index": self.index_name,
-                "_id": f"{doc_id}_{entry.id}",
-                "_source": {
-                    "parent_doc_id": doc_id,
-                    "id": entry.id,
-                    "text": entry.text,
-                    "metadata": entry.metadata,
-                }
-            }
+            self._action(doc_id, entry.id, _source={
+                "parent_doc_id": doc_id,
+                "id": entry.id,
+                "text": entry.text,
+                "metadata": entry.metadata,
+            })
             for entry in entries
         ]
         bulk(self.es_client, actions, refresh=refresh)
         return True
 
-    def retrieve(self, doc_id, document_ids: List[str] = None, metadata: dict = None, *args,
-                 **kwargs) -> [TextEntry]:
+    def _retrieve_query(self, doc_id, document_ids: List[str] = None, metadata: dict = None, size=10000) -> dict:
         query = {
-            "size": "10000",
+            "size": size,
             "query": {
                 "bool": {
                     "must": [
@@ -93,27 +263,225 @@ class ESDocumentFactory(DocumentFactory):
                     query["query"]["bool"]["must"].append({"term": {f"metadata.{key}": value}})
                 elif isinstance(value, list):
                     query["query"]["bool"]["must"].append({"terms": {f"metadata.{key}.keyword": value}})
-        response = self.es_client.search(index=self.index_name, body=query)
-        entries = [
+        return query
+
+    @staticmethod
+    def _hits_to_entries(hits: List[dict]) -> [TextEntry]:
+        # projected hits (see _page_query) have no text and only some metadata
+        return [
             TextEntry(
                 id=hit["_source"]["id"],
-                text=hit["_source"]["text"],
-                metadata=hit["_source"]["metadata"],
+                text=hit["_source"].get("text", ""),
+                metadata=hit["_source"].get("metadata", {}),
+            )
+            for hit in hits
+        ]
+
+    def _single_request(self, document_ids: List[str] = None) -> bool:
+        # a few ids are fetched by a plain search, anything else is paged
+        return bool(document_ids) and len(document_ids) <= self.page_size
+
+    def retrieve(self, doc_id, document_ids: List[str] = None, metadata: dict = None, *args,
+                 **kwargs) -> [TextEntry]:
+        if not self._single_request(document_ids):
+            return list(self.iter_retrieve(doc_id, document_ids, metadata))
+        query = self._retrieve_query(doc_id, document_ids, metadata, len(document_ids))
+        response = self.es_client.search(index=self.index_name, body=query, routing=self._route(doc_id))
+        return self._hits_to_entries(response["hits"]["hits"])
+
+    async def aretrieve(self, doc_id, document_ids: List[str] = None, metadata: dict = None, *args,
+                        **kwargs) -> [TextEntry]:
+        if not self._single_request(document_ids):
+            return [entry async for entry in self.aiter_retrieve(doc_id, document_ids, metadata)]
+        query = self._retrieve_query(doc_id, document_ids, metadata, len(document_ids))
+        response = await self.async_es_client.search(index=self.index_name, body=query, routing=self._route(doc_id))
+        return self._hits_to_entries(response["hits"]["hits"])
+
+    def _page_query(self, doc_id, document_ids: List[str], metadata: dict, fields: List[str], page_size: int,
+                    pit_id: str = None) -> dict:
+        query = self._retrieve_query(doc_id, document_ids, metadata, page_size or self.page_size)
+        query["track_total_hits"] = False
+        if fields is not None:
+            query["_source"] = ["id"] + [f"metadata.{field}" for field in fields]
+        if pit_id is not None:
+            query["pit"] = {"id": pit_id, "keep_alive": self.pit_keep_alive}
+            # _shard_doc is the cheapest total order of a point in time
+            query["sort"] = [{"_shard_doc": "asc"}]
+        return query
+
+    def iter_retrieve(self, doc_id, document_ids: List[str] = None, metadata: dict = None, fields: List[str] = None,
+                      page_size: int = None, *args, **kwargs) -> Iterator[TextEntry]:
+        """
+        Pages through the matching entries of a point in time of the index with search_after, so neither the
+        memory nor the 10000 hits result window bound the number of entries. Matches fitting in a single page,
+        e.g. the existing entries of a small association, are fetched by a plain search instead.
+        """
+        query = self._page_query(doc_id, document_ids, metadata, fields, page_size)
+        hits = self.es_client.search(index=self.index_name, body=query, routing=self._route(doc_id))["hits"]["hits"]
+        if len(hits) < query["size"]:
+            yield from self._hits_to_entries(hits)
+            return
+        # a full page may be followed by others, they are all fetched again from a consistent point in time
+        pit_id = self.es_client.open_point_in_time(index=self.index_name, keep_alive=self.pit_keep_alive,
+                                                   routing=self._route(doc_id))["id"]
+        try:
+            query = self._page_query(doc_id, document_ids, metadata, fields, page_size, pit_id)
+            while True:
+                response = self.es_client.search(body=query)
+                hits = response["hits"]["hits"]
+                yield from self._hits_to_entries(hits)
+                if len(hits) < query["size"]:
+                    return
+                # the point in time id may change between requests
+                pit_id = response.get("pit_id", pit_id)
+                query["pit"]["id"] = pit_id
+                query["search_after"] = hits[-1]["sort"]
+        finally:
+            self.es_client.options(ignore_status=404).close_point_in_time(id=pit_id)
+
+    async def aiter_retrieve(self, doc_id, document_ids: List[str] = None, metadata: dict = None,
+                             fields: List[str] = None, page_size: int = None, *args,
+                             **kwargs) -> AsyncIterator[TextEntry]:
+        query = self._page_query(doc_id, document_ids, metadata, fields, page_size)
+        response = await self.async_es_client.search(index=self.index_name, body=query, routing=self._route(doc_id))
+        hits = response["hits"]["hits"]
+        if len(hits) < query["size"]:
+            for entry in self._hits_to_entries(hits):
+                yield entry
+            return
+        response = await self.async_es_client.open_point_in_time(index=self.index_name,
+                                                                  keep_alive=self.pit_keep_alive,
+                                                                  routing=self._route(doc_id))
+        pit_id = response["id"]
+        try:
+            query = self._page_query(doc_id, document_ids, metadata, fields, page_size, pit_id)
+            while True:
+                response = await self.async_es_client.search(body=query)
+                hits = response["hits"]["hits"]
+                for entry in self._hits_to_entries(hits):
+                    yield entry
+                if len(hits) < query["size"]:
+                    return
+                pit_id = response.get("pit_id", pit_id)
+                query["pit"]["id"] = pit_id
+                query["search_after"] = hits[-1]["sort"]
+        finally:
+            await self.async_es_client.options(ignore_status=404).close_point_in_time(id=pit_id)
+
+    @staticmethod
+    def _docs_to_entries(docs: List[dict]) -> [TextEntry]:
+        return [
+            TextEntry(
+                id=doc["_source"]["id"],
+                text=doc["_source"]["text"],
+                metadata=doc["_source"]["metadata"],
             )
-            for hit in response["hits"]["hits"]
+            for doc in docs if doc.get("found")
         ]
+
+    def get_by_ids(self, doc_id, entry_ids: List[str], *args, **kwargs) -> List[TextEntry]:
+        if not entry_ids:
+            return []
+        # entries are stored under the deterministic _id f"{doc_id}_{entry.id}"
+        response = self.es_client.mget(index=self.index_name, routing=self._route(doc_id),
+                                       ids=[f"{doc_id}_{entry_id}" for entry_id in entry_ids])
+        return self._docs_to_entries(response["docs"])
+
+    def get_by_ids_many(self, requests: List[Tuple[str, List[str]]], *args, **kwargs) -> List[List[TextEntry]]:
+        docs = [{"_id": f"{doc_id}_{entry_id}", "routing": doc_id} if self.routing else {"_id": f"{doc_id}_{entry_id}"}
+                for doc_id, entry_ids in requests for entry_id in entry_ids]
+        if not docs:
+            return [[] for _ in requests]
+        docs = iter(self.es_client.mget(index=self.index_name, docs=docs)["docs"])
+        # mget answers in the order of the ids, split them back per request
+        return [self._docs_to_entries([next(docs) for _ in entry_ids]) for _, entry_ids in requests]
+
+    async def aget_by_ids(self, doc_id, entry_ids: List[str], *args, **kwargs) -> List[TextEntry]:
+        if not entry_ids:
+            return []
+        response = await self.async_es_client.mget(index=self.index_name, routing=self._route(doc_id),
+                                                   ids=[f"{doc_id}_{entry_id}" for entry_id in entry_ids])
+        return self._docs_to_entries(response["docs"])
+
+    def _search_text_query(self, doc_id, query: str, metadata: dict = None, size=25) -> dict:
+        search_query = self._retrieve_query(doc_id, None, metadata)
+        search_query["size"] = size
+        bool_query = search_query["query"]["bool"]
+        # the association and metadata only filter, the BM25 score comes from the text alone
+        bool_query["filter"] = bool_query.pop("must")
+        bool_query["must"] = [{"match": {"text": query}}]
+        return search_query
+
+    @staticmethod
+    def _lexical_hits_to_entries(hits: List[dict]) -> [TextEntry]:
+        entries = ESDocumentFactory._hits_to_entries(hits)
+        for entry, hit in zip(entries, hits):
+            entry.metadata["__lexical"] = hit["_score"]
         return entries
 
+    def search_text(self, doc_id, query: str, metadata: dict = None, size=25, *args, **kwargs) -> List[TextEntry]:
+        response = self.es_client.search(index=self.index_name, routing=self._route(doc_id),
+                                         body=self._search_text_query(doc_id, query, metadata, size))
+        return self._lexical_hits_to_entries(response["hits"]["hits"])
+
+    async def asearch_text(self, doc_id, query: str, metadata: dict = None, size=25, *args,
+                           **kwargs) -> List[TextEntry]:
+        response = await self.async_es_client.search(index=self.index_name, routing=self._route(doc_id),
+                                                     body=self._search_text_query(doc_id, query, metadata, size))
+        return self._lexical_hits_to_entries(response["hits"]["hits"])
+
+    def remove_by_ids(self, doc_id, entry_ids: List[str], refresh=False, *args, **kwargs) -> bool:
+        # entries are stored under the deterministic _id f"{doc_id}_{entry.id}", deleting them needs no search
+        actions = (self._action(doc_id, entry_id, _op_type="delete") for entry_id in entry_ids)
+        bulk(self.es_client, actions, refresh=refresh, ignore_status=404)
+        return True
+
+    def remove_where(self, doc_id, metadata: dict = None, *args, **kwargs) -> Optional[str]:
+        query = self._retrieve_query(doc_id, None, metadata)
+        return start_delete_by_query(self.es_client, self.index_name, query["query"]["bool"]["must"],
+                                     self._route(doc_id))
+
+    def removal_status(self, task_id: str) -> Optional[dict]:
+        return task_status(self.es_client, task_id)
+
+    def bulk_load(self, force_merge_segments: int = None, replicas=0):
+        """
+        Disables refreshes and lowers the replicas of the index during the block, see qa_engine.utils.es_index.
+        """
+        return bulk_load(self.es_client, self.index_name, replicas, force_merge_segments)
+
+    def restore_bulk_load(self) -> bool:
+        return restore_bulk_load(self.es_client, self.index_name)
+
+
+class InMemoryDocumentFactory(DocumentFactory):
+    """
+    DocumentFactory keeping the entries of every doc_id in a dict, with the metadata filter semantics
+    of ESDocumentFactory. Used by the tests and the benchmarks.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def store(self, doc_id, entries: List[TextEntry], *args, **kwargs) -> bool:
+        for entry in entries:
+            self.entries.setdefault(doc_id, {})[entry.id] = TextEntry(entry.id, entry.text, dict(entry.metadata))
+        return True
+
     def remove_by_ids(self, doc_id, entry_ids: List[str], *args, **kwargs) -> bool:
-        query = {
-            "query": {
-                "bool": {
-                    "must": [
-                        {"term": {"parent_doc_id": doc_id}},
-                        {"terms": {"id": entry_ids}},
-                    ],
-                },
-            },
-        }
-        self.es_client.delete_by_query(index=self.index_name, body=query)
+        for entry_id in entry_ids:
+            self.entries.get(doc_id, {}).pop(entry_id, None)
         return True
+
+    def retrieve(self, doc_id, document_ids: List[str] = None, metadata: dict = None, *args,
+                 **kwargs) -> List[TextEntry]:
+        result = []
+        for entry in self.entries.get(doc_id, {}).values():
+            if document_ids and entry.id not in document_ids:
+                continue
+            if metadata and not all(
+                    entry.metadata.get(key) in value if isinstance(value, list) else entry.metadata.get(key) == value
+                    for key, value in metadata.items()):
+                continue
+            result.append(TextEntry(entry.id, entry.text, dict(entry.metadata)))
+        return result
@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List
 from tqdm import tqdm
 from PyPDF2 import PdfReader
 from qa_engine.core.models import Document
+import os
 
 
 class DocumentOperator(ABC):
@@ -9,14 +12,74 @@ class DocumentOperator(ABC):
     def parse(self, document, *args, **kwargs) -> any:
         pass
 
+    def iter_parse(self, document, *args, **kwargs) -> Iterator:
+        """
+        Lazily yields the parts of the parsed document, operators that can avoid holding the whole document
+        in memory override it.
+        """
+        yield from self.parse(document, *args, **kwargs)
+
+
+# the reader opened by a worker process, keyed on path, it lives as long as the executor of iter_parse
+_readers = {}
+
+
+def _extract_pages(path: str, page_indices: List[int]) -> List[str]:
+    if path not in _readers:
+        _readers.clear()
+        _readers[path] = PdfReader(path)
+    reader = _readers[path]
+    return [reader.pages[i].extract_text() for i in page_indices]
+
 
 class PDFDocumentOperator(DocumentOperator):
+    """
+    :parameter max_workers: The number of processes extracting pages, 1 extracts them in-process. Falls
+        back to in-process extraction where processes can not be spawned (e.g. AWS Lambda).
+    :parameter pages_per_task: The number of pages a worker extracts per task.
+    """
+
+    def __init__(self, max_workers: int = None, pages_per_task=8):
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.pages_per_task = pages_per_task
+
     def parse(self, document, *args, **kwargs) -> any:
+        return list(self.iter_parse(document, *args, **kwargs))
+
+    def iter_parse(self, document, *args, **kwargs) -> Iterator[str]:
+        """
+        Yields the text of the pages in order. At most 2 tasks per worker are in flight, so memory does not
+        grow with the number of pages when the consumer is slower than the extraction.
+        """
         path = document.data
-        # print(path)
-        reader = PdfReader(path)  # path / ../'Project plan.pdf'
-        text = [page.extract_text() for page in tqdm(reader.pages)]
-        return text
+        reader = PdfReader(path)
+        page_count = len(reader.pages)
+        tasks = [list(range(start, min(start + self.pages_per_task, page_count)))
+                 for start in range(0, page_count, self.pages_per_task)]
+        progress = tqdm(total=page_count)
+        try:
+            executor = ProcessPoolExecutor(self.max_workers) if self.max_workers > 1 and len(tasks) > 1 else None
+        except (OSError, NotImplementedError):
+            executor = None
+        if executor is None:
+            # a local reader, released with the generator instead of staying cached in this process
+            for page in reader.pages:
+                progress.update()
+                yield page.extract_text()
+            progress.close()
+            return
+        del reader
+        with executor:
+            pending = []
+            next_task = 0
+            while next_task < len(tasks) or pending:
+                while next_task < len(tasks) and len(pending) < 2 * self.max_workers:
+                    pending.append(executor.submit(_extract_pages, path, tasks[next_task]))
+                    next_task += 1
+                for text in pending.pop(0).result():
+                    progress.update()
+                    yield text
+        progress.close()
 
 
 class BasicDocumentOperator(DocumentOperator):
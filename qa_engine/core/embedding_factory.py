@@ -1,14 +1,28 @@
 from abc import ABC, abstractmethod
-from typing import List
+from contextlib import nullcontext
+from typing import List, Optional, Tuple
+import asyncio
+import json
+import os
+import shutil
+import threading
+import uuid
+from urllib.parse import quote
 
 import elasticsearch.helpers
+import numpy as np
 
 from qa_engine.core.models import EmbeddingEntry
-from elasticsearch import Elasticsearch
+from qa_engine.utils.es_index import bulk_load, delete_index, ensure_index, restore_bulk_load
+from qa_engine.utils.es_tasks import start_delete_by_query, task_status
+from qa_engine.utils.stages import stage
+from elasticsearch import Elasticsearch, AsyncElasticsearch
 from elasticsearch.helpers import bulk
 
 
 class EmbeddingFactory(ABC):
+    # the dimension of the stored embeddings, when the factory knows it
+    embedding_size: Optional[int] = None
 
     @abstractmethod
     def store(self, doc_id: str, embeddings: List[EmbeddingEntry], *args, **kwargs):
@@ -20,64 +34,192 @@ class EmbeddingFactory(ABC):
 
     @abstractmethod
     def retrieve(self, doc_id: str, embedding: List[float], metadata: dict, *args, **kwargs) -> List[EmbeddingEntry]:
+        """
+        Implementations accept an `entry_ids` keyword restricting the search to the given entries.
+        """
         pass
 
     def remove(self, doc_id: str, embeddings: List[EmbeddingEntry], *args, **kwargs):
         return self.remove_by_ids(doc_id, [embedding.id for embedding in embeddings], *args, **kwargs)
 
+    def remove_where(self, doc_id: str, metadata: dict = None, *args, **kwargs) -> Optional[str]:
+        """
+        Removes the entries of `doc_id` matching `metadata`, all of them when None. Factories backed by a
+        cluster run it as a background task and return its id (see removal_status), the others return None
+        once the entries are removed.
+        The default retrieves the matching entries with a constant query embedding of `embedding_size`
+        dimensions and removes them, until a retrieval finds no entry left.
+        """
+        if self.embedding_size is None:
+            raise NotImplementedError(f"{type(self).__name__} has no embedding_size to retrieve the entries with")
+        embedding = [1.0] * self.embedding_size
+        removed = set()
+        while True:
+            entry_ids = [entry.id for entry in self.retrieve(doc_id, embedding, metadata) if entry.id not in removed]
+            if not entry_ids:
+                return None
+            self.remove_by_ids(doc_id, entry_ids)
+            removed.update(entry_ids)
+
+    def removal_status(self, task_id: str) -> Optional[dict]:
+        """
+        Progress of a removal task started by remove_where, None when the factory does not know it.
+        """
+        return None
+
+    def bulk_load(self, force_merge_segments: int = None):
+        """
+        Context manager tuning the storage for a large ingestion done in the block, a no-op by default.
+        """
+        return nullcontext()
+
+    def restore_bulk_load(self) -> bool:
+        """
+        Undoes the tuning of a bulk load that was interrupted, e.g. by a crash, returns whether there was one.
+        """
+        return False
+
+    async def aretrieve(self, doc_id: str, embedding: List[float], metadata: dict = None, *args,
+                        **kwargs) -> List[EmbeddingEntry]:
+        return await asyncio.to_thread(self.retrieve, doc_id, embedding, metadata, *args, **kwargs)
+
+    def retrieve_many(self, requests: List[Tuple[str, List[float], Optional[dict]]], *args,
+                      **kwargs) -> List[List[EmbeddingEntry]]:
+        """
+        Runs retrieve for every (doc_id, embedding, metadata) request, factories override it to answer
+        them in a single round trip.
+        """
+        return [self.retrieve(doc_id, embedding, metadata, *args, **kwargs) for doc_id, embedding, metadata in requests]
+
+
 class ESEmbeddingFactory(EmbeddingFactory):
+    """
+    Embedding factory backed by an Elasticsearch dense_vector index.
+    :parameter retrieval_mode: "script_score" scores every vector of the parent_doc_id exactly, "knn"
+        uses the approximate HNSW search of the index with parent_doc_id and metadata as a pre-filter.
+    :parameter k: The number of entries returned by retrieve.
+    :parameter num_candidates: The number of HNSW candidates considered per shard in "knn" mode.
+    :parameter rescore_window: If set, "knn" mode fetches this many candidates and re-ranks them by
+        exact cosine similarity before keeping the top k.
+    :parameter es_client: An existing client to share instead of creating one from es_client_params.
+    :parameter async_es_client: An existing async client used by aretrieve, created lazily otherwise.
+    :parameter ensure_index: Whether to check for the index and create it when missing.
+    :parameter store_text: Whether to keep the entries' text next to their vector, so retrieval does not
+        need a second request to the document factory.
+    :parameter quantization: "int8" (int8_hnsw, Elasticsearch >= 8.12) or "binary" (bbq_hnsw, Elasticsearch
+        >= 8.16) keeps only quantized vectors in the HNSW graph. Quantized indices are searched in "knn"
+        mode and the candidates are rescored against the float vectors of their _source, `rescore_window`
+        defaults to 4 times k.
+    :parameter routing: Whether entries are routed on their parent_doc_id, so the searches of an association only
+        hit the shard holding it. Existing indices are migrated with qa_engine.utils.es_index.migrate_to_routing.
+    :parameter number_of_shards: The number of primary shards of a created index, the cluster default when None.
+    """
 
     def __init__(self,
                  es_client_params: dict,
                  index_name,
-                 embedding_size):
-        self.es_client = Elasticsearch(**es_client_params)
+                 embedding_size,
+                 retrieval_mode="script_score",
+                 k=25,
+                 num_candidates=100,
+                 rescore_window=None,
+                 es_client: Elasticsearch = None,
+                 async_es_client: AsyncElasticsearch = None,
+                 ensure_index=True,
+                 store_text=True,
+                 quantization: str = None,
+                 routing=False,
+                 number_of_shards: int = None):
+        if retrieval_mode not in ("script_score", "knn"):
+            raise ValueError(f"Unknown retrieval mode: {retrieval_mode}")
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization: {quantization}")
+        if quantization:
+            retrieval_mode = "knn"
+            rescore_window = rescore_window or 4 * k
+        self.es_client_params = es_client_params
+        self.es_client = es_client or Elasticsearch(**es_client_params)
+        self._async_es_client = async_es_client
         self.index_name = index_name
         self.embedding_size = embedding_size
-        self.__create_index_if_not_exists()
+        self.retrieval_mode = retrieval_mode
+        self.k = k
+        self.num_candidates = num_candidates
+        self.rescore_window = rescore_window
+        self.store_text = store_text
+        self.quantization = quantization
+        self.routing = routing
+        self.number_of_shards = number_of_shards
+        if ensure_index:
+            self.__create_index_if_not_exists()
+
+    @property
+    def async_es_client(self) -> AsyncElasticsearch:
+        if self._async_es_client is None:
+            self._async_es_client = AsyncElasticsearch(**self.es_client_params)
+        return self._async_es_client
 
     def destruct(self):
-        self.es_client.indices.delete(index=self.index_name)
+        delete_index(self.es_client, self.index_name)
 
     def clear(self):
         self.destruct()
         self.__create_index_if_not_exists()
 
+    def _embedding_mapping(self) -> dict:
+        mapping = {
+            "type": "dense_vector",
+            "dims": self.embedding_size,
+            "similarity": "cosine",
+            "index": True,
+        }
+        if self.quantization == "int8":
+            mapping["index_options"] = {"type": "int8_hnsw"}
+        elif self.quantization == "binary":
+            mapping["index_options"] = {"type": "bbq_hnsw"}
+        return mapping
+
     def __create_index_if_not_exists(self):
-        if self.es_client.indices.exists(index=self.index_name):
-            return
-        self.es_client.indices.create(index=self.index_name)
-        self.es_client.indices.put_mapping(index=self.index_name, body={
-            "properties": {
-                "id": {
-                    "type": "keyword",
-                },
-                "parent_doc_id": {
-                    "type": "keyword",
-                },
-                "embedding": {
-                    "type": "dense_vector",
-                    "dims": self.embedding_size,
-                    "similarity": "cosine",
-                    "index": True,
-                },
-                "metadata": {
-                    "type": "object",
-                },
+        ensure_index(self.es_client, self.index_name, {
+            "id": {
+                "type": "keyword",
+            },
+            "parent_doc_id": {
+                "type": "keyword",
+            },
+            "embedding": self._embedding_mapping(),
+            "metadata": {
+                "type": "object",
+            },
+            "text": {
+                "type": "text",
+                "index": False,
             },
-        })
+        }, self.number_of_shards, self.routing)
+
+    def _route(self, doc_id: str) -> Optional[str]:
+        return doc_id if self.routing else None
+
+    def _action(self, doc_id: str, embedding_id: str, **action) -> dict:
+        action.update({"_index": self.index_name, "_id": embedding_id})
+        if self.routing:
+            action["_routing"] = doc_id
+        return action
+
+    def _source(self, doc_id: str, embedding_entry: EmbeddingEntry) -> dict:
+        source = {
+            "id": embedding_entry.id,
+            "embedding": embedding_entry.embedding,
+            "metadata": embedding_entry.metadata,
+            "parent_doc_id": doc_id,
+        }
+        if self.store_text and embedding_entry.text is not None:
+            source["text"] = embedding_entry.text
+        return source
 
     def store(self, doc_id: str, embeddings: List[EmbeddingEntry], refresh=False, *args, **kwargs):
         actions = [
-            {
-                "_index": self.index_name,
-                "_id": embedding_entry.id,
-                "_source": {
-                    "embedding": embedding_entry.embedding,
-                    "metadata": embedding_entry.metadata,
-                    "parent_doc_id": doc_id,
-                },
-            }
+            self._action(doc_id, embedding_entry.id, _source=self._source(doc_id, embedding_entry))
             for embedding_entry in embeddings]
         try:
             bulk(self.es_client, actions, refresh=refresh)
@@ -87,15 +229,55 @@ class ESEmbeddingFactory(EmbeddingFactory):
                 # print reason
                 print(item['index']['error'])
 
-    def retrieve(self, doc_id, embedding: List[float], metadata: dict = None, *args, **kwargs) -> [
-        EmbeddingEntry]:
-        # fast retrieval and sort by score
+    def _filters(self, doc_id, metadata: dict = None, entry_ids: List[str] = None) -> List[dict]:
+        filters = [{"term": {"parent_doc_id": doc_id}}]
+        if entry_ids is not None:
+            filters.append({"ids": {"values": entry_ids}})
+        if metadata is not None:
+            # same semantics as the document factory: lists match any of their values
+            for key, value in metadata.items():
+                if isinstance(value, list):
+                    filters.append({"terms": {f"metadata.{key}.keyword": value}})
+                else:
+                    filters.append({"term": {f"metadata.{key}": value}})
+        return filters
+
+    def _hits_to_entries(self, hits: List[dict], score_scale=1.0) -> [EmbeddingEntry]:
+        result = []
+        for hit in hits:
+            entry = EmbeddingEntry(
+                hit["_id"],
+                hit["_source"]["embedding"],
+                hit["_source"]["metadata"],
+                hit["_source"].get("text"),
+            )
+            entry.metadata["__rank"] = hit["_score"] * score_scale
+            result.append(entry)
+        return result
+
+    def _search_request(self, doc_id, embedding: List[float], metadata: dict = None,
+                        entry_ids: List[str] = None) -> dict:
+        if self.retrieval_mode == "knn":
+            window = max(self.k, self.rescore_window or 0)
+            knn = {
+                "field": "embedding",
+                "query_vector": embedding,
+                "k": window,
+                "num_candidates": max(self.num_candidates, window),
+                "filter": {
+                    "bool": {
+                        "filter": self._filters(doc_id, metadata, entry_ids),
+                    },
+                },
+            }
+            return {"knn": knn, "size": window}
+        # exact retrieval, scores every vector of the doc_id
         query = {
             "query": {
                 "script_score": {
                     "query": {
-                        "match": {
-                            "parent_doc_id": doc_id,
+                        "bool": {
+                            "filter": self._filters(doc_id, metadata, entry_ids),
                         },
                     },
                     "script": {
@@ -106,34 +288,494 @@ class ESEmbeddingFactory(EmbeddingFactory):
                     },
                 },
             },
-            "size": 25,
+            "size": self.k,
         }
-        if metadata is not None:
-            query["query"]["script_score"]["query"]["match"]["metadata"] = metadata
+        return {"body": query}
 
-        response = self.es_client.search(index=self.index_name, body=query)
-        result = []
-        for hit in response["hits"]["hits"]:
-            entry = EmbeddingEntry(
-                hit["_id"],
-                hit["_source"]["embedding"],
-                hit["_source"]["metadata"],
-            )
-            entry.metadata["__rank"] = hit["_score"]
-            result.append(entry)
-        return result
+    def _parse_response(self, embedding: List[float], response) -> [EmbeddingEntry]:
+        if self.retrieval_mode != "knn":
+            return self._hits_to_entries(response["hits"]["hits"])
+        # knn scores cosine as (1 + cos) / 2, rescale to the cos + 1 of the script_score mode
+        entries = self._hits_to_entries(response["hits"]["hits"], score_scale=2.0)
+        if self.rescore_window and entries:
+            with stage("rescore", len(entries)):
+                entries = self._rescore(embedding, entries)
+        return entries[:self.k]
+
+    def retrieve(self, doc_id, embedding: List[float], metadata: dict = None, entry_ids: List[str] = None,
+                 *args, **kwargs) -> [EmbeddingEntry]:
+        request = self._search_request(doc_id, embedding, metadata, entry_ids)
+        response = self.es_client.search(index=self.index_name, routing=self._route(doc_id), **request)
+        return self._parse_response(embedding, response)
+
+    async def aretrieve(self, doc_id, embedding: List[float], metadata: dict = None, entry_ids: List[str] = None,
+                        *args, **kwargs) -> [EmbeddingEntry]:
+        request = self._search_request(doc_id, embedding, metadata, entry_ids)
+        response = await self.async_es_client.search(index=self.index_name, routing=self._route(doc_id), **request)
+        return self._parse_response(embedding, response)
 
+    def retrieve_many(self, requests: List[Tuple[str, List[float], Optional[dict]]], *args,
+                      **kwargs) -> List[List[EmbeddingEntry]]:
+        if not requests:
+            return []
+        searches = []
+        for doc_id, embedding, metadata in requests:
+            request = self._search_request(doc_id, embedding, metadata)
+            searches += [{"routing": doc_id} if self.routing else {}, request.get("body", request)]
+        response = self.es_client.msearch(index=self.index_name, searches=searches)
+        results = []
+        for (doc_id, embedding, metadata), item in zip(requests, response["responses"]):
+            # like a failed retrieve, so an empty result is never mistaken for (and cached as) a real one
+            if "error" in item:
+                raise RuntimeError(f"Vector search of {doc_id} in {self.index_name} failed: {item['error']}")
+            results.append(self._parse_response(embedding, item))
+        return results
+
+    @staticmethod
+    def _rescore(embedding: List[float], entries: List[EmbeddingEntry]) -> List[EmbeddingEntry]:
+        matrix = np.asarray([entry.embedding for entry in entries], dtype=np.float32)
+        scores = cosine_scores(matrix, embedding)
+        for entry, score in zip(entries, scores):
+            entry.metadata["__rank"] = float(score)
+        return sorted(entries, key=lambda entry: -entry.metadata["__rank"])
 
     def remove_by_ids(self, doc_id: str, embedding_ids: List[str], refresh=False, *args, **kwargs):
-        query = {
-            "query": {
-                "bool": {
-                    "must": [
-                        {"term": {"parent_doc_id": doc_id}},
-                        {"terms": {"id": embedding_ids}},
-                    ],
-                },
-            },
+        # entries are stored under _id = entry id, deleting them by _id needs no search
+        actions = (self._action(doc_id, embedding_id, _op_type="delete") for embedding_id in embedding_ids)
+        bulk(self.es_client, actions, refresh=refresh, ignore_status=404)
+        return True
+
+    def remove_where(self, doc_id: str, metadata: dict = None, *args, **kwargs) -> Optional[str]:
+        return start_delete_by_query(self.es_client, self.index_name, self._filters(doc_id, metadata),
+                                     self._route(doc_id))
+
+    def removal_status(self, task_id: str) -> Optional[dict]:
+        return task_status(self.es_client, task_id)
+
+    def bulk_load(self, force_merge_segments: int = None, replicas=0):
+        """
+        Disables refreshes and lowers the replicas of the index during the block, so the HNSW graph is built
+        once per segment instead of on every refresh. Force-merging afterwards also merges the graphs.
+        """
+        return bulk_load(self.es_client, self.index_name, replicas, force_merge_segments)
+
+    def restore_bulk_load(self) -> bool:
+        return restore_bulk_load(self.es_client, self.index_name)
+
+
+def matches_metadata(entry_metadata: dict, metadata: Optional[dict]) -> bool:
+    """
+    Local equivalent of the metadata filters used by the ES factories: a list value matches any of
+    its members, every other value must be equal.
+    """
+    if not metadata:
+        return True
+    for key, value in metadata.items():
+        if key not in entry_metadata:
+            return False
+        if isinstance(value, list):
+            if entry_metadata[key] not in value:
+                return False
+        elif entry_metadata[key] != value:
+            return False
+    return True
+
+
+def cosine_scores(matrix: np.ndarray, embedding: List[float], norms: np.ndarray = None) -> np.ndarray:
+    """
+    Cosine similarity of every row of `matrix` to `embedding`, on the same scale as the ES
+    script_score (cosineSimilarity + 1.0). Row norms can be passed in when they are precomputed.
+    """
+    query = np.asarray(embedding, dtype=np.float32)
+    if norms is None:
+        norms = np.linalg.norm(matrix, axis=1)
+    denominator = norms * np.linalg.norm(query)
+    denominator[denominator == 0] = 1.0
+    return matrix @ query / denominator + 1.0
+
+
+QUANTIZATIONS = (None, "int8", "binary")
+
+# number of rows scored at once, bounds the temporary copies made while scanning
+SCAN_BLOCK_ROWS = 65536
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def quantize(vectors: np.ndarray, quantization: str):
+    """
+    Quantizes float32 rows. "int8" gives symmetric per-row int8 codes and their float32 scales, "binary"
+    gives the sign bits of every dimension packed into uint8 codes and no scales.
+    """
+    if quantization == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    if quantization == "binary":
+        return np.packbits(vectors > 0, axis=1), None
+    raise ValueError(f"Unknown quantization: {quantization}")
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Positions of the k highest scores, best first.
+    """
+    if len(scores) > k:
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+class _NumpyAssociation:
+    """
+    On-disk state of a single parent_doc_id: a row-major float32 matrix in `vectors.f32` and the id,
+    metadata, text and tombstone of every row. These are kept in a json snapshot (`entries.json`),
+    rewritten when the rows are compacted, followed by an append-only log of the rows stored and
+    tombstoned since then, so a store or remove only writes its own rows. With a quantization the int8 or
+    binary codes of the rows (`codes.bin`, plus the int8 scales in `scales.f32`) are scanned first and
+    only the best candidates are rescored against the float32 matrix.
+    """
+
+    def __init__(self, path: str, embedding_size: int, quantization: str = None):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization: {quantization}")
+        self.path = path
+        self.embedding_size = embedding_size
+        self.quantization = quantization
+        self.vectors_path = os.path.join(path, "vectors.f32")
+        self.codes_path = os.path.join(path, "codes.bin")
+        self.scales_path = os.path.join(path, "scales.f32")
+        self.entries_path = os.path.join(path, "entries.json")
+        # every compaction starts a new log, named in the snapshot, so a crash never replays a stale one
+        self.log_path = os.path.join(path, "entries.log")
+        self.ids: List[str] = []
+        self.metadata: List[dict] = []
+        self.texts: List[Optional[str]] = []
+        self.alive = np.zeros(0, dtype=bool)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.scales = np.zeros(0, dtype=np.float32)
+        self.id2row = {}
+        self.matrix = np.zeros((0, embedding_size), dtype=np.float32)
+        self.codes = None
+        if os.path.exists(self.entries_path) or os.path.exists(self.log_path):
+            self._load()
+
+    @property
+    def tombstones(self) -> int:
+        return len(self.ids) - int(self.alive.sum())
+
+    @property
+    def code_width(self) -> int:
+        return self.embedding_size if self.quantization == "int8" else (self.embedding_size + 7) // 8
+
+    @property
+    def code_dtype(self):
+        return np.int8 if self.quantization == "int8" else np.uint8
+
+    def _load(self):
+        deleted = []
+        if os.path.exists(self.entries_path):
+            with open(self.entries_path, "r") as f:
+                state = json.load(f)
+            self.ids = state["ids"]
+            self.metadata = state["metadata"]
+            self.texts = state.get("texts", [None] * len(self.ids))
+            deleted = state["deleted"]
+            self.log_path = os.path.join(self.path, state.get("log", "entries.log"))
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last record of an interrupted write
+                        break
+                    deleted += record.get("deleted", [])
+                    self.ids += record.get("ids", [])
+                    self.metadata += record.get("metadata", [])
+                    self.texts += record.get("texts", [])
+        self.alive = np.ones(len(self.ids), dtype=bool)
+        self.alive[deleted] = False
+        self.id2row = {entry_id: row for row, entry_id in enumerate(self.ids) if self.alive[row]}
+        # rows written after the last record of the log are dropped, the next ones are appended after them
+        vectors_size = len(self.ids) * self.embedding_size * 4
+        if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) > vectors_size:
+            os.truncate(self.vectors_path, vectors_size)
+        self._map()
+        self.norms = np.concatenate(
+            [np.linalg.norm(self.matrix[start:start + SCAN_BLOCK_ROWS], axis=1)
+             for start in range(0, len(self.ids), SCAN_BLOCK_ROWS)] or [np.zeros(0)]).astype(np.float32)
+        if self.quantization:
+            self._load_codes()
+
+    def _load_codes(self):
+        expected_size = len(self.ids) * self.code_width * np.dtype(self.code_dtype).itemsize
+        if not os.path.exists(self.codes_path) or os.path.getsize(self.codes_path) != expected_size:
+            # stored without (or with another) quantization, derive the codes from the float32 matrix
+            self._write_codes()
+        if self.quantization == "int8":
+            self.scales = np.fromfile(self.scales_path, dtype=np.float32)
+        self._map_codes()
+
+    def _write_codes(self):
+        with open(self.codes_path + ".tmp", "wb") as codes_file, open(self.scales_path + ".tmp", "wb") as scales_file:
+            for start in range(0, len(self.ids), SCAN_BLOCK_ROWS):
+                block = np.asarray(self.matrix[start:start + SCAN_BLOCK_ROWS], dtype=np.float32)
+                codes, scales = quantize(block, self.quantization)
+                codes.tofile(codes_file)
+                if scales is not None:
+                    scales.tofile(scales_file)
+        self.codes = None
+        os.replace(self.codes_path + ".tmp", self.codes_path)
+        os.replace(self.scales_path + ".tmp", self.scales_path)
+
+    def _map(self):
+        if not self.ids:
+            self.matrix = np.zeros((0, self.embedding_size), dtype=np.float32)
+            return
+        self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                                shape=(len(self.ids), self.embedding_size))
+
+    def _map_codes(self):
+        if not self.ids:
+            self.codes = np.zeros((0, self.code_width), dtype=self.code_dtype)
+            return
+        self.codes = np.memmap(self.codes_path, dtype=self.code_dtype, mode="r",
+                               shape=(len(self.ids), self.code_width))
+
+    def _log(self, record: dict):
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def save(self):
+        """
+        Writes a snapshot of every row and starts a new, empty log.
+        """
+        old_log_path = self.log_path
+        log_name = f"entries.{uuid.uuid4().hex[:8]}.log"
+        state = {
+            "ids": self.ids,
+            "metadata": self.metadata,
+            "texts": self.texts,
+            "deleted": np.flatnonzero(~self.alive).tolist(),
+            "log": log_name,
         }
-        self.es_client.delete_by_query(index=self.index_name, body=query, refresh=refresh)
-        return True
\ No newline at end of file
+        tmp_path = self.entries_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.entries_path)
+        self.log_path = os.path.join(self.path, log_name)
+        if os.path.exists(old_log_path):
+            os.remove(old_log_path)
+
+    def append(self, entries: List[EmbeddingEntry]):
+        # the last entry of an id stored twice in the batch wins, like in a bulk request
+        entries = list({entry.id: entry for entry in entries}.values())
+        vectors = np.asarray([entry.embedding for entry in entries], dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[1] != self.embedding_size:
+            raise ValueError(f"Expected embeddings of size {self.embedding_size}, got {vectors.shape}")
+        # Re-stored ids behave like an ES upsert: the previous row becomes a tombstone
+        deleted = self.tombstone([entry.id for entry in entries])
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.vectors_path, "ab") as f:
+            vectors.tofile(f)
+        if self.quantization:
+            codes, scales = quantize(vectors, self.quantization)
+            with open(self.codes_path, "ab") as f:
+                codes.tofile(f)
+            if scales is not None:
+                with open(self.scales_path, "ab") as f:
+                    scales.tofile(f)
+                self.scales = np.concatenate([self.scales, scales])
+        first_row = len(self.ids)
+        for i, entry in enumerate(entries):
+            self.ids.append(entry.id)
+            self.metadata.append(entry.metadata)
+            self.texts.append(entry.text)
+            self.id2row[entry.id] = first_row + i
+        self.alive = np.concatenate([self.alive, np.ones(len(entries), dtype=bool)])
+        self.norms = np.concatenate([self.norms, np.linalg.norm(vectors, axis=1).astype(np.float32)])
+        self._map()
+        if self.quantization:
+            self._map_codes()
+        self._log({"deleted": deleted, "ids": [entry.id for entry in entries],
+                   "metadata": [entry.metadata for entry in entries], "texts": [entry.text for entry in entries]})
+
+    def tombstone(self, entry_ids: List[str]) -> List[int]:
+        rows = [self.id2row.pop(entry_id) for entry_id in entry_ids if entry_id in self.id2row]
+        self.alive[rows] = False
+        return rows
+
+    def remove(self, entry_ids: List[str]) -> int:
+        rows = self.tombstone(entry_ids)
+        if rows:
+            self._log({"deleted": rows})
+        return len(rows)
+
+    def compact(self):
+        rows = np.flatnonzero(self.alive)
+        tmp_path = self.vectors_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for start in range(0, len(rows), SCAN_BLOCK_ROWS):
+                np.asarray(self.matrix[rows[start:start + SCAN_BLOCK_ROWS]], dtype=np.float32).tofile(f)
+        self.matrix = None
+        self.codes = None
+        os.replace(tmp_path, self.vectors_path)
+        self.ids = [self.ids[row] for row in rows]
+        self.metadata = [self.metadata[row] for row in rows]
+        self.texts = [self.texts[row] for row in rows]
+        self.id2row = {entry_id: row for row, entry_id in enumerate(self.ids)}
+        self.alive = np.ones(len(self.ids), dtype=bool)
+        self.norms = self.norms[rows]
+        self._map()
+        if self.quantization:
+            self._write_codes()
+            self._load_codes()
+        self.save()
+
+    def _exact_scores(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        return np.concatenate([
+            cosine_scores(self.matrix[rows[start:start + SCAN_BLOCK_ROWS]], query,
+                          self.norms[rows[start:start + SCAN_BLOCK_ROWS]])
+            for start in range(0, len(rows), SCAN_BLOCK_ROWS)])
+
+    def _approximate_scores(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """
+        First pass scores computed from the quantized codes, only their order is meaningful.
+        """
+        scores = []
+        if self.quantization == "int8":
+            for start in range(0, len(rows), SCAN_BLOCK_ROWS):
+                block = rows[start:start + SCAN_BLOCK_ROWS]
+                norms = self.norms[block].copy()
+                norms[norms == 0] = 1.0
+                scores.append(self.codes[block].astype(np.float32) @ query * self.scales[block] / norms)
+        else:
+            query_bits = np.packbits(query > 0)
+            for start in range(0, len(rows), SCAN_BLOCK_ROWS):
+                block = rows[start:start + SCAN_BLOCK_ROWS]
+                # fewer differing sign bits means a smaller angle
+                scores.append(-_POPCOUNT[self.codes[block] ^ query_bits].sum(axis=1, dtype=np.int32))
+        return np.concatenate(scores)
+
+    def search(self, embedding: List[float], metadata: Optional[dict], size: int, rescore_window: int = None,
+               entry_ids: List[str] = None):
+        if not self.id2row:
+            return [], []
+        if entry_ids is None:
+            mask = self.alive.copy()
+        else:
+            mask = np.zeros(len(self.ids), dtype=bool)
+            mask[[self.id2row[entry_id] for entry_id in entry_ids if entry_id in self.id2row]] = True
+        if metadata:
+            for row in np.flatnonzero(mask):
+                mask[row] = matches_metadata(self.metadata[row], metadata)
+        candidates = np.flatnonzero(mask)
+        if len(candidates) == 0:
+            return [], []
+        query = np.asarray(embedding, dtype=np.float32)
+        if self.quantization:
+            shortlist = top_k(self._approximate_scores(candidates, query), max(size, rescore_window or 0))
+            candidates = np.sort(candidates[shortlist])
+        scores = self._exact_scores(candidates, query)
+        top = top_k(scores, size)
+        return candidates[top], scores[top]
+
+
+class NumpyEmbeddingFactory(EmbeddingFactory):
+    """
+    In-process embedding factory that keeps every parent_doc_id's embeddings as a contiguous float32
+    matrix in a memory-mapped file under `root_dir` and answers retrieve() with one exact, vectorised
+    cosine top-k. Removed entries are tombstoned and the matrix is rewritten once they make up
+    `compaction_ratio` of its rows.
+    :parameter root_dir: Directory holding one sub-directory per parent_doc_id.
+    :parameter embedding_size: The dimension of the stored embeddings.
+    :parameter size: The number of entries returned by retrieve.
+    :parameter compaction_ratio: The fraction of tombstoned rows that triggers a compaction.
+    :parameter quantization: None scans the float32 matrix, "int8" or "binary" scan quantized codes of the
+        rows first and rescore the best `rescore_window` candidates against the float32 matrix, so only
+        those rows of it are read.
+    :parameter rescore_window: The number of quantized candidates rescored, defaults to 4 times the size.
+    """
+
+    def __init__(self,
+                 root_dir: str,
+                 embedding_size: int,
+                 size=25,
+                 compaction_ratio=0.25,
+                 quantization: str = None,
+                 rescore_window: int = None):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization: {quantization}")
+        self.root_dir = root_dir
+        self.embedding_size = embedding_size
+        self.size = size
+        self.compaction_ratio = compaction_ratio
+        self.quantization = quantization
+        self.rescore_window = rescore_window
+        self._associations = {}
+        self._lock = threading.RLock()
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def destruct(self):
+        with self._lock:
+            self._associations = {}
+            shutil.rmtree(self.root_dir, ignore_errors=True)
+
+    def clear(self):
+        self.destruct()
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def _association(self, doc_id: str) -> _NumpyAssociation:
+        if doc_id not in self._associations:
+            path = os.path.join(self.root_dir, quote(doc_id, safe=""))
+            self._associations[doc_id] = _NumpyAssociation(path, self.embedding_size, self.quantization)
+        return self._associations[doc_id]
+
+    def _maybe_compact(self, association: _NumpyAssociation):
+        if association.ids and association.tombstones / len(association.ids) >= self.compaction_ratio:
+            with stage("compact", len(association.ids)):
+                association.compact()
+
+    def store(self, doc_id: str, embeddings: List[EmbeddingEntry], *args, **kwargs):
+        if not embeddings:
+            return
+        with self._lock:
+            association = self._association(doc_id)
+            association.append(embeddings)
+            self._maybe_compact(association)
+
+    def retrieve(self, doc_id, embedding: List[float], metadata: dict = None, size: int = None,
+                 entry_ids: List[str] = None, *args, **kwargs) -> [EmbeddingEntry]:
+        with self._lock:
+            association = self._association(doc_id)
+            size = size or self.size
+            rows, scores = association.search(embedding, metadata, size, self.rescore_window or 4 * size, entry_ids)
+            result = []
+            for row, score in zip(rows, scores):
+                entry = EmbeddingEntry(
+                    association.ids[row],
+                    association.matrix[row].tolist(),
+                    dict(association.metadata[row]),
+                    association.texts[row],
+                )
+                entry.metadata["__rank"] = float(score)
+                result.append(entry)
+            return result
+
+    def remove_by_ids(self, doc_id: str, embedding_ids: List[str], *args, **kwargs):
+        with self._lock:
+            association = self._association(doc_id)
+            if association.remove(embedding_ids):
+                self._maybe_compact(association)
+        return True
+
+    def remove_where(self, doc_id: str, metadata: dict = None, *args, **kwargs) -> Optional[str]:
+        with self._lock:
+            association = self._association(doc_id)
+            embedding_ids = [association.ids[row] for row in np.flatnonzero(association.alive)
+                             if matches_metadata(association.metadata[row], metadata)]
+            self.remove_by_ids(doc_id, embedding_ids)
+        return None
@@ -1,5 +1,19 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+import asyncio
+import contextvars
+import hashlib
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
 from qa_engine.core.models import TextEntry, EmbeddingEntry
+from qa_engine.utils.tokens import estimate_tokens
+from qa_engine.utils.stages import stage
 # from sentence_transformers import SentenceTransformer
 from openai import Embedding as OpenAIEmbedding
 import openai
@@ -10,6 +24,13 @@ class EmbeddingOperator(ABC):
     def embed(self, entries: [TextEntry], *args, **kwargs) -> [EmbeddingEntry]:
         pass
 
+    async def aembed(self, entries: [TextEntry], *args, **kwargs) -> [EmbeddingEntry]:
+        """
+        Asynchronous embed, operators with a native async client override it, the others are run in
+        a worker thread.
+        """
+        return await asyncio.to_thread(self.embed, entries, *args, **kwargs)
+
 
 # class ModelEmbeddingOperator(EmbeddingOperator):
 #
@@ -32,18 +53,104 @@ class EmbeddingOperator(ABC):
 
 
 class OpenAIEmbeddingOperator(EmbeddingOperator):
+    """
+    Embeds entries with the OpenAI embeddings API. Inputs are split into batches bounded by
+    `max_batch_size` items and `max_batch_tokens` estimated tokens, the batches are sent over at most
+    `max_workers` concurrent requests and throttled or failed batches are retried with exponential
+    backoff. Results are returned in input order.
+    :parameter api_base: Overrides the API endpoint, e.g. for a proxy or a local stub server.
+    """
+
+    retryable_errors = (
+        openai.error.RateLimitError,
+        openai.error.APIError,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+    )
 
-    def __init__(self, model_name: str, openai_key: str, organization: str):
+    def __init__(self,
+                 model_name: str,
+                 openai_key: str,
+                 organization: str,
+                 max_batch_size=512,
+                 max_batch_tokens=64_000,
+                 max_workers=4,
+                 max_retries=5,
+                 backoff=1.0,
+                 max_backoff=30.0,
+                 api_base: str = None):
         self.model_name = model_name
+        self.openai_key = openai_key
+        self.organization = organization
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.api_base = api_base
         openai.api_key = openai_key
         openai.organization = organization
 
-    def embed(self, entries: [TextEntry], *args, **kwargs) -> [EmbeddingEntry]:
-        embeddings = OpenAIEmbedding.create(
-            model=self.model_name,
-            input=[entry.text for entry in entries]
-        )["data"]
-        embeddings = [embedding["embedding"] for embedding in embeddings]
+    def _batches(self, texts: List[str]) -> List[List[int]]:
+        batches = []
+        batch, batch_tokens = [], 0
+        for i, text in enumerate(texts):
+            tokens = estimate_tokens(text)
+            if batch and (len(batch) >= self.max_batch_size or batch_tokens + tokens > self.max_batch_tokens):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _request_params(self, texts: List[str]) -> dict:
+        return {
+            "model": self.model_name,
+            "input": texts,
+            "api_key": self.openai_key,
+            "organization": self.organization,
+            "api_base": self.api_base,
+        }
+
+    @staticmethod
+    def _parse(response) -> List[List[float]]:
+        return [embedding["embedding"] for embedding in sorted(response["data"], key=lambda x: x["index"])]
+
+    def _delay(self, attempt: int) -> float:
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * (0.5 + random.random() / 2)
+
+    def _create(self, texts: List[str]) -> List[List[float]]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                with stage("openai_embedding", len(texts)):
+                    return self._parse(OpenAIEmbedding.create(**self._request_params(texts)))
+            except self.retryable_errors:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._delay(attempt))
+
+    async def _acreate(self, texts: List[str], semaphore: asyncio.Semaphore) -> List[List[float]]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with semaphore:
+                    with stage("openai_embedding", len(texts)):
+                        return self._parse(await OpenAIEmbedding.acreate(**self._request_params(texts)))
+            except self.retryable_errors:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._delay(attempt))
+
+    def _to_entries(self, entries: [TextEntry], batches: List[List[int]], results) -> [EmbeddingEntry]:
+        embeddings = [None] * len(entries)
+        for batch, batch_embeddings in zip(batches, results):
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
         return [
             EmbeddingEntry(
                 id=entry.id,
@@ -52,6 +159,158 @@ class OpenAIEmbeddingOperator(EmbeddingOperator):
             ) for entry, embedding in
             zip(entries, embeddings)]
 
+    def embed(self, entries: [TextEntry], *args, **kwargs) -> [EmbeddingEntry]:
+        texts = [entry.text for entry in entries]
+        batches = self._batches(texts)
+        if len(batches) <= 1 or self.max_workers <= 1:
+            results = [self._create([texts[i] for i in batch]) for batch in batches]
+        else:
+            # every batch runs in a copy of the caller's context so that its stage observers see the requests
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, self._create, [texts[i] for i in batch])
+                           for batch in batches]
+                results = [future.result() for future in futures]
+        return self._to_entries(entries, batches, results)
+
+    async def aembed(self, entries: [TextEntry], *args, **kwargs) -> [EmbeddingEntry]:
+        texts = [entry.text for entry in entries]
+        batches = self._batches(texts)
+        semaphore = asyncio.Semaphore(max(1, self.max_workers))
+        results = await asyncio.gather(*[self._acreate([texts[i] for i in batch], semaphore) for batch in batches])
+        return self._to_entries(entries, batches, results)
+
+
+class CachedEmbeddingOperator(EmbeddingOperator):
+    """
+    Wraps an EmbeddingOperator with a persistent, content-addressed embedding cache. Entries are keyed
+    on (model name, sha256 of the text) and kept as float32 blobs in a local sqlite file, evicting
+    the least recently used ones beyond `max_entries`. Only cache misses reach the wrapped operator.
+    :parameter operator: The operator used to embed cache misses.
+    :parameter path: The sqlite file backing the cache.
+    :parameter max_entries: The maximum number of cached embeddings.
+    """
+
+    def __init__(self, operator: EmbeddingOperator, path: str, max_entries=1_000_000):
+        self.operator = operator
+        self.model_name = getattr(operator, "model_name", type(operator).__name__)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_access REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _key(self, text: str) -> str:
+        return f"{self.model_name}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def _lookup(self, keys: List[str]) -> dict:
+        found = {}
+        # stay below sqlite's bound parameter limit
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._db.execute(
+                f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})", batch).fetchall()
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        if found:
+            now = time.time()
+            self._db.executemany("UPDATE embeddings SET last_access = ? WHERE key = ?",
+                                 [(now, key) for key in found])
+        return found
+
+    def _insert(self, embeddings: dict):
+        now = time.time()
+        before = self._db.total_changes
+        self._db.executemany(
+            "INSERT OR IGNORE INTO embeddings (key, embedding, last_access) VALUES (?, ?, ?)",
+            [(key, np.asarray(embedding, dtype=np.float32).tobytes(), now)
+             for key, embedding in embeddings.items()])
+        self._size += self._db.total_changes - before
+        if self._size > self.max_entries:
+            self._db.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+                (self._size - self.max_entries,))
+            self._size = self.max_entries
+
+    def _split(self, entries: [TextEntry]):
+        keys = [self._key(entry.text) for entry in entries]
+        with self._lock:
+            cached = self._lookup(list(set(keys)))
+            self._db.commit()
+        # identical texts within the same call are only embedded once
+        missing = {}
+        for key, entry in zip(keys, entries):
+            if key not in cached and key not in missing:
+                missing[key] = entry
+        with self._lock:
+            self.hits += len(entries) - len(missing)
+            self.misses += len(missing)
+        return keys, cached, missing
+
+    def _merge(self, entries: [TextEntry], keys: List[str], cached: dict, missing: dict,
+               embedded: [EmbeddingEntry]) -> [EmbeddingEntry]:
+        if missing:
+            fresh = {key: embedding_entry.embedding for key, embedding_entry in zip(missing, embedded)}
+            with self._lock:
+                self._insert(fresh)
+                self._db.commit()
+            cached.update(fresh)
+        return [
+            EmbeddingEntry(
+                id=entry.id,
+                embedding=cached[key],
+                metadata=entry.metadata
+            ) for entry, key in
+            zip(entries, keys)]
+
+    def embed(self, entries: [TextEntry], *args, **kwargs) -> [EmbeddingEntry]:
+        keys, cached, missing = self._split(entries)
+        embedded = self.operator.embed(list(missing.values()), *args, **kwargs) if missing else []
+        return self._merge(entries, keys, cached, missing, embedded)
+
+    async def aembed(self, entries: [TextEntry], *args, **kwargs) -> [EmbeddingEntry]:
+        # the sqlite lookups and inserts block, they run off the event loop
+        keys, cached, missing = await asyncio.to_thread(self._split, entries)
+        embedded = await self.operator.aembed(list(missing.values()), *args, **kwargs) if missing else []
+        return await asyncio.to_thread(self._merge, entries, keys, cached, missing, embedded)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class HashEmbeddingOperator(EmbeddingOperator):
+    """
+    Deterministic offline embedding operator: every word is hashed onto one of `embedding_size`
+    dimensions, so texts sharing words have a high cosine similarity. Used by the tests and the benchmarks.
+    """
+    model_name = "hash-embedding"
+
+    def __init__(self, embedding_size=64):
+        self.embedding_size = embedding_size
+        self.calls = 0
+
+    def _embedding(self, text: str) -> List[float]:
+        vector = np.zeros(self.embedding_size, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.embedding_size] += 1.0
+        return vector.tolist()
+
+    def embed(self, entries: [TextEntry], *args, **kwargs) -> [EmbeddingEntry]:
+        self.calls += 1
+        return [EmbeddingEntry(entry.id, self._embedding(entry.text), entry.metadata) for entry in entries]
+
 
 if __name__ == '__main__':
     # operator = ModelEmbeddingOperator('../artifacts/distiluse-base-multilingual-cased-v1')
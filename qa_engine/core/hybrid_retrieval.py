@@ -0,0 +1,63 @@
+from dataclasses import dataclass
+from typing import List, Optional
+from qa_engine.core.models import TextEntry
+
+
+@dataclass
+class HybridRetrieval:
+    """
+    Configuration of the hybrid retrieval of CachingStrategy.find: a BM25 query on the text of the document
+    factory and the vector search each produce candidates, fused with weighted reciprocal rank fusion.
+    :parameter lexical_weight: Weight of the lexical ranking in the fusion, 0 disables its contribution.
+    :parameter vector_weight: Weight of the vector ranking in the fusion.
+    :parameter rrf_k: Rank constant of the fusion, larger values flatten the contribution of the top ranks.
+    :parameter lexical_size: The number of lexical candidates fused.
+    :parameter prefilter_size: If set and the lexical query matches at least this many entries, the vector
+        search only scores the top `prefilter_size` lexical candidates instead of the whole association.
+    """
+    lexical_weight: float = 1.0
+    vector_weight: float = 1.0
+    rrf_k: int = 60
+    lexical_size: int = 25
+    prefilter_size: Optional[int] = None
+
+    @property
+    def lexical_request_size(self) -> int:
+        return max(self.lexical_size, self.prefilter_size or 0)
+
+    def prefilter_ids(self, lexical_entries: List[TextEntry]) -> Optional[List[str]]:
+        """
+        The entry ids the vector search is restricted to, None when it should not be narrowed.
+        """
+        if self.prefilter_size is None or len(lexical_entries) < self.prefilter_size:
+            return None
+        return [entry.id for entry in lexical_entries[:self.prefilter_size]]
+
+    def fuse(self, vector_entries: List[TextEntry], lexical_entries: List[TextEntry]) -> List[TextEntry]:
+        """
+        Reciprocal rank fusion of both rankings, the fused score replaces the "__rank" of the entries.
+        """
+        return reciprocal_rank_fusion(
+            [vector_entries, lexical_entries[:self.lexical_size]],
+            [self.vector_weight, self.lexical_weight],
+            self.rrf_k,
+        )
+
+
+def reciprocal_rank_fusion(rankings: List[List[TextEntry]], weights: List[float], rrf_k=60) -> List[TextEntry]:
+    """
+    Fuses rankings of text entries by summing weight / (rrf_k + rank) over the rankings containing an entry.
+    Entries are returned best first with the fused score in metadata["__rank"], the entry of the first
+    ranking containing an id is kept.
+    """
+    scores, entries = {}, {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, entry in enumerate(ranking, start=1):
+            entries.setdefault(entry.id, entry)
+            scores[entry.id] = scores.get(entry.id, 0.0) + weight / (rrf_k + rank)
+    result = []
+    for entry_id in sorted(scores, key=lambda entry_id: -scores[entry_id]):
+        entry = entries[entry_id]
+        entry.metadata["__rank"] = scores[entry_id]
+        result.append(entry)
+    return result
@@ -4,29 +4,253 @@
 ######################################################
 
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
+import threading
+import time
 from qa_engine.core.caching_strategy import CachingStrategy
 from qa_engine.core.answer_strategy import AnswerStrategy
-from qa_engine.core.models import Document
+from qa_engine.core.models import Document, TextEntry
+from qa_engine.core.result_cache import ResultCache
+from qa_engine.utils.stages import stage
+
+
+class RemovalTasks:
+    """
+    The background removal tasks started by IRSystem.remove_objects that did not complete yet, by
+    (namespace, doc_id). IRSystems over the same indices share one to see each other's removals.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, Tuple[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, namespace: str, doc_id: str, task_ids: List[str]):
+        with self._lock:
+            for task_id in task_ids:
+                self._tasks[task_id] = (namespace, doc_id)
+
+    def pending(self, namespace: str, doc_id: str) -> List[str]:
+        with self._lock:
+            return [task_id for task_id, key in self._tasks.items() if key == (namespace, doc_id)]
+
+    def done(self, task_id: str) -> Optional[Tuple[str, str]]:
+        """
+        Forgets a finished task, returns the (namespace, doc_id) it removed from if it was known.
+        """
+        with self._lock:
+            return self._tasks.pop(task_id, None)
 
 
 class IRSystem(ABC):
+    """
+    :parameter result_cache: Optional cache of find results, invalidated per doc_id whenever
+        index_document or remove_by_ids changes it.
+    :parameter cache_namespace: Separates the results of IRSystems sharing the same result cache,
+        e.g. the index name.
+    :parameter removal_tasks: The running removal tasks, shared by the IRSystems of the same indices. While a
+        doc_id has one, its find results are not cached and index_document waits for it to complete.
+    :parameter removal_poll_seconds: The interval at which index_document polls the running removal tasks.
+    """
 
     def __init__(self,
                  caching_strategy: CachingStrategy,
-                 answer_strategy: AnswerStrategy):
+                 answer_strategy: AnswerStrategy,
+                 result_cache: ResultCache = None,
+                 cache_namespace: str = "",
+                 removal_tasks: RemovalTasks = None,
+                 removal_poll_seconds=0.5):
         self.caching_strategy = caching_strategy
         self.answer_strategy = answer_strategy
+        self.result_cache = result_cache
+        self.cache_namespace = cache_namespace
+        self.removal_tasks = removal_tasks or RemovalTasks()
+        self.removal_poll_seconds = removal_poll_seconds
+
+    def _invalidate(self, doc_id: str):
+        if self.result_cache is not None:
+            self.result_cache.invalidate(self.cache_namespace, doc_id)
+
+    def _removal_pending(self, doc_id: str) -> bool:
+        """
+        Whether removal tasks of doc_id are still running, polling them so the completed ones invalidate it.
+        """
+        for task_id in self.removal_tasks.pending(self.cache_namespace, doc_id):
+            self.removal_status(task_id)
+        return bool(self.removal_tasks.pending(self.cache_namespace, doc_id))
+
+    async def _aremoval_pending(self, doc_id: str) -> bool:
+        if not self.removal_tasks.pending(self.cache_namespace, doc_id):
+            return False
+        return await asyncio.to_thread(self._removal_pending, doc_id)
 
     def index_document(self, document: Document, *args, **kwargs):
-        self.caching_strategy.cache(document)
+        # a removal still running would delete the entries of re-indexed objects that are skipped as unchanged
+        while self._removal_pending(document.id):
+            time.sleep(self.removal_poll_seconds)
+        try:
+            self.caching_strategy.cache(document, *args, **kwargs)
+        finally:
+            self._invalidate(document.id)
+
+    def remove_by_ids(self, doc_id: str, entry_ids: List[str], *args, **kwargs) -> bool:
+        try:
+            return self.caching_strategy.remove_by_ids(doc_id, entry_ids, *args, **kwargs)
+        finally:
+            self._invalidate(doc_id)
+
+    def remove_objects(self, doc_id: str, obj_ids: List[str] = None) -> Dict[str, str]:
+        """
+        Removes source objects, or the whole association when obj_ids is None, and returns the ids of the
+        removal tasks still running, see CachingStrategy.remove_objects.
+        """
+        try:
+            tasks = self.caching_strategy.remove_objects(doc_id, obj_ids)
+            self.removal_tasks.add(self.cache_namespace, doc_id, list(tasks.values()))
+            return tasks
+        finally:
+            self._invalidate(doc_id)
+
+    def removal_status(self, task_id: str) -> Optional[dict]:
+        status = self.caching_strategy.removal_status(task_id)
+        if status is None or status["completed"]:
+            key = self.removal_tasks.done(task_id)
+            # results cached while the task was running may still hold removed entries
+            if key is not None and self.result_cache is not None:
+                self.result_cache.invalidate(*key)
+        return status
+
+    def bulk_load(self, force_merge_segments: int = None):
+        return self.caching_strategy.bulk_load(force_merge_segments)
+
+    def restore_bulk_load(self) -> bool:
+        return self.caching_strategy.restore_bulk_load()
 
     def find(self, doc_id: str, query: str, metadata: dict = None, formulate_answer=True, *args, **kwargs) -> dict:
-        entries = self.caching_strategy.find(doc_id, query, metadata)
-        return {
+        if self.result_cache is not None:
+            key = self.result_cache.key(self.cache_namespace, doc_id, query, metadata, formulate_answer)
+            result = self.result_cache.get(key)
+            if result is not None:
+                return result
+        with stage("retrieve"):
+            entries = self.caching_strategy.find(doc_id, query, metadata)
+        answer = None
+        if formulate_answer:
+            with stage("answer", len(entries)):
+                answer = self.answer_strategy.formulate_answer(query, entries)
+        result = {
+            "resources": entries,
+            "query": query,
+            "answer": answer,
+        }
+        if self.result_cache is not None and not self._removal_pending(doc_id):
+            self.result_cache.put(key, result)
+        return result
+
+    async def afind(self, doc_id: str, query: str, metadata: dict = None, formulate_answer=True, *args,
+                    **kwargs) -> dict:
+        if self.result_cache is not None:
+            key = self.result_cache.key(self.cache_namespace, doc_id, query, metadata, formulate_answer)
+            result = self.result_cache.get(key)
+            if result is not None:
+                return result
+        with stage("retrieve"):
+            entries = await self.caching_strategy.afind(doc_id, query, metadata)
+        answer = None
+        if formulate_answer:
+            with stage("answer", len(entries)):
+                answer = await self.answer_strategy.aformulate_answer(query, entries)
+        result = {
             "resources": entries,
             "query": query,
-            "answer": self.answer_strategy.formulate_answer(query, entries) if formulate_answer else None
+            "answer": answer,
         }
+        if self.result_cache is not None and not await self._aremoval_pending(doc_id):
+            self.result_cache.put(key, result)
+        return result
+
+    def _cached_results(self, queries: List[Tuple[str, str, Optional[dict]]], formulate_answer: bool):
+        """
+        The cached result of every query (None when missing) and the result cache keys.
+        """
+        if self.result_cache is None:
+            return [None] * len(queries), [None] * len(queries)
+        keys = [self.result_cache.key(self.cache_namespace, doc_id, query, metadata, formulate_answer)
+                for doc_id, query, metadata in queries]
+        return [self.result_cache.get(key) for key in keys], keys
+
+    def _store_results(self, queries, results: List[Optional[dict]], keys, missing: List[int],
+                       found: List[List[TextEntry]], answers: List[Optional[str]], pending: Set[str]) -> List[dict]:
+        """
+        Fills in the results of the missing queries and caches those of the doc_ids without pending removals.
+        """
+        for i, entries, answer in zip(missing, found, answers):
+            results[i] = {
+                "resources": entries,
+                "query": queries[i][1],
+                "answer": answer,
+            }
+            if self.result_cache is not None and queries[i][0] not in pending:
+                self.result_cache.put(keys[i], results[i])
+        return results
+
+    def find_many(self, queries: List[Tuple[str, str, Optional[dict]]], formulate_answer=True, max_workers=8,
+                  *args, **kwargs) -> List[dict]:
+        """
+        Batch variant of find for (doc_id, query, metadata) tuples, the retrieval of the queries missing from
+        the result cache is batched by the caching strategy and their answers formulated concurrently.
+        """
+        results, keys = self._cached_results(queries, formulate_answer)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if not missing:
+            return results
+        with stage("retrieve", len(missing)):
+            found = self.caching_strategy.find_many([queries[i] for i in missing])
+        answers = [None] * len(missing)
+        if formulate_answer:
+            with stage("answer", len(missing)), ThreadPoolExecutor(max_workers=max_workers) as executor:
+                answers = list(executor.map(self.answer_strategy.formulate_answer,
+                                            [queries[i][1] for i in missing], found))
+        pending = {doc_id for doc_id in {queries[i][0] for i in missing} if self._removal_pending(doc_id)}
+        return self._store_results(queries, results, keys, missing, found, answers, pending)
+
+    async def afind_many(self, queries: List[Tuple[str, str, Optional[dict]]], formulate_answer=True, *args,
+                         **kwargs) -> List[dict]:
+        results, keys = self._cached_results(queries, formulate_answer)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if not missing:
+            return results
+        with stage("retrieve", len(missing)):
+            found = await asyncio.to_thread(self.caching_strategy.find_many, [queries[i] for i in missing])
+        answers = [None] * len(missing)
+        if formulate_answer:
+            with stage("answer", len(missing)):
+                answers = await asyncio.gather(*[self.answer_strategy.aformulate_answer(queries[i][1], entries)
+                                                 for i, entries in zip(missing, found)])
+        pending = set()
+        for doc_id in {queries[i][0] for i in missing}:
+            if await self._aremoval_pending(doc_id):
+                pending.add(doc_id)
+        return self._store_results(queries, results, keys, missing, found, answers, pending)
+
+    async def astream_find(self, doc_id: str, query: str, metadata: dict = None, formulate_answer=True, *args,
+                           **kwargs):
+        """
+        Streaming variant of find yielding (event, payload) pairs: "resources" as soon as retrieval
+        finishes, one "answer" per answer token and a final "done" with the full answer.
+        """
+        with stage("retrieve"):
+            entries = await self.caching_strategy.afind(doc_id, query, metadata)
+        yield "resources", {"resources": entries, "query": query}
+        answer = None
+        if formulate_answer:
+            tokens = []
+            async for token in self.answer_strategy.astream_answer(query, entries):
+                tokens.append(token)
+                yield "answer", {"token": token}
+            answer = "".join(tokens).strip()
+        yield "done", {"answer": answer}
 
 
 class BookIRSystem(IRSystem):
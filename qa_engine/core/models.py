@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Optional
 
 
 @dataclass
@@ -26,3 +27,6 @@ class EmbeddingEntry:
     id: str
     embedding: list
     metadata: dict
+    # source text, kept next to the vector by factories that co-locate it
+    text: Optional[str] = None
+
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+from typing import List, Optional
+import numpy as np
+from qa_engine.utils.cache import LRUCache
+
+
+class ResultCache:
+    """
+    Cache of IRSystem.find results keyed by (namespace, doc_id, normalized query, filters,
+    formulate_answer). Every (namespace, doc_id) has a generation number that is bumped whenever its
+    entries change, which invalidates all of its cached results at once. At most `max_size` generations are
+    kept, the doc_ids whose generation was evicted share a floor generation that is bumped on every eviction.
+    :parameter max_size: The maximum number of cached results.
+    :parameter ttl: Seconds after which a cached result expires.
+    """
+
+    def __init__(self, max_size=10000, ttl: Optional[float] = 300):
+        self._results = LRUCache(max_size, ttl)
+        self._generations = LRUCache(max_size)
+        self._generation = 0
+        self._floor = 0
+        self._lock = threading.Lock()
+        self.invalidations = 0
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    def key(self, namespace: str, doc_id: str, query: str, metadata: Optional[dict], formulate_answer: bool):
+        """
+        Builds the cache key of a query. It captures the current generation of the doc_id, so taking
+        it before computing a result keeps a concurrent invalidation from being overwritten.
+        """
+        filters = json.dumps(metadata, sort_keys=True, default=str) if metadata else None
+        generation = self._generations.get((namespace, doc_id), self._floor)
+        return namespace, doc_id, generation, self.normalize_query(query), filters, bool(formulate_answer)
+
+    def get(self, key) -> Optional[dict]:
+        result = self._results.get(key)
+        return dict(result) if result is not None else None
+
+    def put(self, key, result: dict):
+        self._results.put(key, dict(result))
+
+    def invalidate(self, namespace: str, doc_id: str):
+        with self._lock:
+            # generations only grow, so an evicted doc_id never gets back one of its cached results
+            self._generation += 1
+            evictions = self._generations.evictions
+            self._generations.put((namespace, doc_id), self._generation)
+            if self._generations.evictions != evictions:
+                self._generation += 1
+                self._floor = self._generation
+            self.invalidations += 1
+
+    def clear(self):
+        self._results.clear()
+
+    def stats(self) -> dict:
+        stats = self._results.stats()
+        stats["invalidations"] = self.invalidations
+        return stats
+
+
+class QueryEmbeddingCache:
+    """
+    In-memory LRU of query embeddings keyed by (model, normalized query) and stored as compact
+    float32 arrays. It can be saved to and warm-loaded from an .npz file.
+    :parameter max_size: The maximum number of cached query embeddings.
+    :parameter path: Optional .npz file loaded on creation when it exists.
+    """
+
+    def __init__(self, max_size=10000, path: Optional[str] = None):
+        self._embeddings = LRUCache(max_size)
+        self.path = path
+        if path and os.path.exists(path):
+            self.load(path)
+
+    @staticmethod
+    def _key(model: str, query: str) -> str:
+        return f"{model}\x1f{ResultCache.normalize_query(query)}"
+
+    def get(self, model: str, query: str) -> Optional[List[float]]:
+        embedding = self._embeddings.get(self._key(model, query))
+        return embedding.tolist() if embedding is not None else None
+
+    def put(self, model: str, query: str, embedding: List[float]):
+        self._embeddings.put(self._key(model, query), np.asarray(embedding, dtype=np.float32))
+
+    def save(self, path: Optional[str] = None):
+        path = path or self.path
+        items = self._embeddings.items()
+        keys = np.array([key for key, _ in items], dtype=str)
+        lengths = np.array([len(embedding) for _, embedding in items], dtype=np.int64)
+        values = np.concatenate([embedding for _, embedding in items]) if items else np.zeros(0, np.float32)
+        with open(path, "wb") as f:
+            np.savez(f, keys=keys, lengths=lengths, values=values)
+
+    def load(self, path: str):
+        with np.load(path) as data:
+            offsets = np.concatenate([[0], np.cumsum(data["lengths"])])
+            values = data["values"]
+            # least recently used first, so the saved order is preserved
+            for i, key in enumerate(data["keys"].tolist()):
+                self._embeddings.put(key, values[offsets[i]:offsets[i + 1]].copy())
+
+    def stats(self) -> dict:
+        return self._embeddings.stats()
@@ -0,0 +1,55 @@
+from qa_engine.core.embedding_operator import EmbeddingOperator, CachedEmbeddingOperator
+from qa_engine.core.models import TextEntry, EmbeddingEntry
+import pytest
+
+
+class CountingEmbeddingOperator(EmbeddingOperator):
+    model_name = "counting-model"
+
+    def __init__(self):
+        self.embedded_texts = []
+
+    def embed(self, entries: [TextEntry], *args, **kwargs) -> [EmbeddingEntry]:
+        self.embedded_texts += [entry.text for entry in entries]
+        return [EmbeddingEntry(entry.id, [float(len(entry.text)), 1.0], entry.metadata) for entry in entries]
+
+
+@pytest.fixture()
+def operator():
+    return CountingEmbeddingOperator()
+
+
+def entries(*texts):
+    return [TextEntry(str(i), text, {"i": i}) for i, text in enumerate(texts)]
+
+
+def test_only_misses_are_embedded(operator, tmp_path):
+    cached_operator = CachedEmbeddingOperator(operator, str(tmp_path / "cache.sqlite"))
+    first = cached_operator.embed(entries("hello", "world", "hello"))
+    assert operator.embedded_texts == ["hello", "world"]
+    assert [e.embedding for e in first] == [[5.0, 1.0], [5.0, 1.0], [5.0, 1.0]]
+    assert [e.metadata for e in first] == [{"i": 0}, {"i": 1}, {"i": 2}]
+
+    second = cached_operator.embed(entries("world", "again"))
+    assert operator.embedded_texts == ["hello", "world", "again"]
+    assert [e.id for e in second] == ["0", "1"]
+    assert cached_operator.hits == 2
+    assert cached_operator.misses == 3
+
+
+def test_cache_is_persistent(operator, tmp_path):
+    CachedEmbeddingOperator(operator, str(tmp_path / "cache.sqlite")).embed(entries("hello"))
+    reopened = CachedEmbeddingOperator(operator, str(tmp_path / "cache.sqlite"))
+    assert reopened.embed(entries("hello"))[0].embedding == [5.0, 1.0]
+    assert operator.embedded_texts == ["hello"]
+
+
+def test_lru_eviction(operator, tmp_path):
+    cached_operator = CachedEmbeddingOperator(operator, str(tmp_path / "cache.sqlite"), max_entries=2)
+    cached_operator.embed(entries("a"))
+    cached_operator.embed(entries("b"))
+    cached_operator.embed(entries("a"))
+    cached_operator.embed(entries("c"))
+    # "b" was the least recently used entry
+    cached_operator.embed(entries("a", "b"))
+    assert operator.embedded_texts == ["a", "b", "c", "b"]
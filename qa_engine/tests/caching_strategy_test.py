@@ -0,0 +1,243 @@
+from qa_engine.core.caching_strategy import JSONChunkingCachingStrategy
+from qa_engine.core.document_operator import BasicDocumentOperator
+from qa_engine.core.embedding_factory import NumpyEmbeddingFactory
+from qa_engine.core.hybrid_retrieval import HybridRetrieval, reciprocal_rank_fusion
+from qa_engine.core.models import Document, TextEntry
+from qa_engine.core.result_cache import QueryEmbeddingCache
+from qa_engine.tests.fakes import HashEmbeddingOperator, InMemoryDocumentFactory
+import asyncio
+import pytest
+
+doc_id = "test_doc_id"
+
+objects = [
+    {"id": "apple", "description": "Apples are red or green fruits that grow on trees in orchards."},
+    {"id": "car", "description": "Cars are vehicles with four wheels and an engine that burns fuel."},
+    {"id": "sea", "description": "The sea is a large body of salt water that covers most of the earth."},
+]
+
+
+@pytest.fixture()
+def strategy(tmp_path):
+    return build_strategy(tmp_path)
+
+
+def build_strategy(tmp_path, query_embedding_cache=None, hybrid_retrieval=None):
+    embedding_operator = HashEmbeddingOperator()
+    return JSONChunkingCachingStrategy(
+        embedding_factory=NumpyEmbeddingFactory(str(tmp_path / "embs"), embedding_operator.embedding_size),
+        document_factory=InMemoryDocumentFactory(),
+        embedding_operator=embedding_operator,
+        document_operator=BasicDocumentOperator(),
+        text_keys=["description"],
+        id_key="id",
+        query_embedding_cache=query_embedding_cache,
+        hybrid_retrieval=hybrid_retrieval,
+    )
+
+
+def test_find(strategy):
+    strategy.cache(Document(doc_id, data=objects))
+    entries = strategy.find(doc_id, "which vehicles have four wheels")
+    assert len(entries) == 3
+    assert entries[0].metadata["obj_id"] == "car"
+
+
+def test_afind_matches_find(strategy):
+    strategy.cache(Document(doc_id, data=objects))
+    entries = strategy.find(doc_id, "salt water of the sea")
+    async_entries = asyncio.run(strategy.afind(doc_id, "salt water of the sea"))
+    assert [e.metadata["obj_id"] for e in async_entries] == [e.metadata["obj_id"] for e in entries]
+    assert [e.metadata["rank_score"] for e in async_entries] == [e.metadata["rank_score"] for e in entries]
+
+
+def test_query_embedding_cache(tmp_path):
+    query_embedding_cache = QueryEmbeddingCache(max_size=10)
+    strategy = build_strategy(tmp_path, query_embedding_cache)
+    strategy.cache(Document(doc_id, data=objects))
+    calls = strategy.embedding_operator.calls
+
+    entries = strategy.find(doc_id, "Four wheels")
+    assert strategy.find(doc_id, "four   wheels", {"obj_id": "car"})[0].metadata["obj_id"] == "car"
+    assert asyncio.run(strategy.afind(doc_id, "four wheels"))[0].id == entries[0].id
+    assert strategy.embedding_operator.calls == calls + 1
+
+    query_embedding_cache.save(str(tmp_path / "queries.npz"))
+    warm_cache = QueryEmbeddingCache(max_size=10, path=str(tmp_path / "queries.npz"))
+    expected = query_embedding_cache.get("hash-embedding", "FOUR wheels")
+    assert warm_cache.get("hash-embedding", "four wheels") == expected
+    assert warm_cache.get("other-model", "four wheels") is None
+
+
+def test_find_uses_colocated_text(strategy, monkeypatch):
+    strategy.cache(Document(doc_id, data=objects))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the document factory should not be queried")
+
+    monkeypatch.setattr(strategy.document_factory, "retrieve", fail)
+    monkeypatch.setattr(strategy.document_factory, "get_by_ids", fail)
+    entries = strategy.find(doc_id, "which vehicles have four wheels")
+    assert entries[0].metadata["obj_id"] == "car"
+    assert "four wheels" in entries[0].text
+
+
+def test_find_falls_back_to_document_factory(strategy):
+    strategy.cache(Document(doc_id, data=objects))
+    association = strategy.embedding_factory._association(doc_id)
+    association.texts = [None] * len(association.texts)
+    entries = strategy.find(doc_id, "which vehicles have four wheels")
+    assert entries[0].metadata["obj_id"] == "car"
+    assert "four wheels" in entries[0].text
+
+
+class EmbeddedTexts:
+    def __init__(self, operator):
+        self.texts = []
+        embed = operator.embed
+
+        def recording_embed(entries, *args, **kwargs):
+            self.texts += [entry.text for entry in entries]
+            return embed(entries, *args, **kwargs)
+
+        operator.embed = recording_embed
+
+
+def test_reingestion_is_incremental(strategy):
+    embedded = EmbeddedTexts(strategy.embedding_operator)
+    strategy.cache(Document(doc_id, data=objects))
+    first_ids = sorted(e.id for e in strategy.document_factory.retrieve(doc_id))
+    assert len(embedded.texts) == 3
+
+    # unchanged objects are skipped and keep their deterministic ids
+    strategy.cache(Document(doc_id, data=objects))
+    assert len(embedded.texts) == 3
+    assert sorted(e.id for e in strategy.document_factory.retrieve(doc_id)) == first_ids
+
+    # only the changed object is re-embedded and its old entries are replaced
+    changed = dict(objects[1], description="Trucks carry heavy loads across the country.")
+    strategy.cache(Document(doc_id, data=[objects[0], changed]))
+    assert embedded.texts[3:] == [changed["description"]]
+    car_entries = strategy.document_factory.retrieve(doc_id, metadata={"obj_id": "car"})
+    assert [e.text for e in car_entries] == [changed["description"]]
+    assert len(strategy.embedding_factory.retrieve(doc_id, [1.0] * 64)) == 3
+
+
+def test_reingestion_with_other_text_keys(strategy):
+    titled_objects = [dict(obj, title=obj["id"].capitalize()) for obj in objects]
+    strategy.cache(Document(doc_id, data=titled_objects))
+    assert {e.metadata["key"] for e in strategy.document_factory.retrieve(doc_id)} == {"description"}
+
+    # the same objects cached with another text key are re-chunked
+    strategy.text_keys = ["description", "title"]
+    strategy.cache(Document(doc_id, data=titled_objects))
+    entries = strategy.document_factory.retrieve(doc_id)
+    assert sorted(e.text for e in entries if e.metadata["key"] == "title") == ["Apple", "Car", "Sea"]
+    assert len(entries) == 6
+    assert len(strategy.embedding_factory.retrieve(doc_id, [1.0] * 64)) == 6
+
+
+def test_sync_removes_missing_objects(strategy):
+    strategy.cache(Document(doc_id, data=objects))
+    strategy.cache(Document(doc_id, data=objects[:1]), sync=True)
+    assert {e.metadata["obj_id"] for e in strategy.document_factory.retrieve(doc_id)} == {"apple"}
+    assert {e.metadata["obj_id"] for e in strategy.embedding_factory.retrieve(doc_id, [1.0] * 64)} == {"apple"}
+
+
+def test_entry_ids_are_unique_per_association(strategy):
+    strategy.cache(Document(doc_id, data=objects))
+    strategy.cache(Document("other_doc_id", data=objects))
+    ids = {e.id for e in strategy.document_factory.retrieve(doc_id)}
+    assert ids.isdisjoint(e.id for e in strategy.document_factory.retrieve("other_doc_id"))
+
+
+def test_objects_are_stored_once(tmp_path):
+    strategy = build_strategy(tmp_path)
+    strategy.object_factory = InMemoryDocumentFactory()
+    strategy.cache(Document(doc_id, data=objects))
+
+    assert all("obj" not in e.metadata for e in strategy.document_factory.retrieve(doc_id))
+    assert all("obj" not in e.metadata for e in strategy.embedding_factory.retrieve(doc_id, [1.0] * 64))
+    assert [e.metadata for e in strategy.object_factory.retrieve(doc_id)] == objects
+
+    entries = strategy.find(doc_id, "which vehicles have four wheels")
+    assert entries[0].metadata["obj"] == objects[1]
+    async_entries = asyncio.run(strategy.afind(doc_id, "which vehicles have four wheels"))
+    assert [e.metadata["obj"] for e in async_entries] == [e.metadata["obj"] for e in entries]
+
+    strategy.cache(Document(doc_id, data=objects[1:]), sync=True)
+    assert [e.id for e in strategy.object_factory.retrieve(doc_id)] == ["car", "sea"]
+
+
+def test_remove_objects(tmp_path):
+    strategy = build_strategy(tmp_path)
+    strategy.object_factory = InMemoryDocumentFactory()
+    strategy.cache(Document(doc_id, data=objects))
+    strategy.cache(Document("other_doc_id", data=objects))
+
+    # the local factories remove right away, there is no task left to poll
+    assert strategy.remove_objects(doc_id, ["car"]) == {}
+    assert {e.metadata["obj_id"] for e in strategy.document_factory.retrieve(doc_id)} == {"apple", "sea"}
+    assert {e.metadata["obj_id"] for e in strategy.embedding_factory.retrieve(doc_id, [1.0] * 64)} == {"apple", "sea"}
+    assert [e.id for e in strategy.object_factory.retrieve(doc_id)] == ["apple", "sea"]
+
+    strategy.remove_objects(doc_id)
+    assert strategy.document_factory.retrieve(doc_id) == []
+    assert strategy.embedding_factory.retrieve(doc_id, [1.0] * 64) == []
+    assert strategy.object_factory.retrieve(doc_id) == []
+    assert len(strategy.document_factory.retrieve("other_doc_id")) == 3
+
+
+def test_numeric_object_ids(strategy):
+    embedded = EmbeddedTexts(strategy.embedding_operator)
+    numbered_objects = [dict(obj, id=i) for i, obj in enumerate(objects)]
+    strategy.cache(Document(doc_id, data=numbered_objects))
+    strategy.cache(Document(doc_id, data=numbered_objects))
+    assert len(embedded.texts) == 3
+    assert {e.metadata["obj_id"] for e in strategy.document_factory.retrieve(doc_id)} == {"0", "1", "2"}
+
+    strategy.remove_objects(doc_id, [1])
+    assert {e.metadata["obj_id"] for e in strategy.document_factory.retrieve(doc_id)} == {"0", "2"}
+
+
+def test_reciprocal_rank_fusion():
+    def ranking(*ids):
+        return [TextEntry(entry_id, entry_id, {}) for entry_id in ids]
+
+    fused = reciprocal_rank_fusion([ranking("a", "b", "c"), ranking("c", "d")], [1.0, 1.0], rrf_k=1)
+    assert [e.id for e in fused] == ["c", "a", "b", "d"]
+    assert fused[0].metadata["__rank"] == pytest.approx(1 / 4 + 1 / 2)
+    fused = reciprocal_rank_fusion([ranking("a", "b", "c"), ranking("c", "d")], [1.0, 0.0], rrf_k=1)
+    assert [e.id for e in fused] == ["a", "b", "c", "d"]
+
+
+def test_hybrid_find(tmp_path):
+    strategy = build_strategy(tmp_path, hybrid_retrieval=HybridRetrieval(rrf_k=1))
+    strategy.cache(Document(doc_id, data=objects))
+    entries = strategy.find(doc_id, "engine fuel")
+    assert entries[0].metadata["obj_id"] == "car"
+    # fused with the lexical ranking, the car is first in both rankings
+    assert entries[0].metadata["rank_score"] == pytest.approx(1.0)
+    async_entries = asyncio.run(strategy.afind(doc_id, "engine fuel"))
+    assert [e.id for e in async_entries] == [e.id for e in entries]
+
+
+def test_hybrid_prefilter(tmp_path):
+    strategy = build_strategy(tmp_path, hybrid_retrieval=HybridRetrieval(prefilter_size=1))
+    strategy.cache(Document(doc_id, data=objects))
+    retrieve = strategy.embedding_factory.retrieve
+    restrictions = []
+
+    def recording_retrieve(*args, entry_ids=None, **kwargs):
+        restrictions.append(entry_ids)
+        return retrieve(*args, entry_ids=entry_ids, **kwargs)
+
+    strategy.embedding_factory.retrieve = recording_retrieve
+    entries = strategy.find(doc_id, "salt water")
+    assert [e.metadata["obj_id"] for e in entries] == ["sea"]
+    assert len(restrictions[0]) == 1
+
+    # without enough lexical candidates the vector search is not narrowed
+    entries = strategy.find(doc_id, "orbiting satellites")
+    assert restrictions[1] is None
+    assert len(entries) == 3
@@ -1,5 +1,7 @@
 from qa_engine.utils.path import get_absolute_path
-from qa_engine.utils.chunk import chunk_corpus, show_chunk
+from qa_engine.utils.chunk import chunk_corpus, show_chunk, iter_passages
+from qa_engine.utils.tokens import estimate_tokens
+import pytest
 
 
 def test_basic_chunking():
@@ -22,3 +24,37 @@ def test_basic_chunking():
     count_words = lambda sentence: len(sentence.split(" "))
     # for sentence in chunked_chunks[0]:
     #     assert count_words(sentence) <= sentence_word_count[1]
+
+
+def test_passages_are_token_bounded():
+    with open("assets/stalin.txt", "r") as f:
+        corpus = f.read()
+    passages = list(iter_passages(corpus, 64))
+
+    assert all(passage.tokens <= 64 for passage in passages)
+    assert all(corpus[passage.start:passage.end] == passage.text for passage in passages)
+    # without overlap the passages cover the corpus in order
+    assert all(previous.end <= passage.start for previous, passage in zip(passages, passages[1:]))
+    assert " ".join(passage.text for passage in passages).split() == corpus.split()
+
+
+def test_passage_overlap():
+    corpus = " ".join(f"Sentence number {i} is here." for i in range(10))
+    sentence_tokens = estimate_tokens("Sentence number 0 is here.")
+    passages = list(iter_passages(corpus, 3 * sentence_tokens, overlap_tokens=sentence_tokens))
+
+    assert [passage.text.count("Sentence") for passage in passages] == [3, 3, 3, 3, 2]
+    # every passage starts with the last sentence of the previous one
+    for previous, passage in zip(passages, passages[1:]):
+        assert passage.start < previous.end
+        assert previous.text.endswith(corpus[passage.start:previous.end])
+
+
+def test_long_sentences_are_split():
+    corpus = "word " * 100 + "x" * 50
+    passages = list(iter_passages(corpus, 8))
+    assert all(len(passage.text) <= 32 for passage in passages)
+    assert "".join(passage.text for passage in passages).replace(" ", "") == corpus.replace(" ", "")
+
+    with pytest.raises(ValueError):
+        list(iter_passages(corpus, 8, overlap_tokens=8))
@@ -1,5 +1,7 @@
 from qa_engine.core.document_factory import ESDocumentFactory
 from qa_engine.core.models import TextEntry
+from qa_engine.utils.es_index import finish_routing_migration, migrate_to_routing
+from qa_engine.utils.es_tasks import task_status
 import pytest
 import time
 
@@ -77,5 +79,84 @@ def test_meta_retrieval(es_doc_factory):
     assert retrieved_text_entries[0].metadata == {"a": 1}
 
 
+def test_get_by_ids(loaded_doc_factory):
+    retrieved_text_entries = loaded_doc_factory.get_by_ids(
+        doc_id, ["preloaded-text-entry-3", "missing", "preloaded-text-entry-1"])
+
+    assert [entry.id for entry in retrieved_text_entries] == ["preloaded-text-entry-3", "preloaded-text-entry-1"]
+    assert retrieved_text_entries[0].text == "Preloaded text sample 3"
+
+
+def test_search_text(es_doc_factory):
+    text_entries = [
+        TextEntry("a", "The red fox jumps over the fence", {"group": "1"}),
+        TextEntry("b", "A quiet afternoon by the river", {"group": "1"}),
+        TextEntry("c", "Foxes are red and foxes are quick", {"group": "2"}),
+    ]
+    es_doc_factory.store(doc_id, text_entries, refresh=True)
+    retrieved_text_entries = es_doc_factory.search_text(doc_id, "red fox")
+
+    assert [entry.id for entry in retrieved_text_entries][0] == "a"
+    assert "b" not in [entry.id for entry in retrieved_text_entries]
+    assert retrieved_text_entries[0].metadata["__lexical"] > 0
+    assert [entry.id for entry in es_doc_factory.search_text(doc_id, "red", {"group": "2"})] == ["c"]
+
+
+def test_iter_retrieve(es_doc_factory):
+    text_entries = [TextEntry(str(i), f"My text entry {i}", {"group": str(i % 2)}) for i in range(25)]
+    es_doc_factory.store(doc_id, text_entries, refresh=True)
+
+    paged_entries = list(es_doc_factory.iter_retrieve(doc_id, page_size=4))
+    assert sorted(entry.id for entry in paged_entries) == sorted(entry.id for entry in text_entries)
+    projected_entries = list(es_doc_factory.iter_retrieve(doc_id, metadata={"group": "1"}, fields=[], page_size=5))
+    assert len(projected_entries) == 12
+    assert all(entry.text == "" and entry.metadata == {} for entry in projected_entries)
+    # stopping early closes the point in time
+    assert len([entry for _, entry in zip(range(3), es_doc_factory.iter_retrieve(doc_id, page_size=2))]) == 3
+
+
+def test_remove_where(es_doc_factory):
+    text_entries = [TextEntry(str(i), f"My text entry {i}", {"group": str(i % 2)}) for i in range(10)]
+    es_doc_factory.store(doc_id, text_entries, refresh=True)
+    es_doc_factory.remove_by_ids(doc_id, ["0", "missing"], refresh=True)
+    assert es_doc_factory.es_client.count(index=index_name)["count"] == 9
+
+    task_id = es_doc_factory.remove_where(doc_id, {"group": "1"})
+    status = es_doc_factory.removal_status(task_id)
+    while not status["completed"]:
+        time.sleep(0.1)
+        status = es_doc_factory.removal_status(task_id)
+    assert status["deleted"] == 5
+    es_doc_factory.es_client.indices.refresh(index=index_name)
+    assert sorted(entry.id for entry in es_doc_factory.retrieve(doc_id)) == ["2", "4", "6", "8"]
+
+
+def test_routing():
+    factory = ESDocumentFactory(es_client_params, index_name + "_routing", routing=True, number_of_shards=3)
+    factory.clear()
+    factory.store(doc_id, [TextEntry("a", "Routed text entry", {})], refresh=True)
+    assert [entry.id for entry in factory.retrieve(doc_id)] == ["a"]
+    assert [entry.id for entry in factory.get_by_ids_many([(doc_id, ["a"]), ("other", ["a"])])[0]] == ["a"]
+    assert [entry.id for entry in factory.search_text(doc_id, "routed")] == ["a"]
+    settings = factory.es_client.indices.get_settings(index=factory.index_name)[factory.index_name]["settings"]
+    assert settings["index"]["number_of_shards"] == "3"
+    factory.destruct()
+
+
+def test_migrate_to_routing(loaded_doc_factory):
+    es_client = loaded_doc_factory.es_client
+    task_id = migrate_to_routing(es_client, index_name, number_of_shards=2)
+    while not task_status(es_client, task_id)["completed"]:
+        time.sleep(0.1)
+    finish_routing_migration(es_client, index_name, task_id)
+
+    routed_factory = ESDocumentFactory(es_client_params, index_name, routing=True)
+    assert len(routed_factory.retrieve(doc_id)) == 10
+    assert [entry.id for entry in routed_factory.get_by_ids(doc_id, ["preloaded-text-entry-1"])] == \
+           ["preloaded-text-entry-1"]
+    # drops the alias with the routed index, so the next tests start from a plain index
+    es_client.indices.delete(index=index_name + "-routed")
+
+
 if __name__ == "__main__":
     pytest.main(["-v", "tests/es_factory.py"])
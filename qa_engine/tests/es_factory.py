@@ -81,5 +81,48 @@ def test_meta_retrieval(es_embedding_factory):
     assert retrieved_embedding_entries[0].metadata == {"key": "value"}
 
 
+def test_knn_retrieve(loaded_es_embedding_factory):
+    knn_factory = ESEmbeddingFactory(es_client_params, index_name, embedding_size,
+                                     retrieval_mode="knn", k=5, num_candidates=20, rescore_window=10)
+    embedding_entries = [
+        EmbeddingEntry("a", [1.0 for _ in range(embedding_size)], {"key": "value"}),
+        EmbeddingEntry("b", [-1.0 for _ in range(embedding_size)], {"key": "other"}),
+    ]
+    knn_factory.store(doc_id, embedding_entries, refresh=True)
+    retrieved_embedding_entries = knn_factory.retrieve(doc_id, [1.0 for _ in range(embedding_size)])
+    assert len(retrieved_embedding_entries) == 5
+    assert retrieved_embedding_entries[0].id == "a"
+    assert retrieved_embedding_entries[0].metadata["__rank"] == pytest.approx(2.0)
+
+    filtered_entries = knn_factory.retrieve(doc_id, [1.0 for _ in range(embedding_size)], {"key": "other"})
+    assert [entry.id for entry in filtered_entries] == ["b"]
+
+
+def test_retrieve_many(loaded_es_embedding_factory):
+    requests = [(doc_id, [1.0 for _ in range(embedding_size)], None),
+                (doc_id, [1.0 for _ in range(embedding_size)], {"key": "value"})]
+    results = loaded_es_embedding_factory.retrieve_many(requests)
+    assert [[entry.id for entry in entries] for entries in results] == \
+           [[entry.id for entry in loaded_es_embedding_factory.retrieve(*request)] for request in requests]
+
+
+def test_bulk_load(es_embedding_factory):
+    def index_settings():
+        return es_embedding_factory.es_client.indices.get_settings(index=index_name)[index_name]["settings"]["index"]
+
+    replicas = index_settings()["number_of_replicas"]
+    with es_embedding_factory.bulk_load(force_merge_segments=1):
+        with es_embedding_factory.bulk_load():
+            assert index_settings()["refresh_interval"] == "-1"
+        # the outer bulk load still runs
+        assert index_settings()["refresh_interval"] == "-1"
+        assert index_settings()["number_of_replicas"] == "0"
+        es_embedding_factory.store(doc_id, [EmbeddingEntry("a", [1.0 for _ in range(embedding_size)], {})])
+    assert "refresh_interval" not in index_settings()
+    assert index_settings()["number_of_replicas"] == replicas
+    # the index was refreshed when the bulk load ended
+    assert es_embedding_factory.es_client.count(index=index_name)["count"] == 1
+
+
 if __name__ == "__main__":
     pytest.main(["-v", "tests/es_factory.py"])
@@ -0,0 +1,194 @@
+from qa_engine.core.answer_strategy import AnswerStrategy
+from qa_engine.core.caching_strategy import JSONChunkingCachingStrategy
+from qa_engine.core.document_operator import BasicDocumentOperator
+from qa_engine.core.embedding_factory import NumpyEmbeddingFactory
+from qa_engine.core.ir_system import IRSystem
+from qa_engine.core.models import Document, TextEntry
+from qa_engine.core.result_cache import ResultCache
+from qa_engine.tests.fakes import HashEmbeddingOperator, InMemoryDocumentFactory
+import asyncio
+import threading
+import pytest
+
+doc_id = "test_doc_id"
+
+objects = [
+    {"id": "apple", "description": "Apples are red or green fruits that grow on trees in orchards."},
+    {"id": "car", "description": "Cars are vehicles with four wheels and an engine that burns fuel."},
+]
+
+
+class EchoAnswerStrategy(AnswerStrategy):
+
+    def __init__(self):
+        super().__init__(top_k=1)
+        self.calls = 0
+
+    def formulate_answer(self, query: str, entries: [TextEntry], *args, **kwargs) -> str:
+        self.calls += 1
+        return f"{entries[0].metadata['obj_id']} answers {query}"
+
+    async def astream_answer(self, query: str, entries: [TextEntry], *args, **kwargs):
+        for word in self.formulate_answer(query, entries).split(" "):
+            yield word + " "
+
+
+@pytest.fixture()
+def ir_system(tmp_path):
+    return build_ir_system(tmp_path)
+
+
+def build_ir_system(tmp_path, result_cache=None):
+    embedding_operator = HashEmbeddingOperator()
+    caching_strategy = JSONChunkingCachingStrategy(
+        embedding_factory=NumpyEmbeddingFactory(str(tmp_path / "embs"), embedding_operator.embedding_size),
+        document_factory=InMemoryDocumentFactory(),
+        embedding_operator=embedding_operator,
+        document_operator=BasicDocumentOperator(),
+        text_keys=["description"],
+        id_key="id",
+    )
+    ir_system = IRSystem(caching_strategy, EchoAnswerStrategy(), result_cache=result_cache, cache_namespace="index")
+    ir_system.index_document(Document(doc_id, data=objects))
+    return ir_system
+
+
+def test_astream_find(ir_system):
+    async def collect():
+        return [event async for event in ir_system.astream_find(doc_id, "four wheels")]
+
+    events = asyncio.run(collect())
+    assert events[0][0] == "resources"
+    assert events[0][1]["resources"][0].metadata["obj_id"] == "car"
+    assert [payload["token"] for event, payload in events[1:-1]] == ["car ", "answers ", "four ", "wheels "]
+    assert events[-1] == ("done", {"answer": "car answers four wheels"})
+
+
+def test_result_cache(tmp_path):
+    result_cache = ResultCache(max_size=10, ttl=60)
+    ir_system = build_ir_system(tmp_path, result_cache)
+    operator = ir_system.caching_strategy.embedding_operator
+    calls = operator.calls
+
+    first = ir_system.find(doc_id, "Four  wheels")
+    assert ir_system.find(doc_id, "four wheels") == first
+    assert asyncio.run(ir_system.afind(doc_id, "four wheels ")) == first
+    assert operator.calls == calls + 1
+    assert ir_system.answer_strategy.calls == 1
+
+    # different filters or answer settings are cached separately
+    ir_system.find(doc_id, "four wheels", formulate_answer=False)
+    assert operator.calls == calls + 2
+    assert result_cache.stats()["hits"] == 2
+
+    # indexing into the association invalidates its results
+    ir_system.index_document(Document(doc_id, data=[{"id": "bike", "description": "Bikes have two wheels."}]))
+    calls = operator.calls
+    ir_system.find(doc_id, "four wheels")
+    assert operator.calls == calls + 1
+    assert result_cache.stats()["invalidations"] == 2
+
+
+def test_result_cache_generations_are_bounded():
+    result_cache = ResultCache(max_size=2, ttl=60)
+    key = result_cache.key("index", "a", "query", None, True)
+    result_cache.put(key, {"answer": "a"})
+    for other in ("b", "c", "d"):
+        result_cache.invalidate("index", other)
+    assert len(result_cache._generations) == 2
+    # the generation of "a" was never tracked, the evictions still invalidate its results
+    assert result_cache.get(result_cache.key("index", "a", "query", None, True)) is None
+
+    result_cache.invalidate("index", "a")
+    key = result_cache.key("index", "a", "query", None, True)
+    result_cache.put(key, {"answer": "a"})
+    assert result_cache.get(result_cache.key("index", "a", "query", None, True)) == {"answer": "a"}
+    result_cache.invalidate("index", "b")
+    result_cache.invalidate("index", "c")
+    assert result_cache.get(result_cache.key("index", "a", "query", None, True)) is None
+
+
+def test_find_many(tmp_path):
+    result_cache = ResultCache(max_size=10, ttl=60)
+    ir_system = build_ir_system(tmp_path, result_cache)
+    operator = ir_system.caching_strategy.embedding_operator
+    queries = [(doc_id, "four wheels", None), (doc_id, "red fruits", None), (doc_id, "four wheels", None)]
+    calls = operator.calls
+
+    results = ir_system.find_many(queries)
+    assert operator.calls == calls + 1
+    assert [result["answer"] for result in results] == [
+        "car answers four wheels", "apple answers red fruits", "car answers four wheels"]
+    result_cache.clear()
+    for (_, query, _), result in zip(queries, results):
+        assert [entry.id for entry in ir_system.find(doc_id, query)["resources"]] == \
+               [entry.id for entry in result["resources"]]
+
+    # cached queries are not searched again
+    calls = operator.calls
+    new_queries = [(doc_id, "four wheels", None), (doc_id, "engine fuel", None)]
+    results = asyncio.run(ir_system.afind_many(new_queries, formulate_answer=True))
+    assert operator.calls == calls + 1
+    assert results[1]["resources"][0].metadata["obj_id"] == "car"
+
+
+class BackgroundRemoval:
+    """
+    Turns the removals of a caching strategy into a background task that only runs on complete().
+    """
+
+    def __init__(self, caching_strategy, monkeypatch):
+        self.remove_objects = caching_strategy.remove_objects
+        self.requests = []
+        self.completed = False
+        monkeypatch.setattr(caching_strategy, "remove_objects", self.start)
+        monkeypatch.setattr(caching_strategy, "removal_status", self.status)
+
+    def start(self, doc_id, obj_ids=None):
+        self.requests.append((doc_id, obj_ids))
+        return {"document_factory": "task"}
+
+    def status(self, task_id):
+        return {"task": task_id, "completed": self.completed} if task_id == "task" else None
+
+    def complete(self):
+        for doc_id, obj_ids in self.requests:
+            self.remove_objects(doc_id, obj_ids)
+        self.completed = True
+
+
+def test_results_are_not_cached_during_removals(tmp_path, monkeypatch):
+    result_cache = ResultCache(max_size=10, ttl=60)
+    ir_system = build_ir_system(tmp_path, result_cache)
+    removal = BackgroundRemoval(ir_system.caching_strategy, monkeypatch)
+    assert ir_system.remove_objects(doc_id, ["car"]) == {"document_factory": "task"}
+
+    # the entries of the car are still searchable until the task completes
+    assert ir_system.find(doc_id, "four wheels")["answer"] == "car answers four wheels"
+    assert asyncio.run(ir_system.afind(doc_id, "four wheels"))["answer"] == "car answers four wheels"
+    ir_system.find_many([(doc_id, "four wheels", None)])
+    assert result_cache.stats()["hits"] == 0
+
+    removal.complete()
+    assert ir_system.removal_status("task")["completed"]
+    assert ir_system.find(doc_id, "four wheels")["answer"] == "apple answers four wheels"
+    assert ir_system.find(doc_id, "four wheels")["answer"] == "apple answers four wheels"
+    assert result_cache.stats()["hits"] == 1
+
+
+def test_reindexing_waits_for_removals(tmp_path, monkeypatch):
+    ir_system = build_ir_system(tmp_path)
+    ir_system.removal_poll_seconds = 0.01
+    removal = BackgroundRemoval(ir_system.caching_strategy, monkeypatch)
+    ir_system.remove_objects(doc_id, ["car"])
+
+    # unchanged objects are skipped, the running removal would then delete the re-indexed car
+    indexing = threading.Thread(target=ir_system.index_document, args=(Document(doc_id, data=objects),))
+    indexing.start()
+    indexing.join(0.2)
+    assert indexing.is_alive()
+    removal.complete()
+    indexing.join(5)
+    assert not indexing.is_alive()
+    entries = ir_system.caching_strategy.document_factory.retrieve(doc_id)
+    assert {entry.metadata["obj_id"] for entry in entries} == {"apple", "car"}
@@ -0,0 +1,148 @@
+from qa_engine.api.jobs import IngestionJobs, QueueFull
+from qa_engine.tests.ir_system_test import build_ir_system
+from contextlib import contextmanager
+import sqlite3
+import threading
+import time
+import pytest
+
+doc_id = "test_doc_id"
+
+objects = [{"id": str(i), "description": f"Object number {i} of the catalogue."} for i in range(10)]
+
+
+def wait_for(jobs, job_id, statuses=("completed", "failed", "cancelled"), timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = jobs.get(job_id)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} is still {jobs.get(job_id)['status']}")
+
+
+@pytest.fixture()
+def ir_system(tmp_path):
+    return build_ir_system(tmp_path)
+
+
+def test_job_progress(ir_system, tmp_path):
+    jobs = IngestionJobs(lambda *args: ir_system, str(tmp_path / "jobs.sqlite"), batch_size=3)
+    job = jobs.submit("index", ["description"], "id", doc_id, objects)
+    assert job["status"] in ("queued", "running")
+
+    job = wait_for(jobs, job["id"])
+    assert job["status"] == "completed"
+    assert job["objects_done"] == 10 and job["progress"] == 1.0
+    assert job["embed_per_second"] > 0 and job["store_per_second"] > 0
+    # on top of the two objects indexed by build_ir_system
+    assert len(ir_system.caching_strategy.document_factory.retrieve(doc_id)) == 12
+    jobs.close()
+
+
+def test_failures_are_reported(ir_system, tmp_path):
+    jobs = IngestionJobs(lambda *args: ir_system, batch_size=4)
+    job = wait_for(jobs, jobs.submit("index", ["description"], "id", doc_id, objects[:5] + [{"id": "x"}])["id"])
+    assert job["status"] == "failed"
+    # the other object of the failing batch is still indexed
+    assert (job["objects_done"], job["objects_failed"], job["progress"]) == (5, 1, 1.0)
+    assert len(job["errors"]) == 1 and "description" in job["errors"][0]
+    assert len(ir_system.caching_strategy.document_factory.retrieve(doc_id, metadata={"obj_id": "4"})) == 1
+    jobs.close()
+
+
+def test_bulk_load_ends_before_sync(ir_system, monkeypatch):
+    events = []
+
+    @contextmanager
+    def bulk_load(force_merge_segments=None):
+        events.append(("start", force_merge_segments))
+        yield
+        events.append(("end", force_merge_segments))
+
+    index_document = ir_system.index_document
+
+    def record_index_document(document, sync=False):
+        events.append("sync" if sync else "batch")
+        index_document(document, sync=sync)
+
+    monkeypatch.setattr(ir_system.caching_strategy.embedding_factory, "bulk_load", bulk_load)
+    monkeypatch.setattr(ir_system, "index_document", record_index_document)
+    jobs = IngestionJobs(lambda *args: ir_system, batch_size=5, bulk_load=True, force_merge_segments=1)
+    job = wait_for(jobs, jobs.submit("index", ["description"], "id", doc_id, objects, sync=True)["id"])
+    assert job["status"] == "completed"
+    assert events == [("start", 1), "batch", "batch", ("end", 1), "sync"]
+    # the sync pass removed the two objects indexed by build_ir_system
+    assert len(ir_system.caching_strategy.document_factory.retrieve(doc_id)) == 10
+    jobs.close()
+
+
+class BlockingIRSystem:
+    def __init__(self):
+        self.release = threading.Event()
+        self.batches = []
+
+        self.restored = 0
+
+    def index_document(self, document, *args, **kwargs):
+        self.release.wait(5)
+        self.batches.append(document.data)
+
+    def restore_bulk_load(self):
+        self.restored += 1
+        return True
+
+
+def test_backpressure_and_cancel(tmp_path):
+    ir_system = BlockingIRSystem()
+    jobs = IngestionJobs(lambda *args: ir_system, max_queued=1, batch_size=2)
+    running = jobs.submit("index", ["description"], "id", doc_id, objects)
+    wait_for(jobs, running["id"], statuses=("running",))
+    queued = jobs.submit("index", ["description"], "id", doc_id, objects)
+    with pytest.raises(QueueFull):
+        jobs.submit("index", ["description"], "id", doc_id, objects)
+
+    assert jobs.cancel(queued["id"])["status"] == "cancelled"
+    assert jobs.cancel(running["id"])["cancel_requested"]
+    ir_system.release.set()
+    job = wait_for(jobs, running["id"])
+    assert job["status"] == "cancelled"
+    assert len(ir_system.batches) == 1
+    jobs.close()
+
+
+def test_jobs_resume_after_restart(tmp_path):
+    ir_system = BlockingIRSystem()
+    jobs = IngestionJobs(lambda *args: ir_system, str(tmp_path / "jobs.sqlite"), batch_size=4)
+    job = jobs.submit("index", ["description"], "id", doc_id, objects)
+    wait_for(jobs, job["id"], statuses=("running",))
+    closing = threading.Thread(target=jobs.close)
+    closing.start()
+    ir_system.release.set()
+    closing.join()
+    assert jobs.get(job["id"])["status"] == "queued"
+
+    resumed = IngestionJobs(lambda *args: ir_system, str(tmp_path / "jobs.sqlite"), batch_size=4)
+    job = wait_for(resumed, job["id"])
+    assert job["status"] == "completed"
+    assert [len(batch) for batch in ir_system.batches] == [4, 4, 2]
+    resumed.close()
+
+
+def test_bulk_load_of_crashed_jobs_is_restored(tmp_path):
+    ir_system = BlockingIRSystem()
+    ir_system.release.set()
+    path = str(tmp_path / "jobs.sqlite")
+    jobs = IngestionJobs(lambda *args: ir_system, path, batch_size=4)
+    jobs.close()
+    job = jobs.submit("index", ["description"], "id", doc_id, objects)
+    # a crash leaves the job running in the queue
+    with sqlite3.connect(path) as db:
+        db.execute("UPDATE jobs SET status = 'running' WHERE id = ?", (job["id"],))
+
+    resumed = IngestionJobs(lambda *args: ir_system, path, batch_size=4)
+    assert wait_for(resumed, job["id"])["status"] == "completed"
+    assert ir_system.restored == 1
+    second = wait_for(resumed, resumed.submit("index", ["description"], "id", doc_id, objects)["id"])
+    assert second["status"] == "completed" and ir_system.restored == 1
+    resumed.close()
@@ -0,0 +1,22 @@
+from qa_engine.utils.cache import LRUCache
+import time
+
+
+def test_lru_eviction():
+    cache = LRUCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "max_size": 2, "hits": 3, "misses": 1, "evictions": 1}
+
+
+def test_ttl_expiry():
+    cache = LRUCache(max_size=2, ttl=0.01)
+    cache.put("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a", "expired") == "expired"
+    assert len(cache) == 0
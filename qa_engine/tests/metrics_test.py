@@ -0,0 +1,42 @@
+from qa_engine.tests.ir_system_test import build_ir_system, doc_id
+from qa_engine.utils.metrics import StageMetrics, StageTimings
+from qa_engine.utils.stages import observe_stages, stage, add_global_observer, remove_global_observer
+import asyncio
+import pytest
+
+
+def test_stages_are_observed(tmp_path):
+    ir_system = build_ir_system(tmp_path)
+    metrics, timings = StageMetrics(), StageTimings()
+    add_global_observer(metrics)
+    try:
+        with observe_stages(timings):
+            ir_system.find(doc_id, "four wheels")
+        asyncio.run(ir_system.afind(doc_id, "red fruits"))
+    finally:
+        remove_global_observer(metrics)
+
+    assert {"query_embedding", "vector_search", "aggregate", "retrieve", "answer"} <= set(timings.durations)
+    assert "query_embedding;dur=" in timings.server_timing()
+    rendered = metrics.render()
+    assert 'qa_stage_duration_seconds_count{stage="vector_search"} 2' in rendered
+    assert 'qa_stage_errors_total{stage="answer"} 0' in rendered
+
+
+def test_errors_and_items_are_counted():
+    metrics = StageMetrics()
+    with observe_stages(metrics):
+        with stage("store", 10):
+            pass
+        with pytest.raises(KeyError):
+            with stage("store", 300):
+                raise KeyError("boom")
+    with stage("store"):
+        # not observed outside of observe_stages
+        pass
+
+    rendered = metrics.render()
+    assert 'qa_stage_errors_total{stage="store"} 1' in rendered
+    assert 'qa_stage_items_bucket{stage="store",le="16"} 1' in rendered
+    assert 'qa_stage_items_bucket{stage="store",le="+Inf"} 2' in rendered
+    assert 'qa_stage_items_sum{stage="store"} 310' in rendered
@@ -0,0 +1,33 @@
+from qa_engine.utils.ndjson import aiter_ndjson, aiter_batches
+import asyncio
+import pytest
+
+
+async def chunked(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+async def collect(items):
+    return [item async for item in items]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_objects_are_parsed_across_chunks(chunk_size):
+    data = b'{"id": 1, "text": "caf\\u00e9"}\n\n{"id": 2}\r\n{"id": 3}'
+    objs = asyncio.run(collect(aiter_ndjson(chunked(data, chunk_size))))
+    assert objs == [{"id": 1, "text": "café"}, {"id": 2}, {"id": 3}]
+
+
+def test_malformed_line():
+    data = b'{"id": 1}\n{"id": \n{"id": 3}\n'
+    with pytest.raises(ValueError, match="line 2"):
+        asyncio.run(collect(aiter_ndjson(chunked(data, 4))))
+
+
+def test_batches():
+    async def numbers():
+        for i in range(7):
+            yield i
+
+    assert asyncio.run(collect(aiter_batches(numbers(), 3))) == [[0, 1, 2], [3, 4, 5], [6]]
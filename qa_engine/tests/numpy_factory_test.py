@@ -0,0 +1,172 @@
+from qa_engine.core.embedding_factory import EmbeddingFactory, NumpyEmbeddingFactory, matches_metadata
+from qa_engine.core.models import EmbeddingEntry
+import numpy as np
+import os
+import pytest
+
+embedding_size = 8
+doc_id = "test/doc id"
+
+
+@pytest.fixture()
+def numpy_embedding_factory(tmp_path):
+    return NumpyEmbeddingFactory(str(tmp_path / "embs"), embedding_size)
+
+
+@pytest.fixture()
+def loaded_numpy_embedding_factory(numpy_embedding_factory):
+    embedding_entries = []
+    for i in range(10):
+        embedding = [0.0] * embedding_size
+        embedding[i % embedding_size] = 1.0
+        embedding_entries.append(EmbeddingEntry(f"preloaded-{i}", embedding, {"group": str(i % 2)}))
+    numpy_embedding_factory.store(doc_id, embedding_entries)
+    return numpy_embedding_factory
+
+
+def test_retrieve(loaded_numpy_embedding_factory):
+    query = [0.0] * embedding_size
+    query[3] = 1.0
+    retrieved = loaded_numpy_embedding_factory.retrieve(doc_id, query)
+
+    assert len(retrieved) == 10
+    assert retrieved[0].id == "preloaded-3"
+    assert retrieved[0].embedding == query
+    assert retrieved[0].metadata["__rank"] == pytest.approx(2.0)
+    assert retrieved[-1].metadata["__rank"] == pytest.approx(1.0)
+
+
+def test_meta_retrieval(loaded_numpy_embedding_factory):
+    query = [1.0] * embedding_size
+    retrieved = loaded_numpy_embedding_factory.retrieve(doc_id, query, {"group": "1"})
+    assert {entry.id for entry in retrieved} == {f"preloaded-{i}" for i in range(1, 10, 2)}
+
+    retrieved = loaded_numpy_embedding_factory.retrieve(doc_id, query, {"group": ["0", "1"]})
+    assert len(retrieved) == 10
+
+
+def test_remove_and_compaction(loaded_numpy_embedding_factory):
+    query = [1.0] * embedding_size
+    loaded_numpy_embedding_factory.remove_by_ids(doc_id, ["preloaded-0", "preloaded-1"])
+    retrieved = loaded_numpy_embedding_factory.retrieve(doc_id, query)
+    assert len(retrieved) == 8
+    assert "preloaded-0" not in {entry.id for entry in retrieved}
+
+    # Crossing the compaction ratio rewrites the matrix without the tombstoned rows
+    loaded_numpy_embedding_factory.remove_by_ids(doc_id, ["preloaded-2"])
+    association = loaded_numpy_embedding_factory._association(doc_id)
+    assert association.tombstones == 0
+    assert association.matrix.shape == (7, embedding_size)
+
+
+def test_persistence(loaded_numpy_embedding_factory):
+    loaded_numpy_embedding_factory.store(doc_id, [EmbeddingEntry("preloaded-3", [0.5] * embedding_size, {})])
+    reopened = NumpyEmbeddingFactory(loaded_numpy_embedding_factory.root_dir, embedding_size)
+    retrieved = reopened.retrieve(doc_id, [1.0] * embedding_size, size=3)
+
+    assert len(retrieved) == 3
+    assert retrieved[0].id == "preloaded-3"
+    assert retrieved[0].embedding == [0.5] * embedding_size
+    assert len(reopened.retrieve(doc_id, [1.0] * embedding_size, size=100)) == 10
+
+
+def test_entries_are_logged(numpy_embedding_factory):
+    numpy_embedding_factory.store(doc_id, [EmbeddingEntry("a", [1.0] * embedding_size, {"n": 1}),
+                                           EmbeddingEntry("a", [0.5] * embedding_size, {"n": 2})])
+    association = numpy_embedding_factory._association(doc_id)
+    # the last of the duplicated ids wins, stores and removes only append to the log
+    assert association.ids == ["a"] and association.metadata == [{"n": 2}]
+    assert not os.path.exists(association.entries_path)
+    for i in range(4):
+        numpy_embedding_factory.store(doc_id, [EmbeddingEntry(f"b{i}", [1.0] * embedding_size, {})])
+    numpy_embedding_factory.remove_by_ids(doc_id, ["b0"])
+    assert not os.path.exists(association.entries_path)
+    with open(association.log_path) as f:
+        assert len(f.readlines()) == 6
+
+    reopened = NumpyEmbeddingFactory(numpy_embedding_factory.root_dir, embedding_size)
+    assert sorted(entry.id for entry in reopened.retrieve(doc_id, [1.0] * embedding_size)) == ["a", "b1", "b2", "b3"]
+
+    # a compaction snapshots the rows and starts a new log
+    numpy_embedding_factory.remove_by_ids(doc_id, ["b1"])
+    assert association.tombstones == 0 and os.path.exists(association.entries_path)
+    numpy_embedding_factory.store(doc_id, [EmbeddingEntry("c", [1.0] * embedding_size, {})])
+    reopened = NumpyEmbeddingFactory(numpy_embedding_factory.root_dir, embedding_size)
+    assert sorted(entry.id for entry in reopened.retrieve(doc_id, [1.0] * embedding_size)) == ["a", "b2", "b3", "c"]
+    assert reopened.retrieve(doc_id, [1.0] * embedding_size, entry_ids=["a"])[0].embedding == [0.5] * embedding_size
+
+
+@pytest.mark.parametrize("quantization", ["int8", "binary"])
+def test_quantized_retrieve(tmp_path, quantization):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(200, 32)).astype(np.float32)
+    entries = [EmbeddingEntry(str(i), vector.tolist(), {"group": str(i % 2)}) for i, vector in enumerate(vectors)]
+    exact = NumpyEmbeddingFactory(str(tmp_path / "exact"), 32, size=5)
+    quantized = NumpyEmbeddingFactory(str(tmp_path / quantization), 32, size=5, quantization=quantization,
+                                      rescore_window=200)
+    exact.store(doc_id, entries)
+    quantized.store(doc_id, entries)
+
+    query = vectors[7].tolist()
+    expected = exact.retrieve(doc_id, query, {"group": "1"})
+    # a rescore window covering every row makes the rescored result exact
+    retrieved = quantized.retrieve(doc_id, query, {"group": "1"})
+    assert [e.id for e in retrieved] == [e.id for e in expected]
+    assert [e.metadata["__rank"] for e in retrieved] == pytest.approx([e.metadata["__rank"] for e in expected])
+
+    quantized.rescore_window = None
+    assert quantized.retrieve(doc_id, query)[0].id == "7"
+
+
+def test_quantized_codes_follow_the_matrix(tmp_path):
+    factory = NumpyEmbeddingFactory(str(tmp_path / "embs"), embedding_size, quantization="int8")
+    factory.store(doc_id, [EmbeddingEntry(str(i), [float(i + 1)] * embedding_size, {}) for i in range(4)])
+    factory.remove_by_ids(doc_id, ["0", "1"])
+    association = factory._association(doc_id)
+    assert association.codes.shape == (2, embedding_size)
+    assert association.scales.tolist() == pytest.approx([3 / 127, 4 / 127])
+
+    # an association stored without quantization gets its codes on first load
+    plain = NumpyEmbeddingFactory(str(tmp_path / "plain"), embedding_size)
+    plain.store(doc_id, [EmbeddingEntry("a", [1.0] * embedding_size, {})])
+    reopened = NumpyEmbeddingFactory(plain.root_dir, embedding_size, quantization="binary")
+    assert reopened._association(doc_id).codes.tolist() == [[255]]
+    assert reopened.retrieve(doc_id, [1.0] * embedding_size)[0].id == "a"
+
+
+def test_retrieve_restricted_to_entry_ids(loaded_numpy_embedding_factory):
+    query = [1.0] * embedding_size
+    retrieved = loaded_numpy_embedding_factory.retrieve(doc_id, query, entry_ids=["preloaded-2", "preloaded-5", "x"])
+    assert {entry.id for entry in retrieved} == {"preloaded-2", "preloaded-5"}
+    retrieved = loaded_numpy_embedding_factory.retrieve(doc_id, query, {"group": "0"},
+                                                        entry_ids=["preloaded-2", "preloaded-5"])
+    assert [entry.id for entry in retrieved] == ["preloaded-2"]
+
+
+class PagedEmbeddingFactory(EmbeddingFactory):
+    """
+    Implements only the abstract methods, retrieve returns at most 3 entries.
+    """
+    embedding_size = embedding_size
+
+    def __init__(self):
+        self.entries = {}
+
+    def store(self, doc_id, embeddings, *args, **kwargs):
+        self.entries.update({embedding.id: embedding for embedding in embeddings})
+
+    def remove_by_ids(self, doc_id, embedding_ids, *args, **kwargs):
+        for embedding_id in embedding_ids:
+            self.entries.pop(embedding_id, None)
+
+    def retrieve(self, doc_id, embedding, metadata=None, *args, **kwargs):
+        return [entry for entry in self.entries.values() if matches_metadata(entry.metadata, metadata)][:3]
+
+
+def test_default_remove_where():
+    factory = PagedEmbeddingFactory()
+    factory.store(doc_id, [EmbeddingEntry(str(i), [1.0] * embedding_size, {"group": str(i % 2)}) for i in range(10)])
+    assert factory.remove_where(doc_id, {"group": "1"}) is None
+    assert sorted(factory.entries) == ["0", "2", "4", "6", "8"]
+    factory.remove_where(doc_id)
+    assert not factory.entries
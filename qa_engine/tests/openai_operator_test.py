@@ -0,0 +1,97 @@
+from qa_engine.core.embedding_operator import OpenAIEmbeddingOperator
+from qa_engine.core.models import TextEntry
+from qa_engine.utils.stages import observe_stages
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import json
+import pytest
+
+
+class StubEmbeddingHandler(BaseHTTPRequestHandler):
+    """
+    Mimics POST /v1/embeddings, embedding every input as [len(text), position in the request]. The
+    first `server.throttle` requests are answered with a 429.
+    """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            self.server.requests.append(body["input"])
+            throttled = len(self.server.requests) <= self.server.throttle
+        if throttled:
+            payload, status = {"error": {"message": "Rate limit reached", "type": "requests"}}, 429
+        else:
+            data = [{"object": "embedding", "index": i, "embedding": [float(len(text)), float(i)]}
+                    for i, text in enumerate(body["input"])]
+            # out of order on purpose, the operator must rely on "index"
+            payload, status = {"object": "list", "model": body["model"], "data": data[::-1]}, 200
+        raw = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubEmbeddingHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.throttle = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def operator_for(server, **kwargs):
+    api_base = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    return OpenAIEmbeddingOperator("text-embedding-ada-002", "sk-test", None, api_base=api_base,
+                                   backoff=0.01, **kwargs)
+
+
+def test_batches_preserve_input_order(stub_server):
+    operator = operator_for(stub_server, max_batch_size=3, max_workers=4)
+    entries = [TextEntry(str(i), "x" * (i + 1), {"i": i}) for i in range(10)]
+    embedded = operator.embed(entries)
+
+    assert sorted(len(batch) for batch in stub_server.requests) == [1, 3, 3, 3]
+    assert [e.id for e in embedded] == [str(i) for i in range(10)]
+    assert [e.embedding[0] for e in embedded] == [float(i + 1) for i in range(10)]
+    assert [e.embedding[1] for e in embedded] == [float(i % 3) for i in range(10)]
+
+
+def test_parallel_batches_are_observed(stub_server):
+    operator = operator_for(stub_server, max_batch_size=2, max_workers=3)
+    observed = []
+    with observe_stages(lambda name, seconds, count, failed: observed.append((name, count))):
+        operator.embed([TextEntry(str(i), "z" * (i + 1), {}) for i in range(5)])
+    assert sorted(observed) == [("openai_embedding", 1), ("openai_embedding", 2), ("openai_embedding", 2)]
+
+
+def test_batches_are_token_bounded(stub_server):
+    operator = operator_for(stub_server, max_batch_tokens=10)
+    operator.embed([TextEntry(str(i), "y" * 16, {}) for i in range(5)])
+    # every text is estimated at 4 tokens, so only two fit in a batch
+    assert sorted(len(batch) for batch in stub_server.requests) == [1, 2, 2]
+
+
+def test_throttled_batches_are_retried(stub_server):
+    stub_server.throttle = 2
+    operator = operator_for(stub_server, max_retries=2)
+    embedded = operator.embed([TextEntry("a", "hello", {})])
+    assert len(stub_server.requests) == 3
+    assert embedded[0].embedding == [5.0, 0.0]
+
+
+def test_retries_are_bounded(stub_server):
+    stub_server.throttle = 10
+    operator = operator_for(stub_server, max_retries=1)
+    with pytest.raises(OpenAIEmbeddingOperator.retryable_errors):
+        operator.embed([TextEntry("a", "hello", {})])
+    assert len(stub_server.requests) == 2
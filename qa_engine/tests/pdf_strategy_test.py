@@ -0,0 +1,80 @@
+from qa_engine.core.caching_strategy import PDFChunkingCachingStrategy
+from qa_engine.core.document_operator import PDFDocumentOperator
+from qa_engine.core.embedding_factory import NumpyEmbeddingFactory
+from qa_engine.core.models import Document
+from qa_engine.tests.fakes import HashEmbeddingOperator, InMemoryDocumentFactory, write_pdf
+import pytest
+
+doc_id = "manual"
+
+pages = [f"Page {i} explains topic number {i} of the manual" for i in range(1, 8)]
+pages[4] = "Page 5 explains how to replace the printer cartridge"
+
+
+@pytest.fixture()
+def pdf_path(tmp_path):
+    path = str(tmp_path / "manual.pdf")
+    write_pdf(path, pages)
+    return path
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_pages_are_extracted_in_order(pdf_path, max_workers):
+    operator = PDFDocumentOperator(max_workers=max_workers, pages_per_task=2)
+    assert operator.parse(Document(doc_id, data=pdf_path)) == pages
+
+
+def build_strategy(tmp_path) -> PDFChunkingCachingStrategy:
+    embedding_operator = HashEmbeddingOperator()
+    return PDFChunkingCachingStrategy(
+        embedding_factory=NumpyEmbeddingFactory(str(tmp_path / "embs"), embedding_operator.embedding_size),
+        document_factory=InMemoryDocumentFactory(),
+        embedding_operator=embedding_operator,
+        document_operator=PDFDocumentOperator(max_workers=2, pages_per_task=3),
+        batch_size=3,
+    )
+
+
+def test_pages_are_cached_in_batches(pdf_path, tmp_path):
+    strategy = build_strategy(tmp_path)
+    embedding_operator = strategy.embedding_operator
+    strategy.cache(Document(doc_id, data=pdf_path))
+    # one entry per page, embedded 3 at a time
+    assert embedding_operator.calls == 3
+    entries = strategy.document_factory.retrieve(doc_id)
+    assert sorted(entry.metadata["page"] for entry in entries) == list(range(1, 8))
+
+    found = strategy.find(doc_id, "replace the printer cartridge")
+    assert found[0].metadata["page"] == 5
+
+    # re-ingesting the same file keeps the entry ids
+    strategy.cache(Document(doc_id, data=pdf_path))
+    assert len(strategy.document_factory.retrieve(doc_id)) == 7
+
+
+def test_files_of_a_doc_id_are_not_mixed(pdf_path, tmp_path):
+    other_path = str(tmp_path / "guide.pdf")
+    write_pdf(other_path, ["The guide covers the installation of the scanner", "The guide ends with a glossary"])
+    strategy = build_strategy(tmp_path)
+    strategy.cache(Document(doc_id, data=pdf_path))
+    strategy.cache(Document(doc_id, data=other_path))
+
+    entries = strategy.document_factory.retrieve(doc_id)
+    assert len(entries) == 9
+    sources = {}
+    for entry in entries:
+        sources.setdefault(entry.metadata["chunk_id"], set()).add(entry.metadata["source"])
+    assert len(sources) == 9 and all(len(chunk_sources) == 1 for chunk_sources in sources.values())
+    found = strategy.find(doc_id, "installation of the scanner")
+    # the chunk only holds the passage of the guide, not the first page of the manual
+    assert found[0].metadata["source"] == other_path and found[0].metadata["chunk_size"] == 1
+
+
+def test_edited_file_replaces_its_entries(pdf_path, tmp_path):
+    strategy = build_strategy(tmp_path)
+    strategy.cache(Document(doc_id, data=pdf_path))
+    write_pdf(pdf_path, pages[:3])
+    strategy.cache(Document(doc_id, data=pdf_path))
+    entries = strategy.document_factory.retrieve(doc_id)
+    assert sorted(entry.metadata["page"] for entry in entries) == [1, 2, 3]
+    assert strategy.find(doc_id, "replace the printer cartridge")[0].metadata["page"] != 5
@@ -0,0 +1,94 @@
+from qa_engine.api.config import Settings
+from qa_engine.api.registry import IRSystemRegistry
+import asyncio
+import threading
+import time
+
+settings = Settings(app_name="qa_engine", version="test", description="test", whitelist=["testserver"])
+
+
+class StubElasticsearch:
+    """
+    Stands in for the cluster clients, the indices are known to the registry so they are never called.
+    """
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class StubAsyncElasticsearch(StubElasticsearch):
+
+    async def close(self):
+        self.closed = True
+
+
+def build_registry(idle_ttl=900) -> IRSystemRegistry:
+    registry = IRSystemRegistry(settings, idle_ttl=idle_ttl)
+    registry._es_client = StubElasticsearch()
+    registry._async_es_client = StubAsyncElasticsearch()
+    registry._known_indices.update({"index$docs", "index$embs", "index$objs"})
+    return registry
+
+
+def test_entries_share_clients_and_caches():
+    registry = build_registry()
+    ir_system = registry.get("index", ["description"], "id")
+    assert registry.get("index", ("description",), "id") is ir_system
+
+    other = registry.get("index", ["title"], "id")
+    assert other is not ir_system
+    strategy, other_strategy = ir_system.caching_strategy, other.caching_strategy
+    assert strategy.document_factory.es_client is other_strategy.document_factory.es_client is registry._es_client
+    assert strategy.embedding_operator is other_strategy.embedding_operator
+    assert ir_system.answer_strategy is other.answer_strategy
+    assert ir_system.result_cache is other.result_cache is registry.result_cache
+    assert ir_system.removal_tasks is other.removal_tasks
+
+
+def test_idle_entries_are_evicted():
+    registry = build_registry(idle_ttl=0.2)
+    idle = registry.get("index", ["title"], "id")
+    used = registry.get("index", ["description"], "id")
+    time.sleep(0.12)
+    assert registry.get("index", ["description"], "id") is used
+    time.sleep(0.12)
+    # the sweep runs on the first get after idle_ttl
+    assert registry.get("index", ["description"], "id") is used
+    assert registry.get("index", ["title"], "id") is not idle
+
+
+def test_one_build_per_key(monkeypatch):
+    registry = build_registry()
+    release = threading.Event()
+    builds = []
+
+    def build(index_name, text_keys, id_key):
+        builds.append(index_name)
+        if index_name == "slow":
+            release.wait(5)
+        return object()
+
+    monkeypatch.setattr(registry, "_build", build)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get("slow"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    # the slow build does not block the other keys
+    registry.get("fast")
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert sorted(builds) == ["fast", "slow"]
+    assert len(results) == 8 and all(result is results[0] for result in results)
+
+
+def test_aclose_closes_both_clients():
+    registry = build_registry()
+    es_client, async_es_client = registry._es_client, registry._async_es_client
+    registry.get("index")
+    asyncio.run(registry.aclose())
+    assert es_client.closed and async_es_client.closed
+    assert registry._es_client is None and registry._async_es_client is None
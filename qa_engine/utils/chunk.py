@@ -1,5 +1,91 @@
-from typing import List, Tuple
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterator, List, Tuple
 import re
+from qa_engine.utils.tokens import CHARS_PER_TOKEN
+
+# a sentence ends with ., ! or ? followed by whitespace and a capital letter or a [, or with a blank line
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+(?=[A-Z\[])|\n\s*\n")
+WORD = re.compile(r"\S+")
+
+
+@dataclass
+class Passage:
+    text: str
+    # character offsets of the passage in the corpus, text == corpus[start:end]
+    start: int
+    end: int
+    tokens: int
+
+
+def iter_sentence_spans(corpus: str, max_tokens: int) -> Iterator[Tuple[int, int]]:
+    """
+    Yields the (start, end) offsets of the sentences of the corpus, sentences longer than `max_tokens` are
+    split between words (or inside a word longer than that).
+    """
+    start = 0
+    for boundary in SENTENCE_BOUNDARY.finditer(corpus):
+        yield from _bounded_spans(corpus, start, boundary.start(), max_tokens)
+        start = boundary.end()
+    yield from _bounded_spans(corpus, start, len(corpus), max_tokens)
+
+
+def _bounded_spans(corpus: str, start: int, end: int, max_tokens: int) -> Iterator[Tuple[int, int]]:
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if end - start <= max_chars:
+        if corpus[start:end].strip():
+            yield start, end
+        return
+    span_start = span_end = None
+    for word in WORD.finditer(corpus, start, end):
+        word_start, word_end = word.span()
+        while word_end - word_start > max_chars:
+            if span_start is not None:
+                yield span_start, span_end
+                span_start = None
+            yield word_start, word_start + max_chars
+            word_start += max_chars
+        if span_start is not None and word_end - span_start > max_chars:
+            yield span_start, span_end
+            span_start = None
+        if span_start is None:
+            span_start = word_start
+        span_end = word_end
+    if span_start is not None:
+        yield span_start, span_end
+
+
+def iter_passages(corpus: str, max_tokens: int, overlap_tokens=0) -> Iterator[Passage]:
+    """
+    Streams the corpus as passages of whole sentences holding at most `max_tokens` (estimated) tokens, in a
+    single pass with running token counts. Consecutive passages share their trailing / leading sentences
+    holding at most `overlap_tokens` tokens.
+    """
+    if overlap_tokens >= max_tokens:
+        raise ValueError("overlap_tokens must be smaller than max_tokens")
+    # (start, end, tokens) of the sentences of the current passage
+    sentences = deque()
+    tokens = 0
+    for start, end in iter_sentence_spans(corpus, max_tokens):
+        # same as estimate_tokens(corpus[start:end]) without copying the sentence
+        sentence_tokens = max(1, -(-(end - start) // CHARS_PER_TOKEN))
+        if sentences and tokens + sentence_tokens > max_tokens:
+            yield _passage(corpus, sentences, tokens)
+            # keep the trailing sentences that fit in the overlap and leave room for the next sentence
+            kept, kept_tokens = deque(), 0
+            while sentences and kept_tokens + sentences[-1][2] <= min(overlap_tokens, max_tokens - sentence_tokens):
+                kept.appendleft(sentences.pop())
+                kept_tokens += kept[0][2]
+            sentences, tokens = kept, kept_tokens
+        sentences.append((start, end, sentence_tokens))
+        tokens += sentence_tokens
+    if sentences:
+        yield _passage(corpus, sentences, tokens)
+
+
+def _passage(corpus: str, sentences, tokens: int) -> Passage:
+    start, end = sentences[0][0], sentences[-1][1]
+    return Passage(corpus[start:end], start, end, tokens)
 
 
 def chunk_corpus(corpus: str, chunk_size: int, sentence_word_count: Tuple[int, int]) -> List[
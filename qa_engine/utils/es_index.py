@@ -0,0 +1,165 @@
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+from qa_engine.utils.es_tasks import task_status
+from elasticsearch import Elasticsearch
+
+# (cluster client, index name) -> [number of bulk loads running, settings to restore]
+_bulk_loads: Dict[Tuple[int, str], list] = {}
+_bulk_loads_lock = threading.Lock()
+
+# the key of the index _meta mapping holding the settings a bulk load has to restore
+BULK_LOAD_META = "bulk_load"
+
+
+def _meta(es_client: Elasticsearch, index_name: str) -> dict:
+    # keyed on the concrete index, which differs from index_name when it is an alias (see migrate_to_routing)
+    return next(iter(es_client.indices.get_mapping(index=index_name).values()))["mappings"].get("_meta", {})
+
+
+def _restore(es_client: Elasticsearch, index_name: str, meta: dict):
+    es_client.indices.put_settings(index=index_name, settings={"index": meta[BULK_LOAD_META]})
+    # the _meta mapping is replaced as a whole
+    es_client.indices.put_mapping(index=index_name, meta={
+        key: value for key, value in meta.items() if key != BULK_LOAD_META})
+
+
+@contextmanager
+def bulk_load(es_client: Elasticsearch, index_name: str, replicas=0, force_merge_segments: Optional[int] = None):
+    """
+    Disables the periodic refresh of the index and lowers its replicas while the block writes to it, then
+    restores the previous settings, refreshes the index and optionally force-merges it down to
+    `force_merge_segments` segments. Overlapping bulk loads of the same index share the tuned settings,
+    the last one to exit restores them.
+    The settings are index-wide: until the block exits, nothing written to the index becomes searchable,
+    for every association and every api instance using it. The previous settings are kept in the _meta
+    mapping of the index, so a bulk load interrupted by a crash can be undone with restore_bulk_load. An index
+    whose refreshes are already disabled, by another process or an interrupted bulk load, is not tuned again.
+    """
+    key = (id(es_client), index_name)
+    with _bulk_loads_lock:
+        state = _bulk_loads.get(key)
+        if state is None:
+            settings = next(iter(es_client.indices.get_settings(index=index_name).values()))["settings"]["index"]
+            if settings.get("refresh_interval") == "-1":
+                raise ValueError(f"The refreshes of {index_name} are already disabled, by a running or an "
+                                 f"interrupted bulk load (see qa_engine.utils.es_index.restore_bulk_load)")
+            previous = {
+                # a missing refresh_interval is the default one, put back by a null
+                "refresh_interval": settings.get("refresh_interval"),
+                "number_of_replicas": settings.get("number_of_replicas"),
+            }
+            # persisted before tuning, a crash in between leaves nothing to restore
+            es_client.indices.put_mapping(index=index_name, meta={
+                **_meta(es_client, index_name), BULK_LOAD_META: previous})
+            es_client.indices.put_settings(index=index_name, settings={
+                "index": {"refresh_interval": "-1", "number_of_replicas": replicas}})
+            state = _bulk_loads[key] = [0, previous]
+        state[0] += 1
+    try:
+        yield
+    finally:
+        with _bulk_loads_lock:
+            state[0] -= 1
+            last = state[0] == 0
+            if last:
+                del _bulk_loads[key]
+                _restore(es_client, index_name, {**_meta(es_client, index_name), BULK_LOAD_META: state[1]})
+        if last:
+            es_client.indices.refresh(index=index_name)
+            if force_merge_segments is not None:
+                # merging a large vector index takes a while, the request must not time out before it ends
+                es_client.options(request_timeout=3600).indices.forcemerge(
+                    index=index_name, max_num_segments=force_merge_segments)
+
+
+def restore_bulk_load(es_client: Elasticsearch, index_name: str) -> bool:
+    """
+    Restores the settings of a bulk load of the index that did not exit, e.g. because its process crashed,
+    and refreshes the index. Returns whether there was one. Bulk loads running in this process are left alone,
+    the caller must make sure no other process is bulk loading the index.
+    """
+    with _bulk_loads_lock:
+        if (id(es_client), index_name) in _bulk_loads:
+            return False
+        meta = _meta(es_client, index_name)
+        if BULK_LOAD_META not in meta:
+            return False
+        _restore(es_client, index_name, meta)
+    es_client.indices.refresh(index=index_name)
+    return True
+
+
+def create_index(es_client: Elasticsearch, index_name: str, properties: dict, number_of_shards: int = None,
+                 routing=False):
+    """
+    Creates the index with the given field mappings. With `routing` every write and read must be routed,
+    the factories route on the parent_doc_id so an association lives on a single shard.
+    """
+    es_client.indices.create(index=index_name,
+                             settings={"number_of_shards": number_of_shards} if number_of_shards else None,
+                             mappings={"_routing": {"required": True}} if routing else None)
+    es_client.indices.put_mapping(index=index_name, properties=properties)
+
+
+def ensure_index(es_client: Elasticsearch, index_name: str, properties: dict, number_of_shards: int = None,
+                 routing=False):
+    """
+    Creates the index when missing (see create_index). An existing index is not changed, with `routing` it
+    must already require routing, otherwise it has to be migrated first.
+    """
+    if not es_client.indices.exists(index=index_name):
+        create_index(es_client, index_name, properties, number_of_shards, routing)
+        return
+    if routing:
+        mapping = next(iter(es_client.indices.get_mapping(index=index_name).values()))["mappings"]
+        if not mapping.get("_routing", {}).get("required", False):
+            raise ValueError(f"{index_name} does not require routing, migrate it first with "
+                             f"qa_engine.utils.es_index.migrate_to_routing (see scripts/migrate_routing.py)")
+
+
+def delete_index(es_client: Elasticsearch, index_name: str):
+    """
+    Deletes the index, or the indices behind it when it is an alias (see finish_routing_migration).
+    """
+    if es_client.indices.exists_alias(name=index_name):
+        # an alias cannot be deleted as an index, deleting its indices also removes it
+        es_client.indices.delete(index=list(es_client.indices.get_alias(name=index_name)))
+    else:
+        es_client.indices.delete(index=index_name)
+
+
+def migrate_to_routing(es_client: Elasticsearch, index_name: str, number_of_shards: int = None,
+                       suffix="-routed") -> str:
+    """
+    Creates f"{index_name}{suffix}" with the mappings of `index_name`, routing required and `number_of_shards`,
+    and starts copying the documents into it, routed on their parent_doc_id, as a background task whose id
+    is returned. finish_routing_migration switches `index_name` over once the task completed.
+    """
+    new_index = index_name + suffix
+    mapping = next(iter(es_client.indices.get_mapping(index=index_name).values()))["mappings"]
+    create_index(es_client, new_index, mapping.get("properties", {}), number_of_shards, routing=True)
+    response = es_client.reindex(source={"index": index_name}, dest={"index": new_index},
+                                 script={"lang": "painless", "source": "ctx._routing = ctx._source.parent_doc_id"},
+                                 conflicts="proceed", wait_for_completion=False)
+    return response["task"]
+
+
+def finish_routing_migration(es_client: Elasticsearch, index_name: str, task_id: str, suffix="-routed"):
+    """
+    Replaces `index_name` by an alias of its routed copy, in one atomic step. Writes to `index_name` made
+    since the migration started are lost, they must be stopped during the migration.
+    """
+    status = task_status(es_client, task_id)
+    if status is None or not status["completed"] or status["failures"]:
+        raise ValueError(f"The migration of {index_name} has not completed successfully: {status}")
+    new_index = index_name + suffix
+    es_client.indices.refresh(index=[index_name, new_index])
+    source_count = es_client.count(index=index_name)["count"]
+    copied_count = es_client.count(index=new_index)["count"]
+    if source_count != copied_count:
+        raise ValueError(f"{new_index} holds {copied_count} documents instead of the {source_count} of {index_name}")
+    es_client.indices.update_aliases(actions=[
+        {"add": {"index": new_index, "alias": index_name}},
+        {"remove_index": {"index": index_name}},
+    ])
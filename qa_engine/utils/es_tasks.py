@@ -0,0 +1,33 @@
+from typing import Optional
+from elasticsearch import Elasticsearch, NotFoundError
+
+
+def start_delete_by_query(es_client: Elasticsearch, index_name: str, filters: list, routing: str = None) -> str:
+    """
+    Starts a delete_by_query of the documents matching every filter as a background task of the cluster
+    and returns its id. Version conflicts with concurrent writes are skipped and the index is not refreshed.
+    """
+    response = es_client.delete_by_query(index=index_name, query={"bool": {"filter": filters}}, routing=routing,
+                                         conflicts="proceed", refresh=False, wait_for_completion=False)
+    return response["task"]
+
+
+def task_status(es_client: Elasticsearch, task_id: str) -> Optional[dict]:
+    """
+    Progress of a delete_by_query or reindex task, None when the cluster does not know it.
+    """
+    try:
+        response = es_client.tasks.get(task_id=task_id)
+    except NotFoundError:
+        return None
+    status = response["task"].get("status", {})
+    result = response.get("response", {})
+    return {
+        "task": task_id,
+        "completed": response["completed"],
+        "total": status.get("total", 0),
+        "created": status.get("created", 0),
+        "deleted": status.get("deleted", 0),
+        "version_conflicts": status.get("version_conflicts", 0),
+        "failures": result.get("failures", []) + ([response["error"]] if "error" in response else []),
+    }
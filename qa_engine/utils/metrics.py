@@ -0,0 +1,99 @@
+import bisect
+import threading
+from typing import Dict, List, Tuple
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# upper bounds of the item count histogram buckets
+ITEM_BUCKETS = (1, 4, 16, 64, 256, 1024, 4096, 16384)
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name: str, labels: str) -> List[str]:
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class StageMetrics:
+    """
+    Thread-safe per-stage latency and item count histograms and error counters, a stage observer
+    (see qa_engine.utils.stages) that renders them in the Prometheus text exposition format.
+    """
+
+    def __init__(self, prefix="qa"):
+        self.prefix = prefix
+        self._latencies: Dict[str, _Histogram] = {}
+        self._items: Dict[str, _Histogram] = {}
+        self._errors: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name: str, seconds: float, count: int, failed: bool):
+        with self._lock:
+            if name not in self._latencies:
+                self._latencies[name] = _Histogram(LATENCY_BUCKETS)
+                self._items[name] = _Histogram(ITEM_BUCKETS)
+                self._errors[name] = 0
+            self._latencies[name].observe(seconds)
+            self._items[name].observe(count)
+            if failed:
+                self._errors[name] += 1
+
+    def clear(self):
+        with self._lock:
+            self._latencies, self._items, self._errors = {}, {}, {}
+
+    def render(self) -> str:
+        latency, items, errors = (f"{self.prefix}_stage_duration_seconds", f"{self.prefix}_stage_items",
+                                  f"{self.prefix}_stage_errors_total")
+        with self._lock:
+            stages = sorted(self._latencies)
+            lines = [f"# HELP {latency} Latency of the pipeline stages.", f"# TYPE {latency} histogram"]
+            for name in stages:
+                lines += self._latencies[name].lines(latency, f'stage="{name}"')
+            lines += [f"# HELP {items} Number of items (entries, texts, ids) processed per stage run.",
+                      f"# TYPE {items} histogram"]
+            for name in stages:
+                lines += self._items[name].lines(items, f'stage="{name}"')
+            lines += [f"# HELP {errors} Number of stage runs that raised.", f"# TYPE {errors} counter"]
+            for name in stages:
+                lines.append(f'{errors}{{stage="{name}"}} {self._errors[name]}')
+        return "\n".join(lines) + "\n"
+
+
+class StageTimings:
+    """
+    Stage observer summing the duration of every stage, rendered as a Server-Timing header value.
+    """
+
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name: str, seconds: float, count: int, failed: bool):
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        with self._lock:
+            return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.durations.items())
+
+
+# process-wide metrics of every stage
+stage_metrics = StageMetrics()
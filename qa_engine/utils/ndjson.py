@@ -0,0 +1,38 @@
+import json
+from typing import Any, AsyncIterator, List
+
+
+async def aiter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    """
+    Parses newline-delimited json from a stream of byte chunks, yielding every object as soon as its line
+    is complete. Blank lines are skipped, a malformed line raises a ValueError naming its line number.
+    """
+    partial = b""
+    line_number = 0
+    async for chunk in chunks:
+        lines = (partial + chunk).split(b"\n")
+        partial = lines.pop()
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield _parse(line, line_number)
+    if partial.strip():
+        yield _parse(partial, line_number + 1)
+
+
+def _parse(line: bytes, line_number: int) -> Any:
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        raise ValueError(f"Malformed json on line {line_number}: {e}")
+
+
+async def aiter_batches(items: AsyncIterator[Any], batch_size: int) -> AsyncIterator[List[Any]]:
+    batch = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
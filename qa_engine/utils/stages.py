@@ -0,0 +1,55 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, List, Tuple
+
+# called with (stage name, seconds, item count, whether the stage raised)
+StageObserver = Callable[[str, float, int, bool], None]
+
+# observers of the stages run in the current context
+_observers: ContextVar[Tuple[StageObserver, ...]] = ContextVar("stage_observers", default=())
+# observers of every stage of the process, e.g. the metrics exporter
+_global_observers: List[StageObserver] = []
+
+
+def add_global_observer(observer: StageObserver):
+    if observer not in _global_observers:
+        _global_observers.append(observer)
+
+
+def remove_global_observer(observer: StageObserver):
+    if observer in _global_observers:
+        _global_observers.remove(observer)
+
+
+@contextmanager
+def observe_stages(observer: StageObserver):
+    """
+    Reports every stage run in the current context (thread or task, and the ones it starts) to `observer`
+    until the block exits.
+    """
+    token = _observers.set(_observers.get() + (observer,))
+    try:
+        yield
+    finally:
+        _observers.reset(token)
+
+
+@contextmanager
+def stage(name: str, count=1):
+    """
+    Times the block as the stage `name` processing `count` items, a no-op when nothing observes it.
+    """
+    observers = _observers.get() + tuple(_global_observers)
+    if not observers:
+        yield
+        return
+    start = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        elapsed = time.perf_counter() - start
+        for observer in observers:
+            observer(name, elapsed, count, failed)
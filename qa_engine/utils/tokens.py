@@ -0,0 +1,11 @@
+import math
+
+# Average number of characters per token of the OpenAI tokenizers on english text
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token count estimate used to size requests and chunks without loading a tokenizer.
+    """
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
@@ -0,0 +1,94 @@
+"""
+Measures the ingestion rate of a synthetic json catalog into fresh Elasticsearch indices with and without the
+bulk-load mode of the caching strategy (refreshes disabled, no replicas, optional force-merge of the vector
+index) and prints the results, including the speedup, as json. Embeddings come from the deterministic hash
+embedding operator, so only an Elasticsearch cluster is needed.
+
+    python scripts/bench_bulk_load.py --hosts http://localhost:9200 --objects 20000 --force-merge-segments 1
+"""
+from qa_engine.core.caching_strategy import JSONChunkingCachingStrategy
+from qa_engine.core.document_factory import ESDocumentFactory
+from qa_engine.core.document_operator import BasicDocumentOperator
+from qa_engine.core.embedding_factory import ESEmbeddingFactory
+from qa_engine.core.embedding_operator import HashEmbeddingOperator
+from qa_engine.core.models import Document
+from contextlib import nullcontext
+from benchmark import catalog
+import argparse
+import json
+import time
+
+doc_id = "benchmark"
+
+
+def build_strategy(es_client_params: dict, index_prefix: str, retrieval_mode: str) -> JSONChunkingCachingStrategy:
+    embedding_operator = HashEmbeddingOperator()
+    document_factory = ESDocumentFactory(es_client_params, index_prefix + "$docs")
+    embedding_factory = ESEmbeddingFactory(es_client_params, index_prefix + "$embs", embedding_operator.embedding_size,
+                                           es_client=document_factory.es_client, retrieval_mode=retrieval_mode)
+    document_factory.clear()
+    embedding_factory.clear()
+    return JSONChunkingCachingStrategy(
+        embedding_factory=embedding_factory,
+        document_factory=document_factory,
+        embedding_operator=embedding_operator,
+        document_operator=BasicDocumentOperator(),
+        text_keys=["description"],
+        id_key="id",
+    )
+
+
+def ingest(strategy: JSONChunkingCachingStrategy, objects: list, batch_size: int, bulk_load: bool,
+           force_merge_segments: int) -> dict:
+    start = time.perf_counter()
+    with strategy.bulk_load(force_merge_segments) if bulk_load else nullcontext():
+        for i in range(0, len(objects), batch_size):
+            strategy.cache(Document(doc_id, data=objects[i:i + batch_size]))
+        load_seconds = time.perf_counter() - start
+    if not bulk_load:
+        strategy.document_factory.es_client.indices.refresh(index=strategy.embedding_factory.index_name)
+    total_seconds = time.perf_counter() - start
+    entries = strategy.embedding_factory.es_client.count(index=strategy.embedding_factory.index_name)["count"]
+    return {
+        "bulk_load": bulk_load,
+        "entries": entries,
+        "load_seconds": round(load_seconds, 3),
+        # includes restoring the settings, the final refresh and the force-merge
+        "total_seconds": round(total_seconds, 3),
+        "objects_per_second": round(len(objects) / total_seconds, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hosts", default="http://localhost:9200")
+    parser.add_argument("--index-prefix", default="bench_bulk_load")
+    parser.add_argument("--objects", type=int, default=20000)
+    parser.add_argument("--sentences", type=int, default=6, help="sentences per object description")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--retrieval-mode", default="knn", choices=["knn", "script_score"])
+    parser.add_argument("--force-merge-segments", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    es_client_params = {"hosts": args.hosts, "timeout": 120}
+    objects = catalog(args.objects, args.sentences, args.seed)
+    runs = []
+    for bulk_load in (False, True):
+        strategy = build_strategy(es_client_params, args.index_prefix, args.retrieval_mode)
+        runs.append(ingest(strategy, objects, args.batch_size, bulk_load, args.force_merge_segments))
+        strategy.document_factory.destruct()
+        strategy.embedding_factory.destruct()
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "objects": args.objects,
+        "retrieval_mode": args.retrieval_mode,
+        "force_merge_segments": args.force_merge_segments,
+        "runs": runs,
+        "speedup": round(runs[0]["total_seconds"] / runs[1]["total_seconds"], 2),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Compares the throughput of chunk_corpus and the token-aware iter_passages on multi-MB corpora built by
+repeating a text file, and prints the results as json.
+
+    python scripts/bench_chunking.py --corpus qa_engine/tests/assets/stalin.txt --sizes-mb 1 4 16
+"""
+from qa_engine.utils.chunk import chunk_corpus, iter_passages
+import argparse
+import json
+import time
+
+
+def corpus_of_size(text: str, size: int) -> str:
+    return (text * (size // len(text) + 1))[:size]
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default="qa_engine/tests/assets/stalin.txt")
+    parser.add_argument("--sizes-mb", type=float, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--chunk-size", type=int, default=8)
+    parser.add_argument("--max-words", type=int, default=75)
+    parser.add_argument("--max-tokens", type=int, default=100)
+    parser.add_argument("--overlap-tokens", type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.corpus, "r") as f:
+        text = f.read()
+
+    report = {"corpus": args.corpus, "runs": []}
+    for size_mb in args.sizes_mb:
+        corpus = corpus_of_size(text, int(size_mb * 1024 * 1024))
+        megabytes = len(corpus.encode("utf-8")) / (1024 * 1024)
+        seconds, chunks = timed(lambda: chunk_corpus(corpus, args.chunk_size, (15, args.max_words)))
+        report["runs"].append({
+            "chunker": "chunk_corpus",
+            "size_mb": round(megabytes, 2),
+            "seconds": round(seconds, 3),
+            "mb_per_second": round(megabytes / seconds, 2),
+            "entries": sum(len(chunk) for chunk in chunks),
+        })
+        seconds, passages = timed(lambda: list(iter_passages(corpus, args.max_tokens, args.overlap_tokens)))
+        report["runs"].append({
+            "chunker": "iter_passages",
+            "size_mb": round(megabytes, 2),
+            "seconds": round(seconds, 3),
+            "mb_per_second": round(megabytes / seconds, 2),
+            "entries": len(passages),
+            "max_tokens": max(passage.tokens for passage in passages),
+        })
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Compares recall@k and retrieve latency of the quantized NumpyEmbeddingFactory modes against the exact
+float32 baseline on synthetic clustered embeddings, and prints the results as json.
+
+    python scripts/bench_quantization.py --rows 50000 --dims 1536 --queries 100 --k 25
+"""
+from qa_engine.core.embedding_factory import NumpyEmbeddingFactory
+from qa_engine.core.models import EmbeddingEntry
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+
+doc_id = "bench"
+
+
+def clustered_vectors(rng, rows: int, dims: int, clusters: int) -> np.ndarray:
+    centers = rng.normal(size=(clusters, dims)).astype(np.float32)
+    assignments = rng.integers(0, clusters, size=rows)
+    return centers[assignments] + 0.5 * rng.normal(size=(rows, dims)).astype(np.float32)
+
+
+def build(root_dir: str, vectors: np.ndarray, k: int, quantization=None, rescore_window=None) -> NumpyEmbeddingFactory:
+    factory = NumpyEmbeddingFactory(root_dir, vectors.shape[1], size=k, quantization=quantization,
+                                    rescore_window=rescore_window)
+    for start in range(0, len(vectors), 10000):
+        factory.store(doc_id, [EmbeddingEntry(str(start + i), vector.tolist(), {})
+                               for i, vector in enumerate(vectors[start:start + 10000])])
+    return factory
+
+
+def run(factory: NumpyEmbeddingFactory, queries: np.ndarray):
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        entries = factory.retrieve(doc_id, query.tolist())
+        latencies.append(time.perf_counter() - start)
+        results.append([entry.id for entry in entries])
+    return results, latencies
+
+
+def code_bytes(factory: NumpyEmbeddingFactory) -> int:
+    association = factory._association(doc_id)
+    if association.quantization is None:
+        return association.matrix.nbytes
+    return association.codes.nbytes + association.scales.nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--rescore-windows", type=int, nargs="+", default=[25, 100, 400])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors = clustered_vectors(rng, args.rows, args.dims, args.clusters)
+    queries = clustered_vectors(rng, args.queries, args.dims, args.clusters)
+
+    report = {"rows": args.rows, "dims": args.dims, "queries": args.queries, "k": args.k, "runs": []}
+    with tempfile.TemporaryDirectory() as root_dir:
+        baseline = build(os.path.join(root_dir, "float32"), vectors, args.k)
+        expected, latencies = run(baseline, queries)
+        configurations = [(None, None)] + [(quantization, window) for quantization in ("int8", "binary")
+                                           for window in args.rescore_windows]
+        for quantization, window in configurations:
+            if quantization is None:
+                factory, results = baseline, expected
+            else:
+                factory = build(os.path.join(root_dir, f"{quantization}-{window}"), vectors, args.k,
+                                quantization, window)
+                results, latencies = run(factory, queries)
+            recall = np.mean([len(set(result) & set(truth)) / len(truth) for result, truth in zip(results, expected)])
+            report["runs"].append({
+                "quantization": quantization or "float32",
+                "rescore_window": window,
+                f"recall@{args.k}": round(float(recall), 4),
+                "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+                "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 3),
+                "scanned_bytes": code_bytes(factory),
+            })
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Offline benchmark suite of the core pipeline: chunking throughput, entry creation cost, ingest rate, find
+latency and peak memory on synthetic json catalogs of several sizes. Uses the deterministic hash embedding
+operator, an in-memory document factory and a NumpyEmbeddingFactory in a temporary directory, so no
+Elasticsearch or OpenAI access is needed. Results are printed (or written to --output) as json.
+
+    python scripts/benchmark.py --sizes 100 1000 10000 --output benchmark.json
+"""
+from qa_engine.core.caching_strategy import JSONChunkingCachingStrategy
+from qa_engine.core.document_factory import InMemoryDocumentFactory
+from qa_engine.core.document_operator import BasicDocumentOperator
+from qa_engine.core.embedding_factory import NumpyEmbeddingFactory
+from qa_engine.core.embedding_operator import HashEmbeddingOperator
+from qa_engine.core.models import Document
+from qa_engine.utils.chunk import chunk_corpus, iter_passages
+import argparse
+import json
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+doc_id = "benchmark"
+
+VOCABULARY = ("engine wheel battery sensor cable filter valve pump motor panel screen switch frame bearing "
+              "gasket spring bolt lever hinge nozzle red green steel plastic compact heavy portable quiet "
+              "durable wireless replaceable adjustable").split()
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    text = " ".join(rng.choice(VOCABULARY) for _ in range(words))
+    return text[0].upper() + text[1:] + "."
+
+
+def catalog(size: int, sentences_per_object: int, seed: int) -> list:
+    rng = random.Random(seed)
+    return [
+        {"id": str(i), "description": " ".join(sentence(rng, rng.randint(6, 20)) for _ in range(sentences_per_object))}
+        for i in range(size)
+    ]
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def build_strategy(root_dir: str) -> JSONChunkingCachingStrategy:
+    embedding_operator = HashEmbeddingOperator()
+    return JSONChunkingCachingStrategy(
+        embedding_factory=NumpyEmbeddingFactory(root_dir, embedding_operator.embedding_size),
+        document_factory=InMemoryDocumentFactory(),
+        embedding_operator=embedding_operator,
+        document_operator=BasicDocumentOperator(),
+        text_keys=["description"],
+        id_key="id",
+    )
+
+
+def percentiles(latencies: list) -> dict:
+    return {f"p{p}_ms": round(float(np.percentile(latencies, p)) * 1000, 3) for p in (50, 95, 99)}
+
+
+def run(size: int, args) -> dict:
+    objects = catalog(size, args.sentences, args.seed)
+    corpus = " ".join(obj["description"] for obj in objects)
+    megabytes = len(corpus.encode("utf-8")) / (1024 * 1024)
+    result = {"objects": size, "corpus_mb": round(megabytes, 3)}
+
+    seconds, _ = timed(lambda: chunk_corpus(corpus, 8, (15, 75)))
+    result["chunk_corpus_mb_per_second"] = round(megabytes / seconds, 2)
+    seconds, _ = timed(lambda: list(iter_passages(corpus, 100)))
+    result["iter_passages_mb_per_second"] = round(megabytes / seconds, 2)
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        strategy = build_strategy(root_dir)
+        seconds, entries = timed(lambda: strategy._parsed_obj_to_entries(objects))
+        result["entries"] = len(entries)
+        result["parse_us_per_object"] = round(seconds / size * 1e6, 2)
+
+        seconds, _ = timed(lambda: strategy.cache(Document(doc_id, data=objects)))
+        result["cache_objects_per_second"] = round(size / seconds, 1)
+        result["cache_entries_per_second"] = round(len(entries) / seconds, 1)
+
+        seconds, _ = timed(lambda: strategy.cache(Document(doc_id, data=objects)))
+        result["recache_unchanged_objects_per_second"] = round(size / seconds, 1)
+
+        rng = random.Random(args.seed + 1)
+        queries = [sentence(rng, 6) for _ in range(args.queries)]
+        latencies = [timed(lambda: strategy.find(doc_id, query))[0] for query in queries]
+        result["find"] = percentiles(latencies)
+
+    # in a pass of its own, tracing the allocations slows down the timed one
+    with tempfile.TemporaryDirectory() as root_dir:
+        strategy = build_strategy(root_dir)
+        tracemalloc.start()
+        strategy.cache(Document(doc_id, data=objects))
+        result["cache_peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+        tracemalloc.stop()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--sentences", type=int, default=6, help="sentences per object description")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file the json results are written to instead of stdout")
+    args = parser.parse_args()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "seed": args.seed,
+        "runs": [run(size, args) for size in args.sizes],
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
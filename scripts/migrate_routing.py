@@ -0,0 +1,52 @@
+"""
+Migrates the indices of an existing index name ($docs, $embs and $objs) to routing by parent_doc_id: each one
+is reindexed into a routed copy with the given number of shards, then atomically replaced by an alias of the
+copy. Ingestion into the index must be stopped while it runs, searches keep working. Afterwards, run the api
+with ES_ROUTING=true (and ES_NUMBER_OF_SHARDS for the indices it creates).
+
+    python scripts/migrate_routing.py --hosts http://localhost:9200 --index products --shards 12
+"""
+from qa_engine.utils.es_index import finish_routing_migration, migrate_to_routing
+from qa_engine.utils.es_tasks import task_status
+from elasticsearch import Elasticsearch
+import argparse
+import json
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hosts", default="http://localhost:9200")
+    parser.add_argument("--index", required=True, help="the index name used by the api")
+    parser.add_argument("--shards", type=int, default=None, help="primary shards of the routed indices")
+    parser.add_argument("--suffix", default="-routed", help="suffix of the routed copies")
+    parser.add_argument("--poll-seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    es_client = Elasticsearch(hosts=args.hosts, request_timeout=120)
+    tasks = {}
+    for suffix in ("$docs", "$embs", "$objs"):
+        index_name = args.index + suffix
+        if not es_client.indices.exists(index=index_name):
+            continue
+        if es_client.indices.exists_alias(name=index_name):
+            print(f"{index_name} is already an alias, skipping it")
+            continue
+        tasks[index_name] = migrate_to_routing(es_client, index_name, args.shards, args.suffix)
+
+    while tasks:
+        for index_name, task_id in list(tasks.items()):
+            status = task_status(es_client, task_id)
+            if status is None:
+                raise SystemExit(f"The reindex task {task_id} of {index_name} is unknown to the cluster")
+            print(json.dumps({"index": index_name, **status}))
+            if status["completed"]:
+                finish_routing_migration(es_client, index_name, task_id, args.suffix)
+                print(f"{index_name} is now an alias of {index_name + args.suffix}")
+                del tasks[index_name]
+        if tasks:
+            time.sleep(args.poll_seconds)
+
+
+if __name__ == "__main__":
+    main()